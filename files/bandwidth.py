@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+"""
+Host-wide upload bandwidth limit, shared by all the uploads of all the
+dx_sync_directory.py processes running on a host.
+
+The limit is a token bucket whose state is kept in a small JSON file (by
+default STATE_FILE_NAME, in the log directory of the uploads), updated under
+an exclusive lock (fcntl.flock) by every upload before it sends data:
+
+  tat: the theoretical arrival time of the bucket (GCRA): the time at which
+  all the bytes sent so far would have been sent at the current rate. An
+  upload sending n bytes moves it n / rate seconds forward, and waits for as
+  long as it is more than BURST seconds ahead of the current time.
+
+  uploads: the registry of the uploads in progress ({"<pid>:<id>": start
+  time}), so that Upload Agent, which runs in a process of its own and is
+  only given a rate (--throttle), gets a fair share of the limit. Entries of
+  processes which are gone are dropped.
+
+The rate may change with the time of day: a Schedule has a default rate and
+windows ("HH:MM-HH:MM=<MB/s>", in local time, possibly spanning midnight)
+with rates of their own. A rate of 0 means no limit.
+
+The state file is created readable and writable by its owner and group only
+(0o660), so that uploads run by other users of the host share it only if
+given the same file in a directory of a group of theirs, and is never
+opened through a symbolic link.
+"""
+
+import contextlib
+import datetime
+import fcntl
+import itertools
+import json
+import os
+import re
+import stat
+import sys
+import threading
+import time
+import logging
+
+
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stderr)
+formatter = logging.Formatter(
+    fmt="[proc:%(process)d][%(filename)s][%(asctime)s][%(levelname)s] %(message)s",
+    datefmt="%b %d %Y, %I:%M:%S %p (%Z)"
+)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.DEBUG)
+
+# Name of the state file, in the log directory, unless given one
+STATE_FILE_NAME = "bandwidth.state"
+
+# Seconds of data at the current rate that may be sent in a burst
+BURST = 1.0
+
+# Longest single wait, so that a change of rate is picked up promptly
+MAX_WAIT = 5.0
+
+_WINDOW = re.compile(r"^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(\d+(?:\.\d+)?)$")
+
+
+class Schedule:
+    """Upload rate (bytes/s, 0 for no limit) by time of day"""
+
+    def __init__(self, default_rate=0, windows=()):
+        self.default_rate = default_rate
+        # [(start minute, end minute, rate)]
+        self.windows = list(windows)
+
+    @classmethod
+    def parse(cls, limit_mb=0, window_specs=()):
+        """Schedule from a default rate and "HH:MM-HH:MM=<MB/s>" windows.
+        Raises ValueError on a malformed window."""
+        windows = []
+        for spec in window_specs or ():
+            match = _WINDOW.match(spec.strip())
+            if match is None:
+                raise ValueError("Invalid bandwidth window %r, expected HH:MM-HH:MM=<MB/s>" % spec)
+            start_h, start_m, end_h, end_m = (int(group) for group in match.groups()[:4])
+            if start_h > 23 or end_h > 24 or start_m > 59 or end_m > 59:
+                raise ValueError("Invalid time of day in bandwidth window %r" % spec)
+            windows.append((start_h * 60 + start_m, end_h * 60 + end_m, float(match.group(5)) * 2**20))
+        return cls(float(limit_mb or 0) * 2**20, windows)
+
+    def rate(self, now=None):
+        """Rate in effect at time now (local time of day)"""
+        moment = datetime.datetime.fromtimestamp(time.time() if now is None else now)
+        minute = moment.hour * 60 + moment.minute
+        for start, end, rate in self.windows:
+            if start <= end:
+                inside = start <= minute < end
+            else:
+                inside = minute >= start or minute < end
+            if inside:
+                return rate
+        return self.default_rate
+
+    def is_limited(self):
+        return bool(self.default_rate or any(rate for _, _, rate in self.windows))
+
+
+class HostLimiter:
+    """Token bucket shared through state_file by the processes of the host"""
+
+    _ids = itertools.count()
+
+    def __init__(self, schedule, state_file):
+        self.schedule = schedule
+        self.state_file = state_file
+
+    @contextlib.contextmanager
+    def _state(self):
+        """The shared state, locked, saved back on exit"""
+        fd = os.open(self.state_file, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o660)
+        if not stat.S_ISREG(os.fstat(fd).st_mode):
+            os.close(fd)
+            raise OSError("Bandwidth state file %s is not a regular file" % self.state_file)
+        with os.fdopen(fd, 'r+') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                try:
+                    state = json.loads(fh.read() or "{}")
+                except ValueError:
+                    state = {}
+                state.setdefault('tat', 0.0)
+                state.setdefault('uploads', {})
+                yield state
+                fh.seek(0)
+                fh.truncate()
+                fh.write(json.dumps(state))
+                fh.flush()
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def acquire(self, nbytes, now=None):
+        """Wait until nbytes may be sent, and return the seconds waited"""
+        waited = 0.0
+        while True:
+            rate = self.schedule.rate(now)
+            if not rate:
+                return waited
+            with self._state() as state:
+                current = time.time() if now is None else now
+                tat = max(state['tat'], current)
+                wait = tat - current - BURST
+                if wait <= 0:
+                    state['tat'] = tat + nbytes / rate
+                    return waited
+            # Not reserved while waiting, so that a change of rate applies
+            wait = min(wait, MAX_WAIT)
+            time.sleep(wait)
+            waited += wait
+            if now is not None:
+                now += wait
+
+    @contextlib.contextmanager
+    def register(self):
+        """Record an upload as in progress for the duration of the context"""
+        key = "%d:%d" % (os.getpid(), next(self._ids))
+        with self._state() as state:
+            state['uploads'][key] = time.time()
+        try:
+            yield
+        finally:
+            with self._state() as state:
+                state['uploads'].pop(key, None)
+
+    def active_uploads(self):
+        """Number of uploads in progress on the host"""
+        with self._state() as state:
+            for key in list(state['uploads']):
+                if not _pid_alive(int(key.split(":")[0])):
+                    del state['uploads'][key]
+            return len(state['uploads'])
+
+    def fair_share(self, now=None):
+        """Rate (bytes/s) for an upload which cannot be paced part by part,
+        the current rate divided among the uploads in progress, or 0 for no
+        limit"""
+        rate = self.schedule.rate(now)
+        if not rate:
+            return 0
+        return int(rate / max(self.active_uploads(), 1))
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def limiter(schedule, state_file):
+    """The HostLimiter of state_file, shared by the uploads of the process"""
+    with _limiters_lock:
+        if state_file not in _limiters:
+            _limiters[state_file] = HostLimiter(schedule, state_file)
+        return _limiters[state_file]
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+"""
+Event-driven change detection for dx_sync_directory.py, based on Linux
+inotify. Rather than walking the whole RUN directory every sync interval,
+a watcher subscribes to inotify events under the sync directory and keeps
+a set of 'dirty' paths, i.e. paths that were created or modified since
+they were last handed out. A sync cycle then only needs to look at the
+dirty paths instead of the whole tree.
+
+inotify only reports changes made through the local kernel. Changes made
+by another NFS/SMB client (e.g. an instrument writing onto a network share)
+are NOT reported, which is why callers must still perform a full walk at
+startup and periodically as a safety net (see InotifyWatcher.needs_full_scan).
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import os.path
+import struct
+import sys
+import time
+import logging
+
+
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stderr)
+formatter = logging.Formatter(
+    fmt="[proc:%(process)d][%(filename)s][%(asctime)s][%(levelname)s] %(message)s",
+    datefmt="%b %d %Y, %I:%M:%S %p (%Z)"
+)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.DEBUG)
+
+# inotify constants, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+# Events which change the content of the directory they are reported for,
+# and hence its mtime
+DIR_CHANGE_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+
+class WatcherError(Exception):
+    """Raised when the watcher cannot be set up (e.g. inotify is unavailable
+    or the number of watches exceeds fs.inotify.max_user_watches)"""
+
+
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        raise WatcherError("inotify is only available on Linux")
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    for func in ("inotify_init1", "inotify_add_watch", "inotify_rm_watch"):
+        if not hasattr(libc, func):
+            raise WatcherError("libc does not provide %s" % func)
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_add_watch.restype = ctypes.c_int
+    return libc
+
+
+class InotifyWatcher:
+    """Watches a directory tree and accumulates the paths that changed.
+
+    Typical usage by a long-lived sync loop:
+
+        watcher = InotifyWatcher(sync_dir, full_scan_interval=3600)
+        watcher.start()
+        ...
+        if watcher.needs_full_scan():
+            watcher.mark_full_scan()
+            <walk the whole tree>
+        else:
+            dirty = watcher.take_dirty()
+            <look at dirty paths only, requeue those not ready yet>
+    """
+
+    def __init__(self, root, full_scan_interval=3600):
+        self.root = os.path.abspath(root)
+        self.full_scan_interval = full_scan_interval
+        self.fd = None
+        self.wd_to_dir = {}
+        self.dirty = set()
+        self.overflowed = False
+        self.last_full_scan = None
+        self._libc = None
+
+    def start(self):
+        """Initialise inotify and add a watch to every directory under root"""
+        self._libc = _load_libc()
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise WatcherError("inotify_init1 failed: %s" % os.strerror(err))
+        self._watch_tree(self.root, mark_dirty=False)
+        logger.info("Watching %d directories under %s" % (len(self.wd_to_dir), self.root))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            self.wd_to_dir = {}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                # Directory vanished between listing and watching
+                return
+            if err == errno.ENOSPC:
+                raise WatcherError("Too many directories to watch under %s, consider increasing "
+                                   "fs.inotify.max_user_watches" % self.root)
+            raise WatcherError("inotify_add_watch failed for %s: %s" % (path, os.strerror(err)))
+        self.wd_to_dir[wd] = path
+
+    def _watch_tree(self, top, mark_dirty):
+        """Add watches to top and all directories below it. When mark_dirty is set,
+        everything found is marked dirty, as files may have been created in a new
+        directory before its watch was in place."""
+        self._add_watch(top)
+        for root, dirs, files in os.walk(top):
+            for name in dirs:
+                self._add_watch(os.path.join(root, name))
+            if mark_dirty:
+                for name in dirs + files:
+                    self.dirty.add(os.path.join(root, name))
+
+    def poll(self):
+        """Read all pending events without blocking and update the dirty set"""
+        if self.fd is None:
+            return
+        while True:
+            try:
+                buf = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                return
+            if not buf:
+                return
+            self._handle_events(buf)
+
+    def _handle_events(self, buf):
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(buf):
+            wd, mask, _cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip(b"\0")
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped by the kernel, only a full walk can recover
+                logger.warning("inotify event queue overflowed, a full scan will be performed")
+                self.overflowed = True
+                continue
+
+            directory = self.wd_to_dir.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.wd_to_dir[wd]
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                continue
+
+            # The root itself is not part of the synced files, see os.walk
+            if mask & DIR_CHANGE_MASK and directory != self.root:
+                self.dirty.add(directory)
+            if not name:
+                continue
+
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                self.dirty.discard(path)
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.dirty.add(path)
+                self._watch_tree(path, mark_dirty=True)
+                continue
+            self.dirty.add(path)
+
+    def needs_full_scan(self, now=None):
+        """Whether the caller should walk the whole tree instead of relying on
+        the dirty set: at startup, after an event queue overflow, and every
+        full_scan_interval seconds"""
+        now = time.time() if now is None else now
+        if self.last_full_scan is None or self.overflowed:
+            return True
+        return now - self.last_full_scan >= self.full_scan_interval
+
+    def mark_full_scan(self, now=None):
+        """Record that a full walk is starting. Dirty paths accumulated so far are
+        covered by the walk and are dropped."""
+        self.poll()
+        self.dirty = set()
+        self.overflowed = False
+        self.last_full_scan = time.time() if now is None else now
+
+    def take_dirty(self):
+        """Return the paths changed since the last call, and reset the dirty set"""
+        self.poll()
+        dirty, self.dirty = self.dirty, set()
+        return dirty
+
+    def requeue(self, paths):
+        """Put back paths which were looked at but are not ready to be synced yet
+        (e.g. not older than --min-age), so that they are looked at again"""
+        self.dirty.update(paths)
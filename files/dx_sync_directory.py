@@ -7,11 +7,22 @@ tar files containing bundles of recently modified files.
 """
 
 import argparse
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import grp
+import hashlib
+import io
 import json
 import os
 import os.path
+import pwd
+import stat
 import sys
 import tarfile
+import threading
 import time
 import tempfile
 import re
@@ -22,6 +33,21 @@ from dxpy.utils.printing import YELLOW
 import humanfriendly
 import logging
 
+import run_readiness
+import bandwidth
+import sqlite_log
+import upload_engine
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 
 # For more information about script and inputs run the script with --help option
 # $ python3 dx_sync_directory.py --help
@@ -50,6 +76,8 @@ import logging
 #       "tarred" -- the tar file has been created, but not yet (successfully) uploaded
 #       "uploaded" -- the tar file has been successfully uploaded, but not yet locally removed
 #       "removed" -- the tar file has been successfully uploaded and removed from the local filesystem
+#       "streaming" -- (--stream-upload only) the tar file is being uploaded as it is generated,
+#                      and was never written locally; it goes to "removed" once uploaded
 #
 #     timestamps [Python's time.time() timestamp]
 #       "tar_start"
@@ -59,8 +87,39 @@ import logging
 #       "remove_start"
 #       "remove_end"
 #
+#     size: total size of the files archived
+#
+#     fill: packing efficiency of the tar file, as size / --max-tar-size
+#
+#     index, index_file_id: (--tar-index only) the local path of the index
+#     of the members of the tar file, and its file ID once uploaded
+#
+#     md5, blake2b or xxh3, checksum_part_size, part_md5s: (--checksums
+#     only) the MD5 and fast hash (--fast-hash) of the tar file, and the MD5s
+#     of its parts of checksum_part_size bytes, computed as it was written;
+#     part_md5s is dropped once checked against the uploaded file
+#
+#     compression, compressed_size: (--compression only) the codec a tar
+#     file of compressible files was compressed with, and its size on disk
+#
 #     file_id: file ID of the uploaded file in the platform
 #
+#     file_id, part_size, parts: (--native-upload only) while a "tarred"
+#     tar file is being uploaded, the platform file it is uploaded to, its
+#     part size, and the indexes of the parts uploaded so far, so that an
+#     interrupted upload is resumed with the missing parts
+#
+#     throughput, throttled: the upload rate of the tar file (bytes/s), kept
+#     up to date while a --native-upload is in progress, and the seconds its
+#     upload threads waited on the bandwidth limit (--bandwidth-limit,
+#     --bandwidth-window)
+#
+#     streamed, part_size, parts, members: (--stream-upload only) the tar
+#     file was streamed in parts of part_size bytes; parts lists the indexes
+#     of the parts uploaded so far, and members the FileEntry fields of the
+#     archived files, from which an interrupted tar stream is regenerated
+#     byte for byte to upload the missing parts.
+#
 #   next_tar_index: number giving the index of the next tar file to be
 #   created; used to construct the name of the file.
 #
@@ -72,6 +131,38 @@ import logging
 #    was synced
 #
 #    size: the file's size, used to determine if tarball has met minimum size to upload
+#
+#    md5: (--checksums only) the MD5 of the file's content, as archived
+#
+# Log journal:
+#
+#  Rewriting the whole log on every state change costs O(number of synced
+#  files), so state changes are instead appended to a journal next to the
+#  log (<log-file>.journal), one JSON object per line:
+#
+#   {"op": "tar", "path": <tar file>, "value": <tar_files entry>}
+#   {"op": "files", "value": {<file path>: <files entry>, ...}}
+#   {"op": "set", "key": <top-level key>, "value": <value>}
+#
+#  The log is read by loading the log file (the snapshot, in the format
+#  described above) and replaying the journal on top of it. Every change
+#  sets a complete value, so replaying a change twice is harmless. The
+#  journal is compacted into a new snapshot once it grows larger than the
+#  snapshot, and at the end of a --finish run so that the log file is
+#  complete when it is uploaded. Log files written by earlier versions are
+#  snapshots without a journal, and are read as is.
+#
+#  With --state-backend sqlite, the log is kept in an SQLite database
+#  (<log-file>.sqlite, see sqlite_log.py) instead, which is initialised from
+#  the JSON log (snapshot and journal) the first time it is opened. The JSON
+#  log file is still written at the end of a --finish run.
+#
+# Scan records:
+#
+#  The directory scan stats each entry exactly once and produces a FileEntry
+#  record (see below). Records are then passed on to split_into_tar_files,
+#  create_tar_file and the log, none of which touch the file metadata again.
+#  This matters on NFS-mounted run folders, where each stat is a round trip.
 
 # Testing:
 #
@@ -107,10 +198,6 @@ import logging
 # - Compress log to save space? Test on large runs and determine whether
 #   it's necessary. It may be better not to, in order to prevent
 #   corruption.
-#
-# - Another idea to avoid possible log corruption: don't overwrite the
-#   existing log file; instead, write to a new file, then move it
-#   (i.e., rename it to have the same name as the existing log file).
 
 logger = logging.getLogger(__name__)
 handler = logging.StreamHandler(sys.stderr)
@@ -122,9 +209,46 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 logger.setLevel(logging.DEBUG)
 
-def parse_args():
-    """Parse the command-line arguments and canonicalize file path
-    arguments."""
+# The journal is not compacted before it reaches this size, see compact_log
+JOURNAL_MIN_COMPACT_SIZE = 4 * 2**20
+
+# Minimum interval (in seconds) between two records of the parts uploaded by
+# --native-upload or --stream-upload for a tar file
+PARTS_LOG_INTERVAL = 10
+
+# Files worth compressing with --compression: InterOp metrics, run
+# parameters, logs and other text files, cluster filters and locations
+COMPRESS_PATTERNS = [r"/InterOp/", r"\.xml$", r"\.txt$", r"\.log$", r"\.csv$", r"\.filter$", r"\.locs$"]
+
+TAR_SUFFIXES = {'zstd': '.zst', 'gzip': '.gz'}
+
+# Part size of the uploads made with Upload Agent (--chunk-size)
+UA_CHUNK_SIZE = 25 * 2**20
+
+class SyncError(Exception):
+    """Error of a sync session. The command line exits with its message,
+    or with exit_code if set."""
+    exit_code = None
+
+class RestartDue(SyncError):
+    """With --hourly-restart, another upload would run past the restart
+    time: the sync stops, and is picked up by the next invocation"""
+    exit_code = 9
+
+# Number of upload threads Upload Agent uses when not given -u
+UA_DEFAULT_UPLOAD_THREADS = 8
+
+# Serializes the changes made to the JSON log by the tar pipeline threads
+_log_lock = threading.RLock()
+
+# Metadata of a scanned file or directory, gathered by a single lstat.
+# size is the number of payload bytes it takes in a tar file, i.e. 0 for
+# anything but regular files.
+FileEntry = collections.namedtuple("FileEntry", ["path", "size", "mtime", "inode", "mode", "uid", "gid"])
+
+def parse_args(argv=None):
+    """Parse the command-line arguments (argv, or sys.argv if not given) and
+    canonicalize file path arguments."""
 
     parser = argparse.ArgumentParser(description='Script to "synchronize" a local directory into the platform. This does not' +
                                     '\n' + 'transfer files into the platform one-by-one, but rather uploads tar' +
@@ -184,12 +308,101 @@ def parse_args():
                         '\n' + '--min-tar-size. DEFAULT=75 MB' +
                         '\n' +
                         '\n')
+    parser.add_argument('--tar-packing', choices=['ffd', 'sequential'], default='sequential',
+                        help='How files are split into tar files of at most' +
+                        '\n' + '--max-tar-size: "ffd" packs the largest files first,' +
+                        '\n' + 'each into the fullest tar file it fits in, for fewer' +
+                        '\n' + 'and fuller tar files; "sequential" fills tar files' +
+                        '\n' + 'in directory order, starting a new one when the next' +
+                        '\n' + 'file does not fit. DEFAULT=sequential' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--tar-order', choices=['scan', 'locality'], default='scan',
+                        help='Order of the files within and across tar files:' +
+                        '\n' + '"scan" keeps the order of the directory scan;' +
+                        '\n' + '"locality" groups the files of an Illumina run by' +
+                        '\n' + 'lane, then cycle, then surface/tile (following' +
+                        '\n' + 'Data/Intensities/BaseCalls/L<lane>/C<cycle>.1), so' +
+                        '\n' + 'that downstream BCL conversion can fetch only the' +
+                        '\n' + 'tar files of the lanes and cycles it needs: tar files' +
+                        '\n' + 'are then packed sequentially, each holding a' +
+                        '\n' + 'contiguous range of cycles (--tar-packing is' +
+                        '\n' + 'ignored). DEFAULT=scan' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--compression', choices=['none', 'zstd', 'gzip'], default='none',
+                        help='Compress the tar files holding files that match' +
+                        '\n' + '--compress-patterns (e.g. InterOp, XML and log files)' +
+                        '\n' + 'into <prefix>_<n>.tar.zst or .tar.gz files. Other' +
+                        '\n' + 'files, such as BCL/CBCL files, are already compressed' +
+                        '\n' + 'and go into plain tar files. zstd requires the' +
+                        '\n' + 'zstandard Python package, and compresses on' +
+                        '\n' + '--compression-threads threads. Not supported with' +
+                        '\n' + '--stream-upload. DEFAULT=none' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--compress-patterns', type=str, nargs='+', metavar='<regex>',
+                        default=COMPRESS_PATTERNS,
+                        help='Patterns of the files worth compressing, matched like' +
+                        '\n' + '--include-patterns. DEFAULT=%s' % ' '.join(COMPRESS_PATTERNS) +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--compression-level', type=int, metavar='<int>',
+                        help='Compression level. DEFAULT=3 for zstd, 6 for gzip' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--compression-threads', type=int, default=-1, metavar='<int>',
+                        help='Number of zstd compression threads, -1 for one per' +
+                        '\n' + 'CPU. DEFAULT=-1' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--tar-index', action='store_true',
+                        help='Write an index of the members of each tar file (path,' +
+                        '\n' + 'byte offset of the data, size and mtime) next to the' +
+                        '\n' + 'log file, as <tar file>.index.json, and upload it' +
+                        '\n' + 'next to the tar file, so that single files can be' +
+                        '\n' + 'read back with ranged reads. With --finish, a' +
+                        '\n' + 'manifest mapping each synced file to its tar file is' +
+                        '\n' + 'written to <log-file>.manifest.json. Offsets in' +
+                        '\n' + 'compressed tar files are those of the uncompressed' +
+                        '\n' + 'tar. Not supported with --stream-upload.' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--checksums', action='store_true',
+                        help='Compute the MD5 of each archived file, of each tar' +
+                        '\n' + 'file and of each of its upload parts as the tar file' +
+                        '\n' + 'is written, record them in the log and as properties' +
+                        '\n' + 'of the uploaded file, and check the parts against the' +
+                        '\n' + 'MD5s reported by the platform once the upload is' +
+                        '\n' + 'closed. Not supported with --stream-upload.' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--fast-hash', choices=['blake2b', 'xxh3'],
+                        help='With --checksums, also compute this hash of each tar' +
+                        '\n' + 'file. xxh3 requires the xxhash Python package.' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--tar-holdback', type=int, default=0, metavar='<files>',
+                        help='With --tar-packing ffd, keep the files of the least' +
+                        '\n' + 'full tar file for the next sync, when it is less than' +
+                        '\n' + 'half full and holds at most <files> files, so that' +
+                        '\n' + 'they are packed with newer files. Files are never' +
+                        '\n' + 'held back with --finish. DEFAULT=0 (disabled)' +
+                        '\n' +
+                        '\n')
     parser.add_argument('--upload-threads', '-u', type=int, metavar='<int>',
                         help='Number of upload threads launched by Upload Agent' +
                         '\n' + '(Decrease to improve stability in low-bandwidth' +
                         '\n' + 'connections), DEFAULT=8' +
                         ']n' +
                         '\n')
+    parser.add_argument('--parallel-uploads', type=int, default=1, metavar='<int>',
+                        help='Number of tar files uploaded at the same time when' +
+                        '\n' + 'several are waiting for upload. The upload threads' +
+                        '\n' + '(--upload-threads) are divided among them, so that' +
+                        '\n' + 'the total stays the same. DEFAULT=1' +
+                        '\n' +
+                        '\n')
     parser.add_argument('--include-patterns', '-i', metavar='<regex>', nargs='*',
                         help='An optional list of regex patterns to search for.' +
                         '\n' + 'If 1 or more regex patterns are given, then' +
@@ -221,6 +434,31 @@ def parse_args():
                         '\n' +
                         '\n')
 
+    parser.add_argument('--pipeline-depth', type=int, default=0, metavar='<int>',
+                        help='Number of tar files created ahead of the one being' +
+                        '\n' + 'uploaded, so that tarring and uploading overlap.' +
+                        '\n' + '0 creates, uploads and removes each tar file in' +
+                        '\n' + 'turn. DEFAULT=0' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--max-staged-size', type=int, metavar='<MB>',
+                        help='With --pipeline-depth, the maximum total size of the' +
+                        '\n' + 'tar files waiting for upload in --tar-directory. A' +
+                        '\n' + 'tar file is only created ahead once enough space is' +
+                        '\n' + 'freed by uploads. DEFAULT=no limit' +
+                        '\n' +
+                        '\n')
+
+    parser.add_argument('--state-backend', choices=['json', 'sqlite'], default='json',
+                        help='Where to keep the sync state described in the log.' +
+                        '\n' + '"json" keeps it in memory and journals changes next to' +
+                        '\n' + 'the log file. "sqlite" keeps it in an indexed SQLite' +
+                        '\n' + 'database (<log-file>.sqlite), for runs with millions' +
+                        '\n' + 'of files. An existing JSON log is imported into the' +
+                        '\n' + 'database the first time. DEFAULT=json' +
+                        '\n' +
+                        '\n')
+
     # Mutually exclusive group that contains a group is not supported
     #upload_debug_group = parser.add_mutually_exclusive_group(required=False)
     parser.add_argument('--dxpy-upload', '-d', action='store_true',
@@ -230,6 +468,52 @@ def parse_args():
                         '\n' +
                         '\n')
 
+    parser.add_argument('--stream-upload', action='store_true',
+                        help='Generate each tar file in memory and upload it part' +
+                        '\n' + 'by part as it is generated, instead of writing it to' +
+                        '\n' + '--tar-directory and uploading it afterwards. Memory use' +
+                        '\n' + 'is bounded by the part size. An interrupted upload is' +
+                        '\n' + 'resumed from the last uploaded part.' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--native-upload', action='store_true',
+                        help='Upload tar files in-process, several parts at a time' +
+                        '\n' + '(--upload-threads) over pooled HTTP connections,' +
+                        '\n' + 'instead of running Upload Agent.' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--part-size', type=int, metavar='<MB>',
+                        help='Size of the parts uploaded by --stream-upload and' +
+                        '\n' + '--native-upload. It is raised as needed to fit a tar' +
+                        '\n' + 'file within the 10000 parts allowed by the platform.' +
+                        '\n' + 'DEFAULT=64 MB for --stream-upload, chosen from the' +
+                        '\n' + 'size of each tar file for --native-upload' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--bandwidth-limit', type=float, default=0, metavar='<MB/s>',
+                        help='Upload rate limit shared by all the uploads of the' +
+                        '\n' + 'host (all dx_sync_directory.py processes using the' +
+                        '\n' + 'same --bandwidth-state-file), outside of the' +
+                        '\n' + '--bandwidth-window windows. 0 for no limit. Upload' +
+                        '\n' + 'Agent uploads get a share of it through --throttle.' +
+                        '\n' + 'Not supported with --dxpy-upload. DEFAULT=0' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--bandwidth-window', action='append', default=[], metavar='<HH:MM-HH:MM=MB/s>',
+                        help='Upload rate limit during a window of the day (local' +
+                        '\n' + 'time, possibly spanning midnight), instead of' +
+                        '\n' + '--bandwidth-limit, e.g. 08:00-20:00=10. 0 for no' +
+                        '\n' + 'limit. Can be given several times.' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--bandwidth-state-file', metavar='<path>',
+                        help='File through which the uploads of the host share' +
+                        '\n' + 'the bandwidth limit, in a directory writable only' +
+                        '\n' + 'by the users sharing it. DEFAULT=%s in the' % bandwidth.STATE_FILE_NAME +
+                        '\n' + 'directory of --log-file' +
+                        '\n' +
+                        '\n')
+
     ua_group=parser.add_argument_group('ua group')
     ua_group.add_argument('--verbose', '-v', action='store_true',
                           help='This flag allows you to specify upload agent' +
@@ -267,24 +551,52 @@ def parse_args():
                            '\n' +
                            '\n')
 
+    parser.add_argument('--rta-readiness', action='store_true',
+                        help='Sync the files of the sequencing cycles RTA has' +
+                        '\n' + 'completed without waiting for --min-age. Cycle' +
+                        '\n' + 'completion is read from RunInfo.xml, the' +
+                        '\n' + 'RTARead<N>Complete.txt markers and' +
+                        '\n' + 'InterOp/ExtractionMetricsOut.bin of the run in' +
+                        '\n' + '<directory>. Other files are still synced according' +
+                        '\n' + 'to --min-age.' +
+                        '\n' +
+                        '\n')
+
+    parser.add_argument('--stable-scans', type=int, default=0, metavar='<N>',
+                        help='Sync files whose size and modified timestamp' +
+                        '\n' + 'were the same for <N> scans in a row, without' +
+                        '\n' + 'waiting for --min-age. Scans are remembered' +
+                        '\n' + 'within a run of the script, so this is meant for' +
+                        '\n' + 'long-lived syncs (see incremental_upload.py).' +
+                        '\n' + 'DEFAULT=0 (disabled)' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--quiet-period', type=int, default=0, metavar='<seconds>',
+                        help='Sync files whose size and modified timestamp' +
+                        '\n' + 'have not changed for <seconds> seconds across' +
+                        '\n' + 'scans, measured with the local clock, without' +
+                        '\n' + 'waiting for --min-age. DEFAULT=0 (disabled)' +
+                        '\n' +
+                        '\n')
+
     parser.add_argument('sync_dir', metavar='<directory>', help='Directory to sync.')
     parser.add_argument("-Z", "--hourly-restart", dest="hourly_restart", action='store_true',
             help="Only upload for 1 hour, then exit and restart.")
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     return args
 
 def check_inputs(args):
 
     # Check required inputs
     if not args.sync_dir:
-        sys.exit("kwarg `sync_dir` is required for dx_sync_directory.py")
+        raise SyncError("kwarg `sync_dir` is required for dx_sync_directory.py")
     if not args.tar_destination:
-        sys.exit("kwarg `tar_destination` is required for dx_sync_directory.py")
+        raise SyncError("kwarg `tar_destination` is required for dx_sync_directory.py")
     if not args.log_file:
-        sys.exit("kwarg `log_file` is required for dx_sync_directory.py")
+        raise SyncError("kwarg `log_file` is required for dx_sync_directory.py")
     if not args.prefix:
-        sys.exit("kwarg `prefix` is required for dx_sync_directory.py")
+        raise SyncError("kwarg `prefix` is required for dx_sync_directory.py")
 
     # Set defaults
     if not args.tar_directory:
@@ -293,10 +605,8 @@ def check_inputs(args):
         args.min_tar_size = 0
     if not args.max_tar_size:
         args.max_tar_size = 75
-    if not args.include_patterns:
-        args.include_patterns = []
-    if not args.exclude_patterns:
-        args.exclude_patterns = []
+    args.include_patterns = unique_patterns(args.include_patterns or [])
+    args.exclude_patterns = unique_patterns(args.exclude_patterns or [])
 
     # Canonicalize paths
     args.tar_directory = os.path.abspath(args.tar_directory)
@@ -306,51 +616,156 @@ def check_inputs(args):
     if args.finish:
         args.min_age = 0
         args.min_tar_size = 0
+        args.tar_holdback = 0
 
     # Convert min & max sizes to MB
     args.max_tar_size = args.max_tar_size * 2**20
     args.min_tar_size = args.min_tar_size * 2**20
+    if args.part_size:
+        args.part_size = args.part_size * 2**20
+    if args.max_staged_size:
+        args.max_staged_size = args.max_staged_size * 2**20
     if args.max_tar_size <= args.min_tar_size:
-        sys.exit("--max-tar-size must be greater than --min-tar-size")
+        raise SyncError("--max-tar-size must be greater than --min-tar-size")
+    if args.native_upload and args.dxpy_upload:
+        raise SyncError("--native-upload and --dxpy-upload cannot be used together")
+    if args.parallel_uploads < 1:
+        raise SyncError("--parallel-uploads must be at least 1")
+    if args.pipeline_depth < 0:
+        raise SyncError("--pipeline-depth must not be negative")
+    if args.compression == 'zstd' and zstandard is None:
+        raise SyncError("--compression zstd requires the zstandard Python package")
+    if args.checksums and args.stream_upload:
+        raise SyncError("--checksums is not supported with --stream-upload")
+    if args.fast_hash == 'xxh3' and xxhash is None:
+        raise SyncError("--fast-hash xxh3 requires the xxhash Python package")
+    if args.tar_index and args.stream_upload:
+        raise SyncError("--tar-index is not supported with --stream-upload")
+    if args.compression != 'none' and args.stream_upload:
+        raise SyncError("--compression is not supported with --stream-upload")
+    if args.tar_holdback < 0:
+        raise SyncError("--tar-holdback must not be negative")
+    if args.stable_scans < 0 or args.quiet_period < 0:
+        raise SyncError("--stable-scans and --quiet-period must not be negative")
+    if args.tar_order == 'locality' and args.tar_packing == 'ffd':
+        logger.warning("--tar-packing ffd is ignored with --tar-order locality, tar files are packed sequentially")
+    if args.bandwidth_limit < 0:
+        raise SyncError("--bandwidth-limit must not be negative")
+    try:
+        schedule = bandwidth.Schedule.parse(args.bandwidth_limit, args.bandwidth_window)
+    except ValueError as e:
+        raise SyncError(str(e))
+    if schedule.is_limited() and args.dxpy_upload:
+        raise SyncError("--bandwidth-limit and --bandwidth-window are not supported with --dxpy-upload")
 
     return args
 
 def read_log(args):
-    """Reads the log file."""
+    """Reads the log file, and replays the journal of changes made since it
+    was written. With the SQLite backend, opens the log database instead."""
+
+    if getattr(args, 'state_backend', 'json') == 'sqlite':
+        logger.info('Opening log database ...')
+        return sqlite_log.open_log(sqlite_path(args.log_file), lambda: read_json_log(args))
+    return read_json_log(args)
+
+def read_json_log(args):
+    """Reads the JSON log file and journal"""
 
     logger.info('Reading log file ...')
 
     if os.path.exists(args.log_file):
         with open(args.log_file, 'r') as logf:
-            return json.load(logf)
+            log = json.load(logf)
     else:
         logger.info('Log file not found, returning empty log.')
-        return {'tar_files': {}, 'next_tar_index': 0, 'files': {},
-                'tar_destination': args.tar_destination, 'file_prefix': args.prefix,
-                'sync_dir': args.sync_dir, 'include_patterns': args.include_patterns,
-                'exclude_patterns': args.exclude_patterns}
+        log = {'tar_files': {}, 'next_tar_index': 0, 'files': {},
+               'tar_destination': args.tar_destination, 'file_prefix': args.prefix,
+               'sync_dir': args.sync_dir, 'include_patterns': args.include_patterns,
+               'exclude_patterns': args.exclude_patterns}
+
+    replay_journal(log, journal_path(args.log_file))
+    return log
+
+def journal_path(log_file):
+    return log_file + ".journal"
+
+def sqlite_path(log_file):
+    return log_file + ".sqlite"
+
+def replay_journal(log, journal_file):
+    """Apply the changes recorded in the journal to the log"""
+
+    if not os.path.exists(journal_file):
+        return
+
+    count = 0
+    with open(journal_file, 'rb') as journalf:
+        lines = journalf.readlines()
+    good_size = 0
+    for i, line in enumerate(lines):
+        try:
+            if not line.endswith(b"\n"):
+                raise ValueError("Incomplete line")
+            change = json.loads(line)
+        except ValueError:
+            if i == len(lines) - 1:
+                # Interrupted while appending the last change, which is therefore lost.
+                # Cut it off so that the next change is appended on a line of its own.
+                logger.warning('Ignoring incomplete last entry of journal %s' % journal_file)
+                os.truncate(journal_file, good_size)
+                break
+            raise SyncError('ERROR: Invalid journal %s, line %d is not valid JSON' % (journal_file, i + 1))
+        apply_log_change(log, change)
+        good_size += len(line)
+        count += 1
+    logger.info('Replayed %d changes from journal %s' % (count, journal_file))
+
+def apply_log_change(log, change):
+    """Apply a single journal change (see 'Log journal' above) to the log"""
+
+    if change['op'] == 'tar':
+        log['tar_files'][change['path']] = change['value']
+    elif change['op'] == 'files':
+        log['files'].update(change['value'])
+    elif change['op'] == 'set':
+        log[change['key']] = change['value']
+    else:
+        raise SyncError('ERROR: Unknown journal operation %s' % change['op'])
+
+def tar_change(tar_file, tar_state):
+    """Journal change recording the current state of a tar file"""
+    return {'op': 'tar', 'path': tar_file, 'value': tar_state}
+
+def tars_with_status(log, status):
+    """List (path, state) of the tar files in the given status, in the order
+    they were created"""
+    if isinstance(log, sqlite_log.SqliteLog):
+        return log.tars_with_status(status)
+    with _log_lock:
+        return [(path, state) for path, state in log['tar_files'].items() if state['status'] == status]
 
 def check_log(log, args):
     logger.info('Checking that log matches inputs')
     try:
         log_sync_dir = log['sync_dir']
         if log_sync_dir != args.sync_dir:
-            sys.exit('ERROR: Sync dir specified in input %s does not match sync dir in log %s' %
+            raise SyncError('ERROR: Sync dir specified in input %s does not match sync dir in log %s' %
                      (args.sync_dir, log_sync_dir))
 
         log_tar_destination = log['tar_destination']
         if log_tar_destination != args.tar_destination:
-            sys.exit('ERROR: DNAnexus tar destination specified in input %s does not match log %s' %
+            raise SyncError('ERROR: DNAnexus tar destination specified in input %s does not match log %s' %
                      (args.tar_destination, log_tar_destination))
 
         log_include = log['include_patterns']
         if not set(log_include) == set(args.include_patterns):
-            sys.exit('ERROR: patterns to include (%s) do not match log %s' %
+            raise SyncError('ERROR: patterns to include (%s) do not match log %s' %
                     (args.include_patterns, log_include))
 
         log_exclude = log['exclude_patterns']
         if not set(log_exclude) == set(args.exclude_patterns):
-            sys.exit('ERROR: patterns to exclude (%s) do not match log %s' %
+            raise SyncError('ERROR: patterns to exclude (%s) do not match log %s' %
                      (args.exclude_patterns, log_exclude))
 
         # Check that log has correct keys
@@ -358,71 +773,390 @@ def check_log(log, args):
             logger.info('All required keys present in log')
 
     except KeyError as e:
-        sys.exit('ERROR: Invalid log file. Log does not have "%s" key' % (e))
+        raise SyncError('ERROR: Invalid log file. Log does not have "%s" key' % (e))
 
     return
 
-def get_files_to_upload(log, args):
+def get_files_to_upload(log, args, watcher=None, stability=None):
     """Traverses the directory to be synced, and identifies which
     files should be synced. Exclude files which match patterns to exclude.
-    If include_patterns is specified, include only files which match."""
+    If include_patterns is specified, include only files which match.
+    Returns a list of FileEntry records.
 
-    logger.info("Getting files to upload in directory %s" % args.sync_dir)
+    If an InotifyWatcher (see dir_watcher.py) is given, only the paths
+    reported as changed since the previous call are examined, except when
+    the watcher asks for a periodic full walk. If a StabilityTracker (see
+    run_readiness.py) is given, files are also synced once it finds them
+    stable across calls."""
 
-    cur_time = int(time.time())
-    to_upload = []
+    matcher = get_path_matcher(args)
+    entries = scan_entries(args.sync_dir, matcher, watcher)
+    to_upload, not_ready = select_files_to_upload(entries, log, args, stability)
 
-    for root, dirs, files in os.walk(args.sync_dir):
-        for name in dirs + files:
-            full_path = os.path.join(root, name)
-            cur_mtime = os.path.getmtime(full_path)
+    if watcher is not None:
+        # Paths which are not old enough yet are looked at again in the next cycle
+        watcher.requeue(not_ready)
 
-            # Python empty list is false
-            if args.exclude_patterns and full_path_matches_pattern(full_path, args.exclude_patterns):
-                continue
-            if args.include_patterns and not full_path_matches_pattern(full_path, args.include_patterns):
-                continue
+    return to_upload
 
-            if cur_time - cur_mtime > args.min_age:
-                if (full_path not in log['files']) or (cur_mtime > log['files'][full_path]['mtime']):
-                    to_upload.append(full_path)
+def scan_entries(top, matcher, watcher=None):
+    """FileEntry records of the paths under top matched by matcher: all of
+    them, or only those the watcher reported as changed, if given and not
+    due for a full walk"""
+
+    if watcher is not None and not watcher.needs_full_scan():
+        dirty = watcher.take_dirty()
+        logger.info("Getting files to upload among %d changed paths in %s" % (len(dirty), top))
+        return stat_entries(sorted(dirty), matcher)
+
+    logger.info("Getting files to upload in directory %s" % top)
+    if watcher is not None:
+        watcher.mark_full_scan()
+    return scan_directory(top, matcher)
+
+def stat_entries(paths, matcher):
+    """Yield a FileEntry for each of the paths matched by matcher"""
+    for full_path in paths:
+        if not matcher.matches(full_path):
+            continue
+        try:
+            yield entry_from_stat(full_path, os.lstat(full_path))
+        except OSError:
+            # Removed since it was reported
+            continue
+
+def select_files_to_upload(entries, log, args, stability=None):
+    """Split the scanned entries which are not synced yet into those ready
+    to be synced (see is_ready), and the paths of the others. The entries
+    are recorded as an observation by the stability tracker, if given."""
 
-    return to_upload
+    cur_time = int(time.time())
+    readiness = get_readiness(args)
+    to_upload = []
+    not_ready = []
+
+    with log_batch(log):
+        for entry in entries:
+            if needs_sync(entry, log):
+                if stability is not None:
+                    stability.observe(entry, cur_time)
+                if is_ready(entry, args, cur_time, readiness, stability):
+                    to_upload.append(entry)
+                    if stability is not None:
+                        stability.forget(entry.path)
+                else:
+                    not_ready.append(entry.path)
+
+    return to_upload, not_ready
+
+def get_readiness(args):
+    """RunReadiness of the directory synced, refreshed, with --rta-readiness"""
+    if not getattr(args, "rta_readiness", False):
+        return None
+    readiness = run_readiness.for_run(args.sync_dir)
+    readiness.refresh()
+    return readiness
+
+def is_ready(entry, args, cur_time, readiness=None, stability=None):
+    """Whether a file is complete enough to be synced: old enough
+    (--min-age), known to be complete by the readiness tracker, or stable
+    according to the stability tracker"""
+    if cur_time - entry.mtime > args.min_age:
+        return True
+    if readiness is not None and readiness.is_ready(entry.path):
+        return True
+    return stability is not None and stability.is_stable(entry, cur_time)
+
+def get_stability(args):
+    """StabilityTracker of a session, with --stable-scans or --quiet-period"""
+    if not (getattr(args, "stable_scans", 0) or getattr(args, "quiet_period", 0)):
+        return None
+    return run_readiness.StabilityTracker(args.stable_scans, args.quiet_period)
+
+def get_limiter(args):
+    """HostLimiter shared by the uploads of the host, with --bandwidth-limit
+    or --bandwidth-window"""
+    schedule = bandwidth.Schedule.parse(getattr(args, "bandwidth_limit", 0),
+                                        getattr(args, "bandwidth_window", ()))
+    if not schedule.is_limited():
+        return None
+    state_file = getattr(args, "bandwidth_state_file", None)
+    if not state_file:
+        state_file = os.path.join(os.path.dirname(os.path.abspath(args.log_file)), bandwidth.STATE_FILE_NAME)
+    return bandwidth.limiter(schedule, state_file)
+
+def entry_from_stat(path, st):
+    """Build a FileEntry from a stat result"""
+    size = st.st_size if stat.S_ISREG(st.st_mode) else 0
+    return FileEntry(path, size, st.st_mtime, st.st_ino, st.st_mode, st.st_uid, st.st_gid)
+
+def scan_directory(top, matcher=None):
+    """Yield a FileEntry for every file and directory below top (top
+    excluded), in the same order as os.walk would list them. Each entry is
+    stat'ed once; symbolic links are not followed.
+
+    If a PathMatcher is given, only matching entries are stat'ed and
+    yielded, and directories it prunes are not descended into at all."""
+
+    stack = [top]
+    while stack:
+        root = stack.pop()
+        dirs = []
+        subdirs = []
+        files = []
+        try:
+            with os.scandir(root) as it:
+                for dir_entry in it:
+                    try:
+                        # Uses the directory entry type, does not stat
+                        is_dir = dir_entry.is_dir(follow_symlinks=False)
+                        if matcher is not None:
+                            if is_dir and matcher.prunes(dir_entry.path):
+                                continue
+                            if not matcher.matches(dir_entry.path):
+                                if is_dir:
+                                    subdirs.append(dir_entry.path)
+                                continue
+                        st = dir_entry.stat(follow_symlinks=False)
+                    except OSError:
+                        # Removed while scanning
+                        continue
+                    entry = entry_from_stat(dir_entry.path, st)
+                    if is_dir:
+                        dirs.append(entry)
+                        subdirs.append(entry.path)
+                    else:
+                        files.append(entry)
+        except OSError as e:
+            logger.warning("Could not scan directory %s: %s" % (root, e))
+            continue
+
+        yield from dirs
+        yield from files
+        stack.extend(reversed(subdirs))
+
+def needs_sync(entry, log):
+    """Whether the file has never been synced, or was modified since"""
+    synced = log['files'].get(entry.path)
+    return synced is None or entry.mtime > synced['mtime']
 
 def full_path_matches_pattern(full_path, patterns_list):
-    for pattern in patterns_list:
-        if re.search(pattern, full_path):
-            return True
-    return False
+    return _compile_any(tuple(unique_patterns(patterns_list))).search(full_path) is not None
+
+def unique_patterns(patterns):
+    """Drop duplicated patterns, keeping the order of first occurrence"""
+    return list(dict.fromkeys(patterns))
+
+# Constructs that make a match depend on what follows it. A pattern free of
+# them that matches a directory path also matches every path below it.
+_ANCHORED_AT_END = re.compile(r"\$|\\Z|\(\?=|\(\?!")
+
+class _AnyOf:
+    """Fallback for pattern lists that cannot be combined into one regex"""
+
+    def __init__(self, patterns):
+        self.regexes = [re.compile(pattern) for pattern in patterns]
+
+    def search(self, path):
+        for regex in self.regexes:
+            match = regex.search(path)
+            if match:
+                return match
+        return None
+
+class _MatchNothing:
+    def search(self, path):
+        return None
+
+@functools.lru_cache(maxsize=None)
+def _compile_any(patterns):
+    """Compile a tuple of patterns into a single regex matching any of them"""
+    if not patterns:
+        return _MatchNothing()
+    compiled = [re.compile(pattern) for pattern in patterns]
+    # Group numbers are shifted in the combined regex, so backreferences would break
+    if any(regex.groups and re.search(r"\\[1-9]", regex.pattern) for regex in compiled):
+        return _AnyOf(patterns)
+    try:
+        return re.compile("|".join("(?:%s)" % pattern for pattern in patterns))
+    except re.error:
+        # e.g. inline global flags or group names used by several patterns
+        return _AnyOf(patterns)
+
+class PathMatcher:
+    """Precompiled include/exclude patterns, matched with re.search against
+    full paths. Exclude patterns take precedence over include patterns; an
+    empty include list includes everything."""
+
+    def __init__(self, include_patterns, exclude_patterns):
+        self.include_patterns = unique_patterns(include_patterns)
+        self.exclude_patterns = unique_patterns(exclude_patterns)
+        prunable = tuple(p for p in self.exclude_patterns if not _ANCHORED_AT_END.search(p))
+        other = tuple(p for p in self.exclude_patterns if p not in prunable)
+        self._include = _compile_any(tuple(self.include_patterns)) if self.include_patterns else None
+        self._exclude_prunable = _compile_any(prunable)
+        self._exclude_other = _compile_any(other)
+
+    def matches(self, full_path):
+        """Whether the path should be synced"""
+        if self._exclude_prunable.search(full_path) or self._exclude_other.search(full_path):
+            return False
+        return self._include is None or self._include.search(full_path) is not None
+
+    def prunes(self, dir_path):
+        """Whether the directory and everything below it are excluded, so the
+        scan does not need to descend into it"""
+        return self._exclude_prunable.search(dir_path) is not None
+
+class AnyPathMatcher:
+    """Union of several PathMatchers: matches the paths matched by any of
+    them, and prunes the directories pruned by all of them"""
+
+    def __init__(self, matchers):
+        self.matchers = matchers
+
+    def matches(self, full_path):
+        return any(matcher.matches(full_path) for matcher in self.matchers)
+
+    def prunes(self, dir_path):
+        return all(matcher.prunes(dir_path) for matcher in self.matchers)
+
+@functools.lru_cache(maxsize=None)
+def _path_matcher(include_patterns, exclude_patterns):
+    return PathMatcher(include_patterns, exclude_patterns)
+
+def get_path_matcher(args):
+    """Return the (cached) PathMatcher for the patterns given in args"""
+    return _path_matcher(tuple(args.include_patterns), tuple(args.exclude_patterns))
 
 def split_into_tar_files(files_to_upload, log, args):
-    """Split list so tar files uploaded are not greater than max_tar_size"""
+    """Split list so tar files uploaded are not greater than max_tar_size.
+    Files of the least full tar file may be held back (--tar-holdback), in
+    which case they are in none of the tar files returned."""
 
     logger.info("Splitting into tar files to upload ...")
 
+    packing = getattr(args, "tar_packing", "sequential")
+    if getattr(args, "tar_order", "scan") == "locality":
+        files_to_upload = sorted(files_to_upload, key=lambda entry: locality_key(entry.path))
+        # Packing by size would spread the cycles across all the tar files
+        packing = "sequential"
+    compression = getattr(args, "compression", "none")
+    if compression != "none":
+        # Compressible files go into tar files of their own
+        matcher = _path_matcher(tuple(args.compress_patterns), ())
+        groups = [([entry for entry in files_to_upload if not matcher.matches(entry.path)], None),
+                  ([entry for entry in files_to_upload if matcher.matches(entry.path)], compression)]
+    else:
+        groups = [(files_to_upload, None)]
     tars_to_upload = []
-    current_tar = {"size": 0, "files": []}
-    total_size = 0
-    for f in files_to_upload:
-        fsize = os.path.getsize(f)
-        if current_tar["size"] + fsize > args.max_tar_size:
-            tars_to_upload.append(current_tar)
-            current_tar = {"size": 0, "files": []}
-        current_tar["files"].append(f)
-        current_tar["size"] += fsize
-        total_size += fsize
-    tars_to_upload.append(current_tar)
+    for entries, tar_compression in groups:
+        if not entries and len(groups) > 1:
+            continue
+        if packing == "ffd":
+            tars = pack_tar_files(entries, args.max_tar_size)
+        else:
+            tars = sequential_tar_files(entries, args.max_tar_size)
+        for tar in tars:
+            tar["compression"] = tar_compression
+        tars_to_upload.extend(tars)
+    total_size = sum(tar["size"] for tar in tars_to_upload)
 
     if total_size < args.min_tar_size:
         logger.warning('QUITTING: Size of files to upload is not big ' +
                 'enough to to be uploaded yet. Please run again later or ' +
-                'specify --min-tar-size to be smaller. Details of Tars to Upload %s' % tars_to_upload)
+                'specify --min-tar-size to be smaller. Details of Tars to Upload %s' %
+                [{"size": tar["size"], "files": [entry.path for entry in tar["files"]]} for tar in tars_to_upload])
         return []
 
-    logger.info(f"Splitted into {len(tars_to_upload)} tar files with total size {total_size/1024/1024/1024:.2f} GB")
+    holdback = getattr(args, "tar_holdback", 0)
+    if holdback and len(tars_to_upload) > 1:
+        least_full = min(tars_to_upload, key=lambda tar: tar["size"])
+        if len(least_full["files"]) <= holdback and least_full["size"] * 2 < args.max_tar_size:
+            logger.info("Holding back %d files (%d bytes) for the next sync" %
+                        (len(least_full["files"]), least_full["size"]))
+            tars_to_upload.remove(least_full)
+            total_size -= least_full["size"]
+
+    logger.info(f"Splitted into {len(tars_to_upload)} tar files with total size {total_size/1024/1024/1024:.2f} GB, " +
+                f"{packing_efficiency(tars_to_upload, args.max_tar_size):.0%} full")
 
     return tars_to_upload
 
+# Illumina run layout: Data/Intensities/BaseCalls/L001/C12.1/s_1_1101.bcl.gz,
+# L001/C12.1/L001_1.cbcl (NovaSeq), L001/0012.bcl.bgzf (NextSeq), L001/s_1_1101.filter
+_LANE_DIR = re.compile(r"(?:^|/)L(\d{3})(?:/|$)")
+_CYCLE_DIR = re.compile(r"(?:^|/)C(\d+)\.\d+(?:/|$)")
+_CYCLE_FILE = re.compile(r"^(\d{4})\.bcl")
+_TILE_FILE = re.compile(r"^s_\d+_(\d+)\.")
+_SURFACE_FILE = re.compile(r"^L\d{3}_(\d+)\.cbcl")
+
+def locality_key(path):
+    """Sort key grouping the files of an Illumina run by lane, then cycle,
+    then surface/tile. Files outside lane directories come first, in path
+    order, and directories come before the files they contain."""
+
+    lane = _LANE_DIR.search(path)
+    if lane is None:
+        return (0, 0, 0, path)
+    name = os.path.basename(path)
+    cycle = _CYCLE_DIR.search(path) or _CYCLE_FILE.match(name)
+    # Tile numbers start with the surface and swath
+    tile = _TILE_FILE.match(name) or _SURFACE_FILE.match(name)
+    return (int(lane.group(1)), int(cycle.group(1)) if cycle else 0,
+            int(tile.group(1)) if tile else -1, path)
+
+def sequential_tar_files(entries, max_size):
+    """Fill tar files in the order of the entries, starting a new one when
+    the next file does not fit"""
+    tars = []
+    current_tar = {"size": 0, "files": []}
+    for entry in entries:
+        if current_tar["size"] + entry.size > max_size:
+            tars.append(current_tar)
+            current_tar = {"size": 0, "files": []}
+        current_tar["files"].append(entry)
+        current_tar["size"] += entry.size
+    tars.append(current_tar)
+    return tars
+
+def pack_tar_files(entries, max_size):
+    """Pack entries into tar files of at most max_size bytes, largest first,
+    each into the fullest tar file it fits in (best-fit decreasing). A file
+    larger than max_size gets a tar file of its own. Tar files, and the files
+    within each of them, keep the order of the entries."""
+
+    entries = list(entries)
+    order = sorted(range(len(entries)), key=lambda i: -entries[i].size)
+    tars = []
+    # (room left, tar index) of the tar files, sorted by room left
+    room = []
+    for i in order:
+        size = entries[i].size
+        pos = bisect.bisect_left(room, (size, -1))
+        if pos < len(room):
+            left, index = room.pop(pos)
+        else:
+            left, index = max_size, len(tars)
+            tars.append({"size": 0, "files": []})
+        tars[index]["files"].append(i)
+        tars[index]["size"] += size
+        bisect.insort(room, (left - size, index))
+
+    for tar in tars:
+        tar["files"].sort()
+    tars.sort(key=lambda tar: tar["files"][0])
+    for tar in tars:
+        tar["files"] = [entries[i] for i in tar["files"]]
+    return tars or [{"size": 0, "files": []}]
+
+def packing_efficiency(tars, max_size):
+    """Fraction of the capacity of the tar files filled, the capacity of a
+    tar file being max_size, or the size of a file larger than that"""
+    if not tars:
+        return 1.0
+    return sum(tar["size"] for tar in tars) / float(sum(max(tar["size"], max_size) for tar in tars))
+
 def create_tar_file(tar_object: dict = {"size": 0, "files": []}, log: dict = {}, args = None) -> dict:
     """Create a tar file containing the given files to be uploaded."""
 
@@ -430,146 +1164,1132 @@ def create_tar_file(tar_object: dict = {"size": 0, "files": []}, log: dict = {},
         logger.info("No files to upload, skipping tar file creation ...")
         return log
 
-    tar_filename = "%s_%03d.tar" % (log['file_prefix'], log['next_tar_index'])
-    tar_full_path = os.path.join(args.tar_directory, tar_filename)
+    compression = tar_object.get("compression")
+    tar_full_path = tar_file_path(log, args, compression)
 
     logger.info("Creating tar file %s ..." % tar_full_path)
 
     tar_start = time.time()
-    tar_file = tarfile.open(tar_full_path, 'w')
-
     log_updates = {}
-    for f_abs in tar_object["files"]:
-        f_rel = os.path.relpath(f_abs, args.sync_dir)
-        tar_file.add(f_abs, arcname=f_rel, recursive=False)
-        log_updates[f_abs] = {'mtime': os.path.getmtime(f_abs)}
-        logger.debug(" "*4 + f"Added File to tar: {f_abs}")
+    index = []
+    checksums = None
+    if getattr(args, 'checksums', False):
+        checksums = Checksums(checksum_part_size(args, estimate_tar_size(tar_object["files"])), args.fast_hash)
+    with open_tar_file(tar_full_path, compression, args, checksums) as tar_file:
+        for entry in tar_object["files"]:
+            f_rel = os.path.relpath(entry.path, args.sync_dir)
+            complete = add_entry_to_tar(tar_file, entry, f_rel, checksums=checksums)
+            if complete is None:
+                continue
+            index.append(index_entry(tar_file))
+            # A file which shrank since it was scanned is padded in the tar, and recorded
+            # with an mtime of 0 so that it is picked up again by the next sync
+            log_updates[entry.path] = {'mtime': entry.mtime if complete else 0, 'size': entry.size}
+            if checksums is not None and entry.path in checksums.members:
+                log_updates[entry.path]['md5'] = checksums.members[entry.path]
+                index[-1].append(checksums.members[entry.path])
+            logger.debug(" "*4 + f"Added File to tar: {entry.path}")
     logger.info("Completed Tar File Creation")
 
-    tar_file.close()
     tar_end = time.time()
 
-    log['tar_files'][tar_full_path] = {'status': 'tarred',
-                                       'size': tar_object["size"],
-                                       'timestamps': {'tar_start': tar_start,
-                                                      'tar_end': tar_end}
-                                      }
-    log['next_tar_index'] += 1
-    for filename in log_updates:
-        log['files'][filename] = log_updates[filename]
-    return update_log(log, args)
+    tar_state = {'status': 'tarred',
+                 'size': tar_object["size"],
+                 'fill': round(tar_object["size"] / float(args.max_tar_size), 4),
+                 'timestamps': {'tar_start': tar_start,
+                                'tar_end': tar_end}
+                }
+    if compression:
+        tar_state['compression'] = compression
+        tar_state['compressed_size'] = os.path.getsize(tar_full_path)
+        logger.info("Compressed %d bytes into %d bytes with %s" %
+                    (tar_object["size"], tar_state['compressed_size'], compression))
+    if checksums is not None:
+        tar_state.update(checksums.tar_state())
+    if getattr(args, 'tar_index', False):
+        tar_state['index'] = write_tar_index(tar_full_path, index, compression, args)
+    return update_log(log, args, [tar_change(tar_full_path, tar_state),
+                                  {'op': 'set', 'key': 'next_tar_index', 'value': log['next_tar_index'] + 1},
+                                  {'op': 'files', 'value': log_updates}])
+
+def tar_index_path(tar_file, args):
+    """Local path of the member index of a tar file, kept next to the log"""
+    return os.path.join(os.path.dirname(args.log_file), os.path.basename(tar_file) + ".index.json")
+
+def index_entry(tar_file):
+    """[name, offset of the data, size, mtime] of the member last added to a
+    tar file open for writing, offsets being those of the uncompressed tar"""
+    member = tar_file.members[-1]
+    # The data, padded to a whole block, ends at the current offset
+    padded_size = -(-member.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+    return [member.name, tar_file.offset - padded_size, member.size, int(member.mtime)]
+
+def write_tar_index(tar_file, index, compression, args):
+    """Write the index of the members of a tar file (see index_entry), and
+    return its path"""
+    index_path = tar_index_path(tar_file, args)
+    index = {'tar': os.path.basename(tar_file),
+             'compression': compression,
+             'members': index}
+    with open(index_path, 'w') as fh:
+        json.dump(index, fh, separators=(',', ':'))
+    return index_path
+
+def write_manifest(log, args):
+    """Write the manifest of the synced files to <log-file>.manifest.json:
+    the file IDs of each uploaded tar file and of its index, and the tar
+    file each archived file went into. Returns the path of the manifest."""
+    manifest = {'tars': {}, 'files': {}}
+    for tar_file, tar_state in log['tar_files'].items():
+        if tar_state['status'] not in ('uploaded', 'removed') or 'index' not in tar_state:
+            continue
+        tar_name = os.path.basename(tar_file)
+        manifest['tars'][tar_name] = {'file_id': tar_state['file_id'],
+                                      'index_file_id': tar_state.get('index_file_id')}
+        with open(tar_state['index']) as fh:
+            for member in json.load(fh)['members']:
+                manifest['files'][member[0]] = tar_name
+    manifest_path = args.log_file + ".manifest.json"
+    with open(manifest_path, 'w') as fh:
+        json.dump(manifest, fh, separators=(',', ':'))
+    return manifest_path
+
+def tar_file_path(log, args, compression=None):
+    """Local path of the next tar file to be created"""
+    tar_filename = "%s_%03d.tar" % (log['file_prefix'], log['next_tar_index'])
+    if compression:
+        tar_filename += TAR_SUFFIXES[compression]
+    return os.path.join(args.tar_directory, tar_filename)
+
+@contextlib.contextmanager
+def open_tar_file(path, compression=None, args=None, checksums=None):
+    """Tar file open for writing, compressed with gzip or zstd if given. The
+    bytes written to disk go through checksums (see Checksums), if given."""
+    with open(path, 'wb') as fh:
+        out = fh if checksums is None else checksums.writer(fh)
+        if compression == 'gzip':
+            level = args.compression_level if args.compression_level is not None else 6
+            with tarfile.open(fileobj=out, mode='w:gz', compresslevel=level) as tar_file:
+                yield tar_file
+        elif compression == 'zstd':
+            level = args.compression_level if args.compression_level is not None else 3
+            compressor = zstandard.ZstdCompressor(level=level, threads=args.compression_threads)
+            with compressor.stream_writer(out, closefd=False) as writer:
+                with tarfile.open(fileobj=writer, mode='w|') as tar_file:
+                    yield tar_file
+        else:
+            with tarfile.open(fileobj=out, mode='w') as tar_file:
+                yield tar_file
+
+class Checksums:
+    """Checksums computed as a tar file is written, so that it is not read
+    again: the MD5 of each archived file (through add_entry_to_tar), and the
+    MD5, optional fast hash and MD5 of each upload part of the bytes written
+    (through writer()). Parts are part_size bytes, the part size the tar
+    file is then uploaded with, so that they can be compared with the parts
+    reported by the platform."""
+
+    def __init__(self, part_size, fast_hash=None):
+        self.part_size = part_size
+        self.members = {}
+        self.md5 = hashlib.md5()
+        self.fast_hash_name = fast_hash
+        self.fast_hash = None
+        if fast_hash == 'blake2b':
+            self.fast_hash = hashlib.blake2b()
+        elif fast_hash == 'xxh3':
+            self.fast_hash = xxhash.xxh3_64()
+        self.part_md5s = []
+        self.part = hashlib.md5()
+        self.part_left = part_size
+        self.size = 0
+
+    def writer(self, fileobj):
+        return _ChecksumWriter(fileobj, self)
+
+    def update(self, data):
+        self.size += len(data)
+        self.md5.update(data)
+        if self.fast_hash is not None:
+            self.fast_hash.update(data)
+        view = memoryview(data)
+        while len(view):
+            chunk = view[:self.part_left]
+            self.part.update(chunk)
+            self.part_left -= len(chunk)
+            view = view[len(chunk):]
+            if self.part_left == 0:
+                self.part_md5s.append(self.part.hexdigest())
+                self.part = hashlib.md5()
+                self.part_left = self.part_size
+
+    def tar_state(self):
+        """Checksum fields of the tar state (see the log structure above)"""
+        part_md5s = list(self.part_md5s)
+        if self.part_left < self.part_size or not part_md5s:
+            part_md5s.append(self.part.hexdigest())
+        state = {'md5': self.md5.hexdigest(), 'checksum_part_size': self.part_size, 'part_md5s': part_md5s}
+        if self.fast_hash is not None:
+            state[self.fast_hash_name] = self.fast_hash.hexdigest()
+        return state
+
+class _ChecksumWriter:
+    """Write-only file object passing the bytes written on to fileobj and to
+    Checksums.update"""
+
+    def __init__(self, fileobj, checksums):
+        self.fileobj = fileobj
+        self.checksums = checksums
+
+    def write(self, data):
+        self.checksums.update(data)
+        return self.fileobj.write(data)
+
+    def tell(self):
+        return self.checksums.size
+
+    def flush(self):
+        self.fileobj.flush()
+
+def checksum_part_size(args, tar_size):
+    """Part size the tar file will be uploaded with, for a tar file of at
+    most tar_size bytes"""
+    if getattr(args, 'native_upload', False):
+        if args.part_size:
+            return upload_engine.choose_part_size(tar_size, args.part_size)
+        return upload_engine.adaptive_part_size(tar_size, upload_threads_per_tar(args) or UA_DEFAULT_UPLOAD_THREADS)
+    if args.dxpy_upload:
+        return upload_engine.choose_part_size(tar_size, upload_engine.DEFAULT_PART_SIZE)
+    return UA_CHUNK_SIZE
+
+_uname_cache = {}
+_gname_cache = {}
+
+def _uname(uid):
+    if uid not in _uname_cache:
+        try:
+            _uname_cache[uid] = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            _uname_cache[uid] = ""
+    return _uname_cache[uid]
+
+def _gname(gid):
+    if gid not in _gname_cache:
+        try:
+            _gname_cache[gid] = grp.getgrgid(gid).gr_name
+        except KeyError:
+            _gname_cache[gid] = ""
+    return _gname_cache[gid]
+
+def tarinfo_from_entry(entry, arcname, keep_layout=False):
+    """Build the tar header of a scanned entry without stat'ing it again
+    (which tarfile.add / gettarinfo would do). Returns None for file types
+    that are not archived (sockets, devices, ...)."""
+
+    tarinfo = tarfile.TarInfo(arcname)
+    tarinfo.mode = stat.S_IMODE(entry.mode)
+    tarinfo.uid = entry.uid
+    tarinfo.gid = entry.gid
+    tarinfo.uname = _uname(entry.uid)
+    tarinfo.gname = _gname(entry.gid)
+    tarinfo.mtime = entry.mtime
+    if stat.S_ISREG(entry.mode):
+        tarinfo.type = tarfile.REGTYPE
+        tarinfo.size = entry.size
+    elif stat.S_ISDIR(entry.mode):
+        tarinfo.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(entry.mode):
+        tarinfo.type = tarfile.SYMTYPE
+        try:
+            tarinfo.linkname = os.readlink(entry.path)
+        except OSError:
+            if not keep_layout:
+                raise
+            logger.warning("Could not read link %s, archiving it with an empty target" % entry.path)
+    else:
+        return None
+    return tarinfo
+
+class _PaddedReader:
+    """Reads exactly `size` bytes from a file, padding with zeros if the file
+    turns out to be shorter than when it was scanned."""
+
+    def __init__(self, fileobj, size, md5=None):
+        self.fileobj = fileobj
+        self.remaining = size
+        self.short = False
+        self.md5 = md5
+
+    def read(self, n=-1):
+        if n < 0 or n > self.remaining:
+            n = self.remaining
+        data = self.fileobj.read(n)
+        if len(data) < n:
+            self.short = True
+            data += b"\0" * (n - len(data))
+        self.remaining -= n
+        if self.md5 is not None:
+            self.md5.update(data)
+        return data
+
+def add_entry_to_tar(tar_file, entry, arcname, keep_layout=False, checksums=None):
+    """Add a scanned entry to an open tar file, using the metadata recorded
+    by the scan. Returns True if the member was archived as scanned, False
+    if its content was cut short (the file shrank in the meantime), and None
+    if it was skipped.
+
+    With keep_layout, the member is never skipped, and a file that cannot be
+    read is archived as zeros, so that the tar stream only depends on the
+    scanned metadata (see stream_tar_file). With checksums (see Checksums),
+    the MD5 of the archived content of a file is recorded in its members."""
+
+    try:
+        tarinfo = tarinfo_from_entry(entry, arcname, keep_layout)
+    except OSError as e:
+        logger.warning("Skipping %s: %s" % (entry.path, e))
+        return None
+    if tarinfo is None:
+        logger.warning("Skipping %s: unsupported file type" % entry.path)
+        return None
+    if tarinfo.type != tarfile.REGTYPE:
+        tar_file.addfile(tarinfo)
+        return True
+
+    try:
+        fh = open(entry.path, 'rb')
+    except OSError as e:
+        if not keep_layout:
+            logger.warning("Skipping %s: %s" % (entry.path, e))
+            return None
+        logger.warning("Could not read %s, archiving zeros instead: %s" % (entry.path, e))
+        fh = io.BytesIO()
+    with fh:
+        reader = _PaddedReader(fh, entry.size, hashlib.md5() if checksums is not None else None)
+        tar_file.addfile(tarinfo, reader)
+    if checksums is not None:
+        checksums.members[entry.path] = reader.md5.hexdigest()
+    if reader.short:
+        logger.warning("%s shrank while being archived, it will be synced again" % entry.path)
+    return not reader.short
+
+def estimate_tar_size(entries):
+    """Upper bound of the size of a tar file holding the given entries"""
+    size = tarfile.RECORDSIZE
+    for entry in entries:
+        # Header, and a PAX header for long names / fractional mtimes
+        size += 3 * tarfile.BLOCKSIZE + 2 * len(os.fsencode(entry.path))
+        size += -(-entry.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+    return size
+
+def get_tar_destination(args):
+    """(project, folder) to upload the tar files to"""
+    project, folder, _ = dxpy.utils.resolver.resolve_path(args.tar_destination, expected='folder')
+    return project, folder
+
+def stream_tar_file(tar_object, log, args, api=None):
+    """Upload a tar file of the given files as it is generated, without
+    writing it to disk. The parts uploaded are recorded in the log as they
+    complete, so that resume_streamed_tars can finish an interrupted upload."""
+
+    if len(tar_object["files"]) == 0:
+        logger.info("No files to upload, skipping tar file creation ...")
+        return log
+
+    api = api or upload_engine.DXFileAPI(limiter=get_limiter(args))
+    tar_full_path = tar_file_path(log, args)
+    tar_filename = os.path.basename(tar_full_path)
+    project, folder = get_tar_destination(args)
+
+    part_size = upload_engine.choose_part_size(estimate_tar_size(tar_object["files"]),
+                                               args.part_size or upload_engine.DEFAULT_PART_SIZE)
+    file_id = api.new_file(project, folder, tar_filename)
+    logger.info("Streaming tar file %s to %s:%s (%s) in parts of %s ..." %
+                (tar_filename, project, folder, file_id, humanfriendly.format_size(part_size, binary=True)))
+
+    tar_state = {'status': 'streaming',
+                 'streamed': True,
+                 'size': tar_object["size"],
+                 'fill': round(tar_object["size"] / float(args.max_tar_size), 4),
+                 'file_id': file_id,
+                 'part_size': part_size,
+                 'parts': [],
+                 'members': [list(entry) for entry in tar_object["files"]],
+                 'timestamps': {'tar_start': time.time()}
+                }
+    # Files are recorded as synced right away, as the tar file is bound to be
+    # completed from its recorded members
+    log_updates = {entry.path: {'mtime': entry.mtime, 'size': entry.size} for entry in tar_object["files"]}
+    log = update_log(log, args, [tar_change(tar_full_path, tar_state),
+                                 {'op': 'set', 'key': 'next_tar_index', 'value': log['next_tar_index'] + 1},
+                                 {'op': 'files', 'value': log_updates}])
+    return _stream_tar(tar_full_path, tar_state, log, args, api)
+
+def resume_streamed_tars(log, args, api=None):
+    """Finish uploading tar files whose streaming was interrupted"""
+
+    streaming = tars_with_status(log, 'streaming')
+    if not streaming:
+        return log
+
+    api = api or upload_engine.DXFileAPI(limiter=get_limiter(args))
+    for tar_file, tar_state in streaming:
+        logger.info("Resuming upload of %s (%s), %d parts already uploaded" %
+                    (tar_file, tar_state['file_id'], len(tar_state['parts'])))
+        log = _stream_tar(tar_file, tar_state, log, args, api, resume=True)
+    return log
+
+def _stream_tar(tar_file, tar_state, log, args, api, resume=False):
+    entries = [FileEntry._make(member) for member in tar_state['members']]
+    file_updates = {}
+    if resume:
+        # Files modified since the interrupted attempt are archived as they were
+        # scanned then (size and header), but will be synced again
+        for entry in entries:
+            try:
+                st = os.lstat(entry.path)
+                changed = st.st_mtime != entry.mtime or (stat.S_ISREG(st.st_mode) and st.st_size != entry.size)
+            except OSError:
+                changed = True
+            if changed:
+                file_updates[entry.path] = {'mtime': 0, 'size': entry.size}
+        # The parts are only recorded every few seconds: the platform knows
+        # best which parts it got
+        remote_state, remote_parts = upload_engine.remote_parts(api, tar_state['file_id'])
+        if remote_state == 'open':
+            tar_state['parts'] = sorted(set(tar_state['parts']) | remote_parts)
+
+    last_recorded = [time.time()]
+
+    def on_part(index):
+        tar_state['parts'].append(index)
+        # Recorded every few seconds rather than for each part, as the state
+        # is journaled whole, members included
+        if time.time() - last_recorded[0] >= PARTS_LOG_INTERVAL:
+            last_recorded[0] = time.time()
+            update_log(log, args, [tar_change(tar_file, tar_state)])
+
+    if not resume:
+        tar_state['timestamps']['upload_start'] = time.time()
+    writer = upload_engine.MultipartWriter(api, tar_state['file_id'], tar_state['part_size'],
+                                           skip_parts=tar_state['parts'], on_part=on_part)
+    limiter = getattr(api, 'limiter', None)
+    with limiter.register() if limiter is not None else contextlib.nullcontext():
+        stream = tarfile.open(fileobj=writer, mode='w|')
+        for entry in entries:
+            f_rel = os.path.relpath(entry.path, args.sync_dir)
+            if not add_entry_to_tar(stream, entry, f_rel, keep_layout=True):
+                file_updates[entry.path] = {'mtime': 0, 'size': entry.size}
+        stream.close()
+        writer.close()
+    tar_state['timestamps']['tar_end'] = time.time()
+
+    api.close(tar_state['file_id'])
+    tar_state['status'] = 'removed'
+    tar_state['timestamps']['upload_end'] = time.time()
+    # Nothing to keep for a resume anymore
+    del tar_state['members']
+    logger.info("Complete Tar File Upload\n---From\n(%s)\nTo\n(%s)\n---" % (tar_file, tar_state['file_id']))
+
+    changes = [tar_change(tar_file, tar_state)]
+    if file_updates:
+        changes.append({'op': 'files', 'value': file_updates})
+    return update_log(log, args, changes)
 
 def upload_tar_files(log, args):
     """Uploads any tar files that haven't yet been uploaded"""
 
     logger.info("Uploading tar files ...")
 
-    tar_destination_project, tar_destination_folder, _ = dxpy.utils.resolver.resolve_path(args.tar_destination, expected='folder')
-
-    upload_count = 0
-    for tar_file in log['tar_files']:
-        if log['tar_files'][tar_file]['status'] == 'tarred':
-            logger.info("Uploading Tar File %s to %s:%s..." % (tar_file, tar_destination_project, tar_destination_folder))
-            upload_count += 1
-            upload_start = time.time()
-            if args.dxpy_upload:
-                dx_file = dxpy.upload_local_file(tar_file, project=tar_destination_project, folder=tar_destination_folder)
-                dx_file_id = dx_file.get_id()
-            else:
-                opts=''
-                if args.upload_threads:
-                    opts += '-u %d ' %args.upload_threads
-                if args.verbose:
-                    opts += '--verbose '
-
-                if args.ua_progress:
-                    opts += '--progress '
-
-                ua_command = "ua --project %s --folder %s --do-not-compress --wait-on-close %s %s --auth-token %s --chunk-size 25M" % (tar_destination_project, tar_destination_folder, opts, tar_file, args.auth_token)
-                logger.info(f"UA Command -> {ua_command}")
-                try:
-                    ua_process = subprocess.run(ua_command, shell=True, check=True, stdout=subprocess.PIPE, universal_newlines=True)
-                    dx_file_id = ua_process.stdout.strip()
-                except subprocess.CalledProcessError:
-                    sys.exit("ERROR: Tar file %s was not uploaded. Please check log for progress and rerun script" % tar_file)
-            upload_end = time.time()
-
-            logger.info("Complete Tar File Upload\n---From\n(%s)\nTo\n(%s:%s)\n---" % (tar_file, tar_destination_project, tar_destination_folder))
-
-            log['tar_files'][tar_file]['status'] = 'uploaded'
-            log['tar_files'][tar_file]['file_id'] = dx_file_id
-            log['tar_files'][tar_file]['timestamps']['upload_start'] = upload_start
-            log['tar_files'][tar_file]['timestamps']['upload_end'] = upload_end
-            log = update_log(log, args)
-    if upload_count == 0:
+    tars_to_upload = tars_with_status(log, 'tarred')
+    parallel_uploads = min(getattr(args, 'parallel_uploads', 1), len(tars_to_upload))
+    if parallel_uploads > 1:
+        logger.info("Uploading %d tar files, %d at a time" % (len(tars_to_upload), parallel_uploads))
+        # Each upload records its status in the log as soon as it completes
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallel_uploads,
+                                                   thread_name_prefix="upload") as executor:
+            futures = [executor.submit(upload_tar_file, tar_file, tar_state, log, args)
+                       for tar_file, tar_state in tars_to_upload]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+            except BaseException:
+                # Let the uploads in progress finish, but do not start new ones
+                for future in futures:
+                    future.cancel()
+                raise
+    else:
+        for tar_file, tar_state in tars_to_upload:
+            log = upload_tar_file(tar_file, tar_state, log, args)
+    if len(tars_to_upload) == 0:
         logger.info("(!) No files uploaded...")
 
     return log
 
+def upload_tar_file_native(tar_file, tar_state, log, args, api=None):
+    """Upload a tar file with the native upload engine, and return its file
+    ID. The file ID, part size and uploaded parts are recorded in the tar
+    state as the upload goes (the status stays "tarred"), so that an upload
+    interrupted by a failure or a restart only sends the missing parts."""
+
+    api = api or upload_engine.DXFileAPI(limiter=get_limiter(args))
+    project, folder = get_tar_destination(args)
+    # Work on a copy, the log may be serialized by another thread meanwhile
+    state = dict(tar_state)
+
+    skip_parts = ()
+    if state.get('file_id'):
+        try:
+            remote_state, skip_parts = upload_engine.remote_parts(api, state['file_id'])
+        except dxpy.exceptions.ResourceNotFound:
+            logger.warning("%s is gone, uploading %s again" % (state['file_id'], tar_file))
+            state = {key: value for key, value in state.items() if key not in ('file_id', 'part_size', 'parts')}
+        else:
+            if remote_state != 'open':
+                logger.info("%s was already uploaded to %s" % (tar_file, state['file_id']))
+                api.wait_on_close(state['file_id'])
+                return state['file_id']
+            # The platform knows best which parts it got
+            logger.info("Resuming upload of %s to %s, %d parts already uploaded" %
+                        (tar_file, state['file_id'], len(skip_parts)))
+
+    last_recorded = [time.time()]
+    started = [time.time(), len(state.get('parts', ()))]
+
+    def record_parts(force=False):
+        # Part numbers are recorded every few seconds rather than for each part:
+        # the state is journaled whole, and the platform's list of parts is the
+        # reference when resuming anyway
+        if force or time.time() - last_recorded[0] >= PARTS_LOG_INTERVAL:
+            last_recorded[0] = time.time()
+            # Live throughput of this attempt, from the parts uploaded so far
+            elapsed = last_recorded[0] - started[0]
+            if elapsed > 0:
+                state['throughput'] = int((len(state['parts']) - started[1]) * state['part_size'] / elapsed)
+            update_log(log, args, [tar_change(tar_file, dict(state, parts=sorted(state['parts'])))])
+
+    def on_start(file_id, part_size):
+        state.update(file_id=file_id, part_size=part_size, parts=[])
+        record_parts(force=True)
+
+    def on_part(index):
+        state['parts'].append(index)
+        record_parts()
+
+    if 'parts' in state:
+        state['parts'] = sorted(set(state['parts']) | skip_parts)
+    return upload_engine.upload_file(tar_file, project, folder, api=api,
+                                     threads=upload_threads_per_tar(args) or UA_DEFAULT_UPLOAD_THREADS,
+                                     part_size=state.get('part_size') or state.get('checksum_part_size') or args.part_size,
+                                     progress=functools.partial(log_upload_progress, tar_file),
+                                     file_id=state.get('file_id'), skip_parts=skip_parts,
+                                     on_start=on_start, on_part=on_part)
+
+def log_upload_progress(tar_file, done, total):
+    logger.debug("%s: %s of %s uploaded" % (tar_file, humanfriendly.format_size(done, binary=True),
+                                            humanfriendly.format_size(total, binary=True)))
+
+def upload_threads_per_tar(args):
+    """Number of Upload Agent threads for each tar file, dividing
+    --upload-threads among the --parallel-uploads uploads. None leaves it to
+    the Upload Agent default."""
+    parallel_uploads = getattr(args, 'parallel_uploads', 1)
+    if parallel_uploads <= 1:
+        return args.upload_threads
+    return max(1, (args.upload_threads or UA_DEFAULT_UPLOAD_THREADS) // parallel_uploads)
+
+def upload_tar_file(tar_file, tar_state, log, args):
+    """Uploads a single tar file, and records it as uploaded"""
+
+    tar_destination_project, tar_destination_folder = get_tar_destination(args)
+    if tar_state.get('index') and not tar_state.get('index_file_id'):
+        # Uploaded first, so that it is not uploaded again with the tar file on retries
+        logger.info("Uploading index %s ..." % tar_state['index'])
+        tar_state = dict(tar_state, index_file_id=upload_small_file(tar_state['index'], args))
+        log = update_log(log, args, [tar_change(tar_file, tar_state)])
+    logger.info("Uploading Tar File %s to %s:%s..." % (tar_file, tar_destination_project, tar_destination_folder))
+    limiter = get_limiter(args)
+    api = None
+    upload_start = time.time()
+    with limiter.register() if limiter is not None else contextlib.nullcontext():
+        if getattr(args, 'native_upload', False):
+            api = upload_engine.DXFileAPI(limiter=limiter)
+            try:
+                dx_file_id = upload_tar_file_native(tar_file, tar_state, log, args, api=api)
+            except upload_engine.UploadError as e:
+                logger.error(str(e))
+                raise SyncError("ERROR: Tar file %s was not uploaded. Please check log for progress and rerun script" % tar_file)
+        elif args.dxpy_upload:
+            # Parts of the size the checksums were computed for
+            kwargs = {'write_buffer_size': tar_state['checksum_part_size']} if 'checksum_part_size' in tar_state else {}
+            dx_file = dxpy.upload_local_file(tar_file, project=tar_destination_project, folder=tar_destination_folder,
+                                             **kwargs)
+            dx_file_id = dx_file.get_id()
+        else:
+            dx_file_id = ua_upload(tar_file, args, upload_threads_per_tar(args), limiter=limiter)
+    upload_end = time.time()
+
+    if 'part_md5s' in tar_state:
+        try:
+            verify_upload(dx_file_id, tar_file, tar_state)
+        except SyncError:
+            # Upload again from scratch on the next attempt
+            tar_state = {key: value for key, value in tar_state.items()
+                         if key not in ('file_id', 'part_size', 'parts')}
+            update_log(log, args, [tar_change(tar_file, tar_state)])
+            raise
+
+    logger.info("Complete Tar File Upload\n---From\n(%s)\nTo\n(%s:%s)\n---" % (tar_file, tar_destination_project, tar_destination_folder))
+
+    # Work on a copy, the log may be serialized by another thread meanwhile
+    tar_state = dict(tar_state, status='uploaded', file_id=dx_file_id,
+                     timestamps=dict(tar_state['timestamps'], upload_start=upload_start, upload_end=upload_end))
+    if upload_end > upload_start:
+        tar_state['throughput'] = int(os.path.getsize(tar_file) / (upload_end - upload_start))
+    if api is not None and api.throttled:
+        tar_state['throttled'] = round(api.throttled, 1)
+    for key in ('part_size', 'parts', 'part_md5s'):
+        tar_state.pop(key, None)
+    return update_log(log, args, [tar_change(tar_file, tar_state)])
+
+def verify_upload(file_id, tar_file, tar_state, api=None):
+    """Compare the MD5s of the parts of an uploaded tar file, as reported by
+    the platform, with those computed when the tar file was written, and
+    record the checksums of the tar file as properties of the file. Raises
+    SyncError if they differ."""
+
+    api = api or upload_engine.DXFileAPI()
+    desc = api.describe(file_id)
+    parts = desc.get('parts', {})
+    remote_md5s = [parts[index].get('md5') for index in sorted(parts, key=int)]
+    if remote_md5s != tar_state['part_md5s']:
+        logger.error("Parts of %s: expected MD5s %s, platform reports %s" %
+                     (file_id, tar_state['part_md5s'], remote_md5s))
+        raise SyncError("ERROR: Tar file %s was corrupted on upload to %s. Please rerun script" % (tar_file, file_id))
+    properties = {key: tar_state[key] for key in ('md5', 'blake2b', 'xxh3') if key in tar_state}
+    api.set_properties(file_id, desc['project'], properties)
+    logger.info("Checksums of %s verified against %s" % (tar_file, file_id))
+
+def ua_upload(path, args, upload_threads=None, limiter=None):
+    """Upload a file with Upload Agent, and return its file ID. With a
+    limiter, Upload Agent is throttled to its share of the bandwidth limit
+    when it starts."""
+    tar_destination_project, tar_destination_folder = get_tar_destination(args)
+    opts=''
+    if upload_threads:
+        opts += '-u %d ' %upload_threads
+    if limiter is not None:
+        throttle = limiter.fair_share()
+        if throttle:
+            opts += '--throttle %d ' % throttle
+    if args.verbose:
+        opts += '--verbose '
+
+    if args.ua_progress:
+        opts += '--progress '
+
+    ua_command = "ua --project %s --folder %s --do-not-compress --wait-on-close %s %s --auth-token %s --chunk-size %dM" % (tar_destination_project, tar_destination_folder, opts, path, args.auth_token, UA_CHUNK_SIZE // 2**20)
+    logger.info(f"UA Command -> {ua_command}")
+    try:
+        ua_process = subprocess.run(ua_command, shell=True, check=True, stdout=subprocess.PIPE, universal_newlines=True)
+        return ua_process.stdout.strip()
+    except subprocess.CalledProcessError:
+        raise SyncError("ERROR: Tar file %s was not uploaded. Please check log for progress and rerun script" % path)
+
+def upload_small_file(path, args):
+    """Upload a small file (e.g. a tar index) to the tar destination with
+    the uploader used for tar files, and return its file ID"""
+    project, folder = get_tar_destination(args)
+    limiter = get_limiter(args)
+    with limiter.register() if limiter is not None else contextlib.nullcontext():
+        if getattr(args, 'native_upload', False):
+            try:
+                api = upload_engine.DXFileAPI(limiter=limiter)
+                return upload_engine.upload_file(path, project, folder, api=api, threads=1)
+            except upload_engine.UploadError as e:
+                raise SyncError("ERROR: %s was not uploaded: %s" % (path, e))
+        elif args.dxpy_upload:
+            return dxpy.upload_local_file(path, project=project, folder=folder).get_id()
+        return ua_upload(path, args, 1, limiter=limiter)
+
 def remove_tar_files(log, args):
     """Removes tar files that have been uploaded from the local disk."""
 
     logger.info("Removing uploaded tar files...")
 
     remove_count = 0
-    for tar_file in log['tar_files']:
-        if log['tar_files'][tar_file]['status'] == 'uploaded':
-            logger.info("Removing %s..." % tar_file)
-
-            remove_count += 1
-            remove_start = time.time()
-            os.remove(tar_file)
-            remove_end = time.time()
-
-            log['tar_files'][tar_file]['status'] = 'removed'
-            log['tar_files'][tar_file]['timestamps']['remove_start'] = remove_start
-            log['tar_files'][tar_file]['timestamps']['remove_end'] = remove_end
-            log = update_log(log, args)
+    for tar_file, tar_state in tars_with_status(log, 'uploaded'):
+        remove_count += 1
+        log = remove_tar_file(tar_file, tar_state, log, args)
 
     if remove_count == 0:
         logger.info("\tNo files removed...")
 
     return log
 
-def print_all_file_ids(log):
-    """Outputs the file ID of each tar file that has been uploaded."""
+def remove_tar_file(tar_file, tar_state, log, args):
+    """Removes a single uploaded tar file, and records it as removed"""
+
+    logger.info("Removing %s..." % tar_file)
+    remove_start = time.time()
+    os.remove(tar_file)
+    remove_end = time.time()
+
+    tar_state = dict(tar_state, status='removed',
+                     timestamps=dict(tar_state['timestamps'], remove_start=remove_start, remove_end=remove_end))
+    return update_log(log, args, [tar_change(tar_file, tar_state)])
+
+class TarPipeline:
+    """Creates tar files in a background thread, up to `depth` tar files
+    ahead of the upload, while the calling thread uploads and removes them.
+
+    The producer creates the tar files in the planned order, and the consumer
+    uploads them in the order they were created, so the log goes through the
+    same status transitions ("tarred", "uploaded", "removed") as with the
+    serial loop; an interrupted pipeline leaves at most `depth` + 1 tar files
+    in the "tarred" state, which the next invocation uploads first. With
+    max_staged_size, a tar file is only created once the tar files waiting
+    on disk leave room for it (one tar file is always allowed, so that a tar
+    file larger than the cap still goes through)."""
+
+    def __init__(self, tars_to_upload, log, args):
+        self.tars_to_upload = tars_to_upload
+        self.log = log
+        self.args = args
+        self.depth = max(args.pipeline_depth, 1)
+        self.max_staged_size = getattr(args, 'max_staged_size', None)
+        self.cond = threading.Condition()
+        # Tar files left over by an earlier invocation go first
+        self.ready = collections.deque((path, state, os.path.getsize(path))
+                                       for path, state in tars_with_status(log, 'tarred'))
+        self.staged_size = sum(size for _, _, size in self.ready)
+        self.done = False
+        self.stopped = False
+        self.error = None
+
+    def _has_room(self, size):
+        if len(self.ready) >= self.depth:
+            return False
+        if self.max_staged_size and self.staged_size:
+            return self.staged_size + size <= self.max_staged_size
+        return True
+
+    def _produce(self):
+        try:
+            for tar in self.tars_to_upload:
+                with self.cond:
+                    while not self.stopped and not self._has_room(tar["size"]):
+                        self.cond.wait()
+                    if self.stopped:
+                        return
+                tar_file = tar_file_path(self.log, self.args, tar.get("compression"))
+                self.log = create_tar_file(tar_object=tar, log=self.log, args=self.args)
+                if tar_file not in self.log['tar_files']:
+                    continue
+                with self.cond:
+                    self.ready.append((tar_file, self.log['tar_files'][tar_file], os.path.getsize(tar_file)))
+                    self.staged_size += self.ready[-1][2]
+                    self.cond.notify_all()
+        except BaseException as e:
+            with self.cond:
+                self.error = e
+        finally:
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+
+    def __iter__(self):
+        """Yields (path, state) of each tar file once it is created"""
+        producer = threading.Thread(target=self._produce, name="tar-producer", daemon=True)
+        producer.start()
+        try:
+            while True:
+                with self.cond:
+                    while not self.ready and not self.done:
+                        self.cond.wait()
+                    if self.ready:
+                        tar_file, tar_state, size = self.ready[0]
+                    elif self.error is not None:
+                        raise self.error
+                    else:
+                        return
+                yield tar_file, tar_state
+                # The tar file has been uploaded and removed by the caller
+                with self.cond:
+                    self.ready.popleft()
+                    self.staged_size -= size
+                    self.cond.notify_all()
+        finally:
+            self.stop()
+            producer.join()
+
+    def stop(self):
+        """Do not create any more tar files"""
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+def run_tar_pipeline(tars_to_upload, log, args):
+    """Create, upload and remove the given tar files through a TarPipeline"""
+
+    # Uploaded tar files left over by an earlier invocation
+    log = remove_tar_files(log, args)
+
+    pipeline = TarPipeline(tars_to_upload, log, args)
+    initial_time = time.time()
+    time_is_up = False
+    with contextlib.closing(iter(pipeline)) as tars:
+        for i, (tar_file, tar_state) in enumerate(tars, start=1):
+            logger.info(f"Start Upload Iteration {i}")
+            start_time = time.time()
+            logger.info(f"Total Time elapsed {humanfriendly.format_timespan(start_time - initial_time)}")
+            log = upload_tar_file(tar_file, tar_state, log, args)
+            log = remove_tar_file(tar_file, log['tar_files'][tar_file], log, args)
+            end_time = time.time()
+            duration = end_time - start_time
+            logger.info(f"(Upload Iteration {i}) It took {humanfriendly.format_timespan(duration)} secs to upload")
+            if hourly_restart_due(end_time, duration, args):
+                time_is_up = True
+                break
+    # Closing the iterator waits for the tar file being created, if any
+
+    if time_is_up:
+        logger.warning("It took too long to upload tar file(s) and time is up")
+        logger.info("Stop uploading and Let the subsequent invocations pick up the other tar files")
+        raise RestartDue()
+    return log
+
+def hourly_restart_due(end_time, duration, args):
+    """Whether another upload taking `duration` would cross the restart
+    threshold, with --hourly-restart"""
+    #
+    # Getting threshold limit from env if any
+    # The env is decided by the variable `sync_duration_threshold` from the playbook file
+    threshold = int(os.environ.get("SYNC_DURATION_THRESHOLD", 3600))
+    return args.hourly_restart and ((end_time + duration) // threshold > end_time // threshold)
+
+def uploaded_file_ids(log):
+    """File ID of each tar file that has been uploaded. Raises SyncError if
+    some tar files were not uploaded."""
 
     failed_uploads = 0
     file_ids = []
 
-    for tar_file in log['tar_files']:
-        if log['tar_files'][tar_file]['status'] == 'removed':
-            file_ids.append(log['tar_files'][tar_file]['file_id'])
-        elif log['tar_files'][tar_file]['status'] == 'uploaded':
+    for tar_file, tar_state in log['tar_files'].items():
+        if tar_state['status'] == 'removed':
+            file_ids.append(tar_state['file_id'])
+        elif tar_state['status'] == 'uploaded':
             logger.warning('%s was uploaded but not removed' % tar_file)
-            file_ids.append(log['tar_files'][tar_file]['file_id'])
+            file_ids.append(tar_state['file_id'])
         else:
             logger.error('%s was not uploaded' % tar_file)
             failed_uploads += 1
 
     assert failed_uploads >= 0
 
-    if failed_uploads == 0:
-        for file_id in file_ids:
-            print(file_id.strip())
-    elif failed_uploads == 1:
-        sys.exit('One file was not successfully uploaded.')
-    else:
-        sys.exit('%s files were not successfully uploaded.' % failed_uploads)
+    if failed_uploads == 1:
+        raise SyncError('One file was not successfully uploaded.')
+    elif failed_uploads > 1:
+        raise SyncError('%s files were not successfully uploaded.' % failed_uploads)
+    return [file_id.strip() for file_id in file_ids]
 
 def write_log(log, log_file):
-    """Writes the log to the log file."""
+    """Writes the log to the log file. The log is written to a temporary
+    file which is then renamed, so that an interruption cannot leave a
+    truncated log behind."""
 
     logger.info('Writing log file...')
 
-    with open(log_file, 'w') as logf:
+    tmp_log_file = log_file + ".tmp"
+    with open(tmp_log_file, 'w') as logf:
         json.dump(log, logf)
+        logf.flush()
+        os.fsync(logf.fileno())
+    os.replace(tmp_log_file, log_file)
 
-def update_log(log, args):
-    """Write current state of logs"""
+def compact_log(log, args):
+    """Write the full log as a new snapshot and discard the journal"""
 
+    if isinstance(log, sqlite_log.SqliteLog):
+        log = log.export()
     write_log(log, args.log_file)
-    return read_log(args)
+    journal_file = journal_path(args.log_file)
+    if os.path.exists(journal_file):
+        os.remove(journal_file)
+
+def update_log(log, args, changes):
+    """Apply the given changes to the log, and append them to the journal.
+    Only the changes are written, except when the journal is due for
+    compaction. With the SQLite backend, the changes are committed to the
+    database in a single transaction."""
+
+    if isinstance(log, sqlite_log.SqliteLog):
+        log.apply(changes)
+        return log
+
+    with _log_lock:
+        for change in changes:
+            apply_log_change(log, change)
+
+        if not os.path.exists(args.log_file):
+            compact_log(log, args)
+            return log
+
+        with open(journal_path(args.log_file), 'a') as journalf:
+            for change in changes:
+                journalf.write(json.dumps(change) + "\n")
+            journalf.flush()
+            os.fsync(journalf.fileno())
+            journal_size = journalf.tell()
+
+        # Compacting costs a full write of the log, keep it proportional to the
+        # amount of changes written since the last compaction
+        if journal_size > max(JOURNAL_MIN_COMPACT_SIZE, os.path.getsize(args.log_file)):
+            logger.info('Compacting log journal ...')
+            compact_log(log, args)
+
+    return log
+
+def log_batch(log):
+    """Context manager grouping the log accesses made within into a single
+    database transaction (no-op for the JSON log)"""
+    if isinstance(log, sqlite_log.SqliteLog):
+        return log.batch()
+    return contextlib.nullcontext()
+
+class SharedScan:
+    """One scan per cycle of a directory synced by several sessions with
+    different patterns (e.g. one per lane), instead of one scan per session.
+
+    The scan covers the union of the sessions' patterns, and its entries are
+    then sorted into one bucket per session, by matching them against the
+    patterns of each session; a file matched by several sessions (e.g. the
+    run configuration files) goes into each of their buckets. A scan happens
+    at the first sync of a session after new_cycle(), for all the sessions
+    registered then. The optional watcher is shared the same way."""
+
+    def __init__(self, top, watcher=None):
+        self.top = os.path.abspath(top)
+        self.watcher = watcher
+        self.sessions = []
+        self.buckets = None
+        self.lock = threading.Lock()
+
+    def register(self, session):
+        with self.lock:
+            self.sessions.append(session)
+
+    def unregister(self, session):
+        with self.lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+            if self.buckets is not None:
+                self.buckets.pop(session, None)
+
+    def new_cycle(self):
+        """Scan again at the next sync. The paths of the buckets of the
+        sessions which did not sync this cycle (e.g. lanes not due yet) are
+        put back into the watcher, so that they are not lost until the next
+        full walk."""
+        with self.lock:
+            if self.watcher is not None and self.buckets:
+                for bucket in self.buckets.values():
+                    self.watcher.requeue(entry.path for entry in bucket)
+            self.buckets = None
+
+    def _scan(self):
+        matchers = [get_path_matcher(session.args) for session in self.sessions]
+        self.buckets = {session: [] for session in self.sessions}
+        buckets = list(zip(matchers, self.buckets.values()))
+        for entry in scan_entries(self.top, AnyPathMatcher(matchers), self.watcher):
+            for matcher, bucket in buckets:
+                if matcher.matches(entry.path):
+                    bucket.append(entry)
+
+    def files_to_upload(self, session, log, args):
+        """Same as get_files_to_upload, for the given registered session"""
+        with self.lock:
+            if self.buckets is None or session not in self.buckets:
+                if self.buckets is not None:
+                    # Registered since the scan of this cycle (e.g. re-created
+                    # after a failure): walked on its own, in full since the
+                    # changes reported by the watcher went to the failed session
+                    self.buckets[session] = list(scan_entries(self.top, get_path_matcher(session.args)))
+                else:
+                    self._scan()
+            entries = self.buckets.pop(session)
+        to_upload, not_ready = select_files_to_upload(entries, log, args, getattr(session, "stability", None))
+        self.requeue(not_ready)
+        return to_upload
+
+    def requeue(self, paths):
+        """Have the watcher report the paths again in the next cycle"""
+        if self.watcher is not None:
+            with self.lock:
+                self.watcher.requeue(paths)
+
+    def probe(self):
+        """Data waiting to be synced by each registered session, as
+        {session: (bytes, mtime of the oldest file)}, counting the files ready
+        to be synced. This only stats the paths reported by the watcher, and
+        does not hand them out. Returns None when the watcher asks for a full
+        walk, which is left to the next sync rather than done at every probe."""
+
+        if self.watcher is None:
+            raise SyncError("Probing for new data requires a watcher")
+        with self.lock:
+            if self.watcher.needs_full_scan():
+                return None
+            sessions = list(self.sessions)
+            matchers = [get_path_matcher(session.args) for session in sessions]
+            self.watcher.poll()
+            entries = list(stat_entries(sorted(self.watcher.dirty), AnyPathMatcher(matchers)))
+
+        cur_time = int(time.time())
+        readiness = [get_readiness(session.args) for session in sessions]
+        pending = {session: (0, None) for session in sessions}
+        for entry in entries:
+            for session, matcher, ready in zip(sessions, matchers, readiness):
+                if (matcher.matches(entry.path)
+                        and is_ready(entry, session.args, cur_time, ready, getattr(session, "stability", None))
+                        and needs_sync(entry, session.log)):
+                    size, oldest = pending[session]
+                    pending[session] = (size + entry.size, entry.mtime if oldest is None else min(oldest, entry.mtime))
+        return pending
+
+class SyncSession:
+    """Long-lived synchronization of a directory into the platform.
+
+    A session keeps the log, the path matcher and, if given a watcher (see
+    dir_watcher.py), the record of changed paths in memory between calls to
+    sync(), instead of re-reading the log and re-walking the whole directory
+    on every invocation. Sessions syncing the same directory can share its
+    scan through a SharedScan. args are the parsed command-line arguments of
+    this script (see parse_args). Errors are raised as SyncError."""
+
+    def __init__(self, args, watcher=None, shared_scan=None):
+        self.args = check_inputs(args)
+        self.watcher = watcher
+        self.shared_scan = shared_scan
+        # Sizes and mtimes seen by the previous syncs, with --stable-scans or --quiet-period
+        self.stability = get_stability(self.args)
+        if self.args.native_upload or self.args.stream_upload or self.args.checksums:
+            # In-process uploads and checks authenticate with the given token
+            dxpy.set_security_context({"auth_token_type": "Bearer", "auth_token": self.args.auth_token})
+        self.log = None
+        self.reload()
+        if shared_scan is not None:
+            shared_scan.register(self)
+
+    def reload(self):
+        """(Re-)read the log from disk, e.g. after a failed sync left the
+        in-memory log ahead of what was written"""
+        self.close_log()
+        self.log = read_log(self.args)
+        check_log(self.log, self.args)
+        # Finish tar files whose streaming was interrupted
+        self.log = resume_streamed_tars(self.log, self.args)
+
+    def requeue(self, paths):
+        if self.shared_scan is not None:
+            self.shared_scan.requeue(paths)
+        elif self.watcher is not None:
+            self.watcher.requeue(paths)
+
+    def close_log(self):
+        if isinstance(self.log, sqlite_log.SqliteLog):
+            self.log.close()
+        self.log = None
+
+    def close(self):
+        self.close_log()
+        if self.shared_scan is not None:
+            self.shared_scan.unregister(self)
+        if self.watcher is not None:
+            self.watcher.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def sync(self, finish=False, flush=False):
+        """Tar and upload the files not synced yet, and return the file IDs
+        of all the tar files uploaded so far. With finish, files are synced
+        regardless of their age and of the minimum tar size, as with
+        --finish. With flush, files old enough are synced regardless of the
+        minimum tar size."""
+
+        args = self.args
+        if finish and not args.finish:
+            args = argparse.Namespace(**vars(args))
+            args.finish = True
+            args.min_age = 0
+            args.min_tar_size = 0
+            args.tar_holdback = 0
+        elif flush and (args.min_tar_size or args.tar_holdback):
+            args = argparse.Namespace(**vars(args))
+            args.min_tar_size = 0
+            args.tar_holdback = 0
+        log = self.log
+
+        if self.shared_scan is not None:
+            files_to_upload = self.shared_scan.files_to_upload(self, log, args)
+        else:
+            files_to_upload = get_files_to_upload(log, args, self.watcher, self.stability)
+        for entry in files_to_upload:
+            logger.debug("Files To Upload %s" % entry.path)
+
+        tars_to_upload = split_into_tar_files(files_to_upload, log, args)
+        packed = set(entry.path for tar in tars_to_upload for entry in tar["files"])
+        held_back = [entry.path for entry in files_to_upload if entry.path not in packed]
+        if held_back:
+            # Below --min-tar-size or held back, have the watcher report them again
+            self.requeue(held_back)
+
+        # Run through upload & remove in case last invocation was interrupted
+        if len(tars_to_upload) == 0:
+            log = upload_tar_files(log, args)
+            log = remove_tar_files(log, args)
+        elif args.pipeline_depth and not args.stream_upload:
+            log = run_tar_pipeline(tars_to_upload, log, args)
+            tars_to_upload = []
+
+        initial_time = time.time()
+        for i, tar in enumerate(tars_to_upload, start=1):
+            logger.info(f"Start Upload Iteration {i}")
+            start_time = time.time()
+            logger.info(f"Total Time elapsed {humanfriendly.format_timespan(start_time - initial_time)}")
+            # Log out previous un-uploaded tar files if any
+            previous_unuploaded_tars = tars_with_status(log, 'tarred')
+            if len(previous_unuploaded_tars) != 0:
+                logger.info("Previous Tar Files to be uploaded along with this iteration")
+                for tar_fp, tar_fp_value in previous_unuploaded_tars:
+                    logger.info(
+                        f"(size={tar_fp_value['size']})(tar_start={tar_fp_value['timestamps']['tar_start']})(tar_end={tar_fp_value['timestamps']['tar_end']}) {tar_fp}")
+                    logger.debug("-"*20)
+            if args.stream_upload:
+                log = stream_tar_file(tar_object=tar, log=log, args=args)
+            else:
+                log = create_tar_file(tar_object=tar, log=log, args=args)
+                log = upload_tar_files(log, args)
+                log = remove_tar_files(log, args)
+            end_time = time.time()
+            duration = end_time - start_time
+            logger.info(f"(Upload Iteration {i}) It took {humanfriendly.format_timespan(duration)} secs to upload")
+
+            if hourly_restart_due(end_time, duration, args):
+                logger.warning("It took too long to upload tar file(s) and time is up")
+                logger.info("Stop uploading and Let the subsequent invocations pick up the other tar files")
+                raise RestartDue()
+
+        if args.finish:
+            compact_log(log, args)
+            if args.tar_index:
+                write_manifest(log, args)
+
+        self.log = log
+        return uploaded_file_ids(log)
 
 def main():
     """Main function."""
@@ -577,53 +2297,14 @@ def main():
     args = parse_args()
     logger.debug(f"User Input\n---> {args}\n")
 
-    args = check_inputs(args)
-    log = read_log(args)
-    check_log(log, args)
-
-    files_to_upload = get_files_to_upload(log, args)
-    for fp in files_to_upload:
-        logger.debug("Files To Upload %s" % fp)
-
-    tars_to_upload = split_into_tar_files(files_to_upload, log, args)
-
-    # Run through upload & remove in case last invocation was interrupted
-    if len(tars_to_upload) == 0:
-        log = upload_tar_files(log, args)
-        log = remove_tar_files(log, args)
+    try:
+        with SyncSession(args) as session:
+            file_ids = session.sync()
+    except SyncError as e:
+        sys.exit(e.exit_code if e.exit_code is not None else str(e))
 
-    initial_time = time.time()
-    for i, tar in enumerate(tars_to_upload, start=1):
-        logger.info(f"Start Upload Iteration {i}")
-        start_time = time.time()
-        time_elapsed = start_time - initial_time
-        logger.info(f"Total Time elapsed {humanfriendly.format_timespan(start_time - initial_time)}")
-        # Log out previous un-uploaded tar files if any
-        previous_unuploaded_tar_objs = list(filter(lambda x: x["status"] == "tarred", [v for k, v in log['tar_files'].items()]))
-        if len(previous_unuploaded_tar_objs) != 0:
-            logger.info("Previous Tar Files to be uploaded along with this iteration")
-            for tar_fp, tar_fp_value in log['tar_files'].items():
-                if tar_fp_value['status'] == 'tarred':
-                    logger.info(
-                        f"(size={tar_fp_value['size']})(tar_start={tar_fp_value['timestamps']['tar_start']})(tar_end={tar_fp_value['timestamp']['tar_end']}) {tar_fp}")
-                logger.debug("-"*20)
-        log = create_tar_file(tar_object=tar, log=log, args=args)
-        log = upload_tar_files(log, args)
-        log = remove_tar_files(log, args)
-        end_time = time.time()
-        duration = end_time - start_time
-        logger.info(f"(Upload Iteration {i}) It took {humanfriendly.format_timespan(duration)} secs to upload")
-        #
-        # Getting threshold limit from env if any
-        # The env is decided by the variable `sync_duration_threshold` from the playbook file
-        threshold = int(os.environ.get("SYNC_DURATION_THRESHOLD", 3600))
-
-        if args.hourly_restart and ((end_time + duration) // threshold > end_time // threshold):
-            logger.warning("It took too long to upload tar file(s) and time is up")
-            logger.info("Stop uploading and Let the subsequent invocations pick up the other tar files")
-            sys.exit(9)
-
-    print_all_file_ids(log)
+    for file_id in file_ids:
+        print(file_id)
     logger.info("-"*10 + "END" + "-"*10)
 
 
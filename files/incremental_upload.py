@@ -3,6 +3,7 @@
 
 import sys
 import os
+import concurrent.futures
 import subprocess as sub
 import re
 import xml.etree.ElementTree as ET
@@ -13,6 +14,9 @@ import json
 import logging
 import traceback
 
+import dx_sync_directory
+import dir_watcher
+
 # Uploads an Illumina run directory (HiSeq 2500, HiSeq X, NextSeq, NovaSeq)
 # If for use with a MiSeq, users MUST change the config files to include and NOT specify the -l argument
 #
@@ -25,6 +29,10 @@ import traceback
 #
 # By "synchronize" we mean that each invocation of dx_sync_directory.py will create a TAR
 # archive of all files in the run directory modified since the last invocation.
+#
+# dx_sync_directory.py is not run as a separate process: each lane is synced by a
+# dx_sync_directory.SyncSession, created with the same command-line arguments and kept
+# for the whole upload, so that its log and scan state stay in memory between intervals.
 
 
 logger = logging.getLogger(__name__)
@@ -79,6 +87,75 @@ def parse_args():
     parser.add_argument("-i", "--sync-interval", metavar="<seconds>", type=int,
             default=1800, help="Interval at which the run directory will be " +
             "scanned, and new files will be tarred and uploaded")
+    parser.add_argument("--probe-interval", metavar="<seconds>", type=int,
+            default=0, help="If set, the run directory is probed for new data " +
+            "every <seconds> seconds instead of being synced every " +
+            "--sync-interval: a lane is synced as soon as its files old enough " +
+            "to be uploaded add up to --min-size, or once the oldest of them " +
+            "has waited --max-latency seconds. Requires --watch: probing only " +
+            "stats the files inotify reported as changed, while the hourly " +
+            "full walk of the run directory is done by a sync of every lane.")
+    parser.add_argument("--max-latency", metavar="<seconds>", type=int,
+            help="With --probe-interval, the longest a file old enough to be " +
+            "uploaded waits for --min-size to be reached, before its lane is " +
+            "synced regardless. (default: --sync-interval)")
+    parser.add_argument("--rta-readiness", action="store_true",
+            help="Upload the files of the sequencing cycles RTA has completed " +
+            "(according to RunInfo.xml, the RTARead<N>Complete.txt markers and " +
+            "InterOp/ExtractionMetricsOut.bin) without waiting for --min-age. " +
+            "Other files are still uploaded according to --min-age.")
+    parser.add_argument("--stable-scans", metavar="<N>", type=int, default=0,
+            help="Upload files whose size and modified time were the same " +
+            "for <N> scans in a row, without waiting for --min-age. With " +
+            "--probe-interval, this counts syncs rather than probes.")
+    parser.add_argument("--quiet-period", metavar="<seconds>", type=int, default=0,
+            help="Upload files whose size and modified time have not changed " +
+            "for <seconds> seconds across scans (measured with the local " +
+            "clock), without waiting for --min-age.")
+    parser.add_argument("--compression", choices=["none", "zstd", "gzip"], default="none",
+            help="Compress InterOp, XML, log and other compressible files into " +
+            "TAR archives of their own (.tar.zst or .tar.gz), while BCL files " +
+            "still go into plain TAR archives. zstd requires the zstandard " +
+            "Python package. (default %(default)s)")
+    parser.add_argument("--tar-order", choices=["scan", "locality"], default="scan",
+            help="Order of the files in the TAR archives: \"locality\" groups " +
+            "them by lane, then cycle, then surface/tile, so that downstream " +
+            "BCL conversion can fetch only the archives it needs (each archive " +
+            "then holds a contiguous range of cycles, whatever --tar-packing). " +
+            "(default %(default)s)")
+    parser.add_argument("--tar-index", action="store_true",
+            help="Upload an index of the members of each TAR archive (path, " +
+            "byte offset, size, mtime) next to it, and a manifest mapping each " +
+            "file of the run to its archive, linked from the details of the " +
+            "upload sentinel, so that single files can be read back with " +
+            "ranged reads.")
+    parser.add_argument("--bandwidth-limit", metavar="<MB/s>", type=float, default=0,
+            help="Upload rate limit shared by all the uploads of the host, " +
+            "outside of the --bandwidth-window windows. 0 for no limit. " +
+            "(default %(default)s)")
+    parser.add_argument("--bandwidth-window", metavar="<HH:MM-HH:MM=MB/s>", action="append", default=[],
+            help="Upload rate limit during a window of the day (local time), " +
+            "instead of --bandwidth-limit, e.g. 08:00-20:00=10. Can be given " +
+            "several times.")
+    parser.add_argument("--bandwidth-state-file", metavar="<path>",
+            help="File through which the uploads of the host share the " +
+            "bandwidth limit, in a directory writable only by the users " +
+            "sharing it. (default: in --log-dir)")
+    parser.add_argument("--checksums", action="store_true",
+            help="Compute the MD5 of each archived file and of each TAR " +
+            "archive as it is written, record them in the sync log and as " +
+            "properties of the archives, and check the uploaded archives " +
+            "against the MD5s reported by the platform.")
+    parser.add_argument("--tar-packing", choices=["sequential", "ffd"], default="sequential",
+            help="How files are split into TAR archives of at most --max-size: " +
+            "\"sequential\" fills them in scan order, \"ffd\" packs the largest " +
+            "files first into the fullest archive they fit in, for fewer and " +
+            "fuller archives. (default %(default)s)")
+    parser.add_argument("--tar-holdback", metavar="<files>", type=int, default=0,
+            help="With --tar-packing ffd, keep up to <files> files which would go into a tar file less " +
+            "than half full for the next sync, so that they are packed with " +
+            "newer files into fewer, fuller tar files. Nothing is held back " +
+            "once the run is complete.")
     parser.add_argument("-D", "--run-duration", metavar="<duration>", type=str,
             default="24h", help="Expected duration of the run, acceptable suffix:" +
             "s, m, h, d, w, M, y. (default %(default)s)")
@@ -114,12 +191,51 @@ def parse_args():
             help="If Novaseq is used, this parameter has to be used.")
     parser.add_argument("-Z", "--hourly-restart", dest="hourly_restart", action='store_true',
             help="Only upload for 1 hour, then exit and restart.")
+    parser.add_argument("--parallel-lanes", metavar="<int>", type=int, default=1,
+            help="Number of lanes synced at the same time. The upload threads " +
+            "(-u) are shared among them, so that the total stays the same. " +
+            "(default %(default)s)")
+    parser.add_argument("--parallel-uploads", metavar="<int>", type=int, default=1,
+            help="Number of TAR archives of a lane uploaded at the same time " +
+            "when several are waiting, e.g. for the final sync of a run. The " +
+            "upload threads of the lane are divided among them. " +
+            "(default %(default)s)")
+    parser.add_argument("--watch", action="store_true",
+            help="Watch the run directory for changes (inotify, Linux only) " +
+            "instead of walking it in full every interval. The run directory " +
+            "is still walked in full once an hour, for changes inotify does " +
+            "not report (e.g. made by another host on a network share).")
+    parser.add_argument("--stream-upload", action="store_true",
+            help="Generate each TAR archive in memory and upload it part by " +
+            "part as it is generated, instead of writing it to --temp-dir " +
+            "first. An interrupted upload is resumed from the last uploaded part.")
+    parser.add_argument("--pipeline-depth", metavar="<int>", type=int, default=0,
+            help="Number of TAR archives created ahead of the one being " +
+            "uploaded, so that tarring and uploading overlap. 0 creates, " +
+            "uploads and removes each archive in turn. (default %(default)s)")
+    parser.add_argument("--max-staged-size", metavar="<MB>", type=int,
+            help="With --pipeline-depth, the maximum total size of the TAR " +
+            "archives waiting for upload in --temp-dir. (default: no limit)")
+    parser.add_argument("--state-backend", choices=["json", "sqlite"], default="json",
+            help="Where dx_sync_directory.py keeps the sync state of each lane: " +
+            "a JSON log (default) or an indexed SQLite database, for runs with " +
+            "millions of files.")
 
     # Mutually exclusive inputs for groups are not supported
     parser.add_argument("--dxpy-upload", "-d", action="store_true",
             help="This flag allows you to specify to use dxpy instead of " +
             "upload agent")
     
+    parser.add_argument("--native-upload", action="store_true",
+            help="Upload TAR archives in-process, several parts at a time (-u) " +
+            "over pooled HTTP connections, instead of running Upload Agent. " +
+            "An upload interrupted by a failure or by the hourly restart (-Z) " +
+            "is resumed from the parts it is missing.")
+    parser.add_argument("--part-size", metavar="<MB>", type=int,
+            help="Size of the parts uploaded by --native-upload and " +
+            "--stream-upload. (default: chosen from the size of each TAR " +
+            "archive for --native-upload, 64 MB for --stream-upload)")
+
     ua_group = parser.add_argument_group('ua options')
     ua_group.add_argument("--verbose", "-v", action="store_true",
         help="This flag allows you to specify upload agent --verbose mode.")
@@ -151,6 +267,14 @@ def parse_args():
     # Ensure min < max
     if args.min_size > args.max_size:
         raise_error("--min-size input must be less than --max-size")
+    if args.parallel_lanes < 1:
+        raise_error("--parallel-lanes must be at least 1")
+    if args.parallel_uploads < 1:
+        raise_error("--parallel-uploads must be at least 1")
+    if args.probe_interval and not args.watch:
+        raise_error("--probe-interval requires --watch")
+    if args.max_latency is None:
+        args.max_latency = args.sync_interval
 
     return args
 
@@ -204,15 +328,8 @@ def check_input(args):
         except sub.CalledProcessError:
             raise_error("Upload agent executable 'ua' was not found in the $PATH")
 
-    try:
-        # We assume that dx_sync_directory is located in the same folder as this script
-        # This is resolved by absolute path of invocation
-        sub.check_call(['python3', '{curr_dir}/dx_sync_directory.py'.format(curr_dir=sys.path[0]), '-h'],
-                stdout=open(os.devnull, 'w'), close_fds=True)
-    except sub.CalledProcessError:
-        raise_error("dx_sync_directory.py not found. Please run incremental " +
-                "upload from the directory containing incremental_upload.py "+
-                "and dx_sync_directory.py")
+    if args.watch and not sys.platform.startswith("linux"):
+        raise_error("--watch is only supported on Linux")
 
 def get_run_id(run_dir):
     runinfo_xml = run_dir + "/RunInfo.xml"
@@ -234,25 +351,6 @@ def get_target_folder(base, lane):
     else:
         return base.rstrip("/") + "/" + lane
 
-def run_command_with_retry(my_num_retries, my_command):
-    for trys in range(my_num_retries):
-        logger.info("Running (Try %d of %d): %s" % (trys, my_num_retries, my_command))
-        try:
-            process = sub.run(my_command, check=True, stdout=sub.PIPE, universal_newlines=True, env=os.environ.copy())
-
-            output = process.stdout.strip()
-            logger.info(f"output of dx_sync_directory.py is {output}")
-            return output
-        except sub.CalledProcessError as e:
-            if e.returncode == 9: # error code of dx_sync_directory when one iteration took too long (span to the next hour) to upload
-                logger.info(msg="Triggering restarts")
-                sys.exit()
-            logger.error("Failed to run `%s`, retrying (Try %s)" % (" ".join(my_command), trys))
-
-        time.sleep(10)
-
-    raise_error("Number of retries exceed %d. Please check logs to troubleshoot issues." % my_num_retries)
-
 def raise_error(msg):
     logger.error(msg)
     sys.exit()
@@ -279,7 +377,8 @@ def upload_single_file(filepath, project, folder, properties):
         logger.error("Failed to upload local file %s to %s:%s" % (filepath, project, folder))
         return None
 
-def run_sync_dir(lane, args, finish=False):
+def sync_dir_argv(lane, args):
+    """Command-line arguments of dx_sync_directory.py to sync the given lane"""
     # Set list of config files to include (only if lanes are specified)
     CONFIG_FILES = ["RTAConfiguration.xml", "RunInfo.xml", "RunParameters.xml",
         "config.xml", "s.locs"]
@@ -288,21 +387,22 @@ def run_sync_dir(lane, args, finish=False):
     # Set lane specific patterns to include IF uploading by lane
     include_patterns = []
     if not lane_num == "all":
-        include_patterns = CONFIG_FILES
-        include_patterns.append("s_" + lane_num + "_")
-    # If upload_thumbnails is specified, upload thumbnails
-    if not args.exclude_patterns:
-        args.exclude_patterns = []
+        include_patterns = CONFIG_FILES + ["s_" + lane_num + "_"]
 
-    exclude_patterns = args.exclude_patterns
+    # Build a new list on every call, so that args.exclude_patterns does not
+    # grow with each sync interval
+    exclude_patterns = list(args.exclude_patterns or [])
 
+    # If upload_thumbnails is specified, upload thumbnails
     if not args.upload_thumbnails:
         exclude_patterns.append("Images")
 
     if args.samplesheet_delay:
         exclude_patterns.append("SampleSheet.csv")
 
-    invocation = ["python3", "{curr_dir}/dx_sync_directory.py".format(curr_dir=sys.path[0])]
+    exclude_patterns = list(dict.fromkeys(exclude_patterns))
+
+    invocation = []
     invocation.extend(["--log-file", lane["log_path"]])
     invocation.extend(["--tar-destination", args.project + ":" + lane["remote_folder"]])
     invocation.extend(["--tar-directory", args.temp_dir])
@@ -312,10 +412,13 @@ def run_sync_dir(lane, args, finish=False):
     invocation.extend(exclude_patterns)
     invocation.extend(["--min-tar-size", str(args.min_size)])
     invocation.extend(["--max-tar-size", str(args.max_size)])
-    invocation.extend(["--upload-threads", str(args.upload_threads)])
+    invocation.extend(["--upload-threads", str(lane_upload_threads(args))])
+    if args.parallel_uploads != 1:
+        invocation.extend(["--parallel-uploads", str(args.parallel_uploads)])
     invocation.extend(["--prefix", lane["prefix"]])
     if args.hourly_restart:
         invocation.extend(["-Z"])
+    invocation.extend(["--state-backend", args.state_backend])
     invocation.extend(["--auth-token", args.api_token])
     if args.verbose:
         invocation.append("--verbose")
@@ -323,14 +426,145 @@ def run_sync_dir(lane, args, finish=False):
         invocation.append("--ua_progress")
     if args.dxpy_upload:
         invocation.append("--dxpy-upload")
-    if finish:
-        invocation.append("--finish")
-    else:
-        invocation.extend(["--min-age", str(args.min_age)])
+    if args.native_upload:
+        invocation.append("--native-upload")
+    if args.part_size:
+        invocation.extend(["--part-size", str(args.part_size)])
+    if args.stream_upload:
+        invocation.append("--stream-upload")
+    if args.pipeline_depth:
+        invocation.extend(["--pipeline-depth", str(args.pipeline_depth)])
+    if args.max_staged_size:
+        invocation.extend(["--max-staged-size", str(args.max_staged_size)])
+    invocation.extend(["--min-age", str(args.min_age)])
+    if args.rta_readiness:
+        invocation.append("--rta-readiness")
+    if args.compression != "none":
+        invocation.extend(["--compression", args.compression])
+    if args.tar_order != "scan":
+        invocation.extend(["--tar-order", args.tar_order])
+    if args.tar_packing != "sequential":
+        invocation.extend(["--tar-packing", args.tar_packing])
+    if args.tar_index:
+        invocation.append("--tar-index")
+    if args.checksums:
+        invocation.append("--checksums")
+    if args.bandwidth_limit:
+        invocation.extend(["--bandwidth-limit", str(args.bandwidth_limit)])
+    for window in args.bandwidth_window:
+        invocation.extend(["--bandwidth-window", window])
+    if args.bandwidth_state_file:
+        invocation.extend(["--bandwidth-state-file", args.bandwidth_state_file])
+    if args.tar_holdback:
+        invocation.extend(["--tar-holdback", str(args.tar_holdback)])
+    if args.stable_scans:
+        invocation.extend(["--stable-scans", str(args.stable_scans)])
+    if args.quiet_period:
+        invocation.extend(["--quiet-period", str(args.quiet_period)])
     invocation.append(args.run_dir)
+    return invocation
+
+def lane_upload_threads(args):
+    """Upload threads of each lane, sharing -u among the lanes synced at once"""
+    parallel_lanes = min(getattr(args, "parallel_lanes", 1), args.num_lanes or 1)
+    return max(1, args.upload_threads // parallel_lanes)
+
+def sync_lanes(lanes, args, sync_lane):
+    """Call sync_lane on each of the given lanes, up to --parallel-lanes lanes
+    at a time, so that a slow lane does not hold back the others. Errors
+    (including the exits of raise_error and of the hourly restart) are
+    raised once the lanes being synced are done, and no new lane is started
+    after the first one."""
+    parallel_lanes = min(args.parallel_lanes, len(lanes))
+    if parallel_lanes <= 1:
+        for lane in lanes:
+            sync_lane(lane)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallel_lanes,
+                                               thread_name_prefix="lane") as executor:
+        futures = [executor.submit(sync_lane, lane) for lane in lanes]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+def get_shared_scan(args):
+    """Scan of the run directory shared by the lane sessions, so that it is
+    walked once per interval rather than once per lane"""
+    watcher = None
+    if args.watch:
+        watcher = dir_watcher.InotifyWatcher(args.run_dir)
+        watcher.start()
+    return dx_sync_directory.SharedScan(args.run_dir, watcher)
+
+def get_sync_session(lane, args, shared_scan=None):
+    """The sync session of the lane, created on first use"""
+    if lane.get("session") is None:
+        sync_args = dx_sync_directory.parse_args(sync_dir_argv(lane, args))
+        logger.debug("Starting sync session of lane %s: %s" % (lane["lane"], sync_args))
+        lane["session"] = dx_sync_directory.SyncSession(sync_args, shared_scan=shared_scan)
+    return lane["session"]
+
+def close_sync_session(lane):
+    if lane.get("session") is not None:
+        lane["session"].close()
+        lane["session"] = None
+
+def run_sync_dir(lane, args, finish=False, shared_scan=None, flush=False):
+    """Sync the lane, and return the file IDs of the tar files uploaded so far.
+    With finish, all remaining files are synced and the session is closed.
+    With flush, files are synced even if they do not add up to --min-size."""
+    for trys in range(args.retries):
+        logger.info("Syncing lane %s (Try %d of %d)" % (lane["lane"], trys, args.retries))
+        try:
+            file_ids = get_sync_session(lane, args, shared_scan).sync(finish=finish, flush=flush)
+            if finish:
+                close_sync_session(lane)
+            return file_ids
+        except dx_sync_directory.RestartDue:
+            # One iteration took too long (span to the next hour) to upload
+            logger.info(msg="Triggering restarts")
+            sys.exit()
+        except Exception as e:
+            logger.error("Failed to sync lane %s, retrying (Try %s): %s" % (lane["lane"], trys, e))
+            logger.debug(traceback.format_exc())
+            # Start over from the log on disk
+            close_sync_session(lane)
 
-    output = run_command_with_retry(args.retries, invocation)
-    return output.split()
+        time.sleep(10)
+
+    raise_error("Number of retries exceed %d. Please check logs to troubleshoot issues." % args.retries)
+
+
+def lanes_due(lanes, args, shared_scan, now=None):
+    """With --probe-interval, the lanes to sync now: {lane number: flush}.
+    A lane is due once the data it has ready for upload reaches --min-size,
+    or, to be flushed below --min-size, once its oldest data ready for
+    upload has waited --max-latency seconds. Every lane is due when the
+    watcher asks for a full walk of the run directory, which the sync does."""
+    now = time.time() if now is None else now
+    pending = shared_scan.probe()
+    due = {}
+    for lane in lanes:
+        session = lane.get("session")
+        if session is None or pending is None:
+            # Not opened yet, or failed: leave it to run_sync_dir
+            due[lane["lane"]] = False
+            continue
+        size, oldest = pending.get(session, (0, None))
+        if size >= args.min_size * 2**20:
+            due[lane["lane"]] = False
+        elif oldest is not None and now - (oldest + args.min_age) >= args.max_latency:
+            logger.info("Lane %s has had data waiting for upload for over %d seconds" %
+                        (lane["lane"], args.max_latency))
+            due[lane["lane"]] = True
+        else:
+            logger.debug("Lane %s has %d bytes ready for upload, waiting for more" % (lane["lane"], size))
+    return due
 
 def termination_file_exists(novaseq, run_dir):
     if not novaseq:
@@ -370,6 +604,76 @@ def mark_completed_run_uploaded(lane: dict):
     with open(lane["log_path"], "w") as f:
         json.dump(log, f, indent=4)
 
+def manifest_details(lane, args, properties):
+    """Upload the manifest written by the final sync of the lane, and return
+    the sentinel details linking it and the index of each TAR archive"""
+    manifest_path = lane["log_path"] + ".manifest.json"
+    if not os.path.exists(manifest_path):
+        logger.error("No manifest was written for lane %s" % lane["lane"])
+        return {}
+    with open(manifest_path) as fh:
+        tars = json.load(fh)["tars"]
+    details = {'tar_index_file_ids': {tar["file_id"]: tar["index_file_id"] for tar in tars.values()}}
+    manifest_file_id = upload_single_file(manifest_path, args.project, lane["remote_folder"], properties)
+    if manifest_file_id:
+        details['manifest_file_id'] = manifest_file_id
+    return details
+
+def finish_lane(lane, args, run_id, shared_scan=None):
+    """Final synchronization of a lane: upload the remaining data and the
+    lane log, set the details of the upload sentinel and close it"""
+    file_ids = run_sync_dir(lane, args, finish=True, shared_scan=shared_scan)
+    record = lane["dxrecord"]
+    properties = record.get_properties()
+    lane["log_file_id"] = upload_single_file(lane["log_path"], args.project,
+                                     lane["remote_folder"], properties)
+
+    for file_id in file_ids:
+        dxpy.get_handler(file_id, project=args.project).set_properties(properties)
+    details = {
+        'run_id': run_id,
+        'lanes': lane["lane"],
+        'upload_thumbnails': str(args.upload_thumbnails).lower(),
+        'dnanexus_path': args.project + ":" + lane["remote_folder"],
+        'tar_file_ids': file_ids
+        }
+
+    # Upload sample sheet here, if samplesheet-delay specified
+    if args.samplesheet_delay:
+        lane["samplesheet_file_id"] = upload_single_file(args.run_dir + "/SampleSheet.csv", args.project,
+                                        lane["remote_folder"], properties)
+
+    if args.upload_complete_files:
+        # At this point we have confirmed that one of the three *Complete.txt
+        # files is in the run directory
+
+        file_name = "CopyComplete.txt"
+        if os.path.isfile(os.path.join(args.run_dir, file_name)):
+            lane["copy_complete_file_id"] = upload_single_file(args.run_dir + "/" + file_name, args.project,
+                                        lane["remote_folder"], properties)
+        file_name = "RTAComplete.txt"
+        if os.path.isfile(os.path.join(args.run_dir, file_name)):
+            lane["rta_complete_file_id"] = upload_single_file(args.run_dir + "/" + file_name, args.project,
+                                        lane["remote_folder"], properties)
+        file_name = "SequenceComplete.txt"
+        if os.path.isfile(os.path.join(args.run_dir, file_name)):
+            lane["sequence_complete_file_id"] = upload_single_file(args.run_dir + "/" + file_name, args.project,
+                                        lane["remote_folder"], properties)
+
+    # ID to singly uploaded file (when uploaded successfully)
+    if lane.get("log_file_id"):
+        details.update({'log_file_id': lane["log_file_id"]})
+    if lane.get("runinfo_file_id"):
+        details.update({'runinfo_file_id': lane["runinfo_file_id"]})
+    if lane.get("samplesheet_file_id"):
+        details.update({'samplesheet_file_id': lane["samplesheet_file_id"]})
+    if args.tar_index:
+        details.update(manifest_details(lane, args, properties))
+
+    record.set_details(details)
+    record.close()
+    mark_completed_run_uploaded(lane)
+
 def main():
     logger.info("-"*10 + "START" + "-"*10)
 
@@ -463,6 +767,17 @@ def main():
     seconds_to_wait = (dxpy.utils.normalize_timedelta(args.run_duration) / 1000 * args.intervals_to_wait)
     logger.debug("Maximum allowable time for run to complete: %d seconds." % seconds_to_wait)
 
+    shared_scan = get_shared_scan(args)
+    # Open the lane sessions up front, so that the first scan covers all of them
+    for lane in lane_info:
+        if lane["uploaded"] or was_completed_run_uploaded(lane=lane, args=args):
+            continue
+        try:
+            get_sync_session(lane, args, shared_scan)
+        except Exception as e:
+            # Retried by run_sync_dir
+            logger.warning("Could not open sync session of lane %s: %s" % (lane["lane"], e))
+
     initial_start_time = time.time()
     loop = 1
     # While loop waiting for RTAComplete.txt or RTAComplete.xml, or CopyComplete.txt, in case of a NovaSeq run
@@ -475,81 +790,35 @@ def main():
             sys.exit(1)
 
         # Loop through all lanes in run directory
-        for lane in lane_info:
-            lane_num = lane["lane"]
-            if lane["uploaded"]:
-               continue
-            run_sync_dir(lane, args)
+        lanes = [lane for lane in lane_info if not lane["uploaded"]]
+        if args.probe_interval:
+            due = lanes_due(lanes, args, shared_scan)
+        else:
+            due = {lane["lane"]: False for lane in lanes}
+        shared_scan.new_cycle()
+        sync_lanes([lane for lane in lanes if lane["lane"] in due], args,
+                   lambda lane: run_sync_dir(lane, args, shared_scan=shared_scan, flush=due[lane["lane"]]))
 
         cur_time = time.time()
         diff = cur_time - start_time
+        interval = args.probe_interval or args.sync_interval
 
         # if the next upload is going to be 1 hour after the initial start, then terminate and let the cron job pick it up
-        if args.hourly_restart and ((cur_time + args.sync_interval) // threshold > cur_time // threshold):
+        if args.hourly_restart and ((cur_time + interval) // threshold > cur_time // threshold):
             logger.info("EXITING: Next run interval will be hourly cron initiated")
             sys.exit()
 
         # Wait at least the minimum time interval before running the loop again.  If the previous loop
-        # ran longer than the sync_interval, then run loop immediately
-        if diff < args.sync_interval:
-            logger.debug("Sleeping for %d seconds" % (int(args.sync_interval - diff)))
-            time.sleep(int(args.sync_interval - diff))
+        # ran longer than the interval, then run loop immediately
+        if diff < interval:
+            logger.debug("Sleeping for %d seconds" % (int(interval - diff)))
+            time.sleep(int(interval - diff))
 
     # Final synchronization, upload data, set details
-    for lane in lane_info:
-        if was_completed_run_uploaded(lane=lane, args=args):
-            continue
-        if lane["uploaded"]:
-            continue
-        file_ids = run_sync_dir(lane, args, finish=True)
-        record = lane["dxrecord"]
-        properties = record.get_properties()
-        lane["log_file_id"] = upload_single_file(lane["log_path"], args.project,
-                                         lane["remote_folder"], properties)
-
-        for file_id in file_ids:
-            dxpy.get_handler(file_id, project=args.project).set_properties(properties)
-        details = {
-            'run_id': run_id,
-            'lanes': lane["lane"],
-            'upload_thumbnails': str(args.upload_thumbnails).lower(),
-            'dnanexus_path': args.project + ":" + lane["remote_folder"],
-            'tar_file_ids': file_ids
-            }
-
-        # Upload sample sheet here, if samplesheet-delay specified
-        if args.samplesheet_delay:
-            lane["samplesheet_file_id"] = upload_single_file(args.run_dir + "/SampleSheet.csv", args.project,
-                                            lane["remote_folder"], properties)
-
-        if args.upload_complete_files:
-            # At this point we have confirmed that one of the three *Complete.txt
-            # files is in the run directory
-
-            file_name = "CopyComplete.txt"
-            if os.path.isfile(os.path.join(args.run_dir, file_name)):
-                lane["copy_complete_file_id"] = upload_single_file(args.run_dir + "/" + file_name, args.project,
-                                            lane["remote_folder"], properties)
-            file_name = "RTAComplete.txt"
-            if os.path.isfile(os.path.join(args.run_dir, file_name)):
-                lane["rta_complete_file_id"] = upload_single_file(args.run_dir + "/" + file_name, args.project,
-                                            lane["remote_folder"], properties)
-            file_name = "SequenceComplete.txt"
-            if os.path.isfile(os.path.join(args.run_dir, file_name)):
-                lane["sequence_complete_file_id"] = upload_single_file(args.run_dir + "/" + file_name, args.project,
-                                            lane["remote_folder"], properties)
-
-        # ID to singly uploaded file (when uploaded successfully)
-        if lane.get("log_file_id"):
-            details.update({'log_file_id': lane["log_file_id"]})
-        if lane.get("runinfo_file_id"):
-            details.update({'runinfo_file_id': lane["runinfo_file_id"]})
-        if lane.get("samplesheet_file_id"):
-            details.update({'samplesheet_file_id': lane["samplesheet_file_id"]})
-
-        record.set_details(details)
-        record.close()
-        mark_completed_run_uploaded(lane)
+    shared_scan.new_cycle()
+    sync_lanes([lane for lane in lane_info
+                if not lane["uploaded"] and not was_completed_run_uploaded(lane=lane, args=args)],
+               args, lambda lane: finish_lane(lane, args, run_id, shared_scan))
 
     logger.info("Run %s successfully streamed!" % (run_id))
 
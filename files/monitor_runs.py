@@ -2,6 +2,7 @@
 
 import argparse
 import dxpy
+import fnmatch
 import glob
 import json
 import multiprocessing
@@ -18,6 +19,7 @@ src_dir = os.path.join(os.path.dirname(__file__), ".")
 sys.path.append(src_dir)
 
 from incremental_upload import termination_file_exists
+import run_readiness
 
 
 logger = logging.getLogger(__name__)
@@ -39,6 +41,16 @@ DEBUG = False
 # and will be relaunched
 N_INTERVALS_TO_WAIT = 5
 
+# Name of the file, in the log_dir, caching the state of the upload sentinels
+SENTINEL_CACHE = "sentinel_cache.json"
+
+# Number of sentinels fetched by each request of find_sentinel_states (at most 1000)
+SENTINEL_PAGE_SIZE = 1000
+
+# Factor by which each level of run priority (see run_priorities) multiplies
+# the weight of a run, the completion of a run multiplying it by up to 2
+PRIORITY_FACTOR = 2
+
 # Default config values (used when corresponding configs
 # are not provided in the config YAML file)
 CONFIG_DEFAULT = {
@@ -53,11 +65,33 @@ CONFIG_DEFAULT = {
     "run_length": "24h",
     "n_seq_intervals": 2,
     "n_upload_threads": 8,
+    "n_parallel_lanes": 1,
+    "probe_interval": 0,
+    "rta_readiness": False,
+    "stable_scans": 0,
+    "tar_order": "scan",
+    "tar_packing": "sequential",
+    "compression": "none",
+    "tar_index": False,
+    "checksums": False,
+    "bandwidth_limit": 0,
+    "bandwidth_windows": "",
+    "bandwidth_state_file": "",
     "downstream_input": '',
     "n_streaming_threads":1,
+    "total_upload_threads": 0,
+    "run_priorities": {},
+    "sentinel_cache_ttl": 3600,
     "delay_sample_sheet_upload": False,
     "novaseq": False,
     "hourly_restart": False,
+    "stream_upload": False,
+    "pipeline_depth": 0,
+    "max_staged_size": 0,
+    "n_parallel_uploads": 1,
+    "native_upload": False,
+    "part_size": 0,
+    "state_backend": "json",
     "ua_progress": True,
     "verbose": True
 }
@@ -282,9 +316,59 @@ def check_local_runs(base_dir, run_folders, run_length, n_intervals, novaseq=Fal
     return (not_run_folders, completed_runs, in_progress_runs, stale_runs)
 
 
-def check_dnax_folders(run_folders, project):
+def sentinel_cache_path(config):
+    return os.path.join(config['log_dir'], SENTINEL_CACHE)
+
+def load_sentinel_cache(config):
+    """ Local cache of the state of the upload sentinels of the project:
+    {"project": project, "runs": {run_name: {"state": state, "checked": time}}}.
+    Closed sentinels are final, open ones are checked again once older than
+    config['sentinel_cache_ttl'] seconds, or before their run is relaunched
+    (see check_incomplete_sync). A missing or unreadable cache is
+    started afresh."""
+    cache = {"project": config['project'], "runs": {}}
+    try:
+        with open(sentinel_cache_path(config)) as fh:
+            cached = json.load(fh)
+    except (OSError, ValueError) as e:
+        if DEBUG: logger.debug("No usable sentinel cache ({0}), starting a new one".format(e))
+        return cache
+    if cached.get("project") == config['project'] and isinstance(cached.get("runs"), dict):
+        cache = cached
+    return cache
+
+def save_sentinel_cache(cache, config):
+    """ Write the sentinel cache, through a temporary file renamed over it, so
+    that concurrent monitors never read a truncated cache"""
+    path = sentinel_cache_path(config)
+    tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as fh:
+            json.dump(cache, fh)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("Could not save the sentinel cache {0}: {1}".format(path, e))
+
+def cached_sentinel_state(folder, cache, config, now=None):
+    """ State of the upload sentinel of the run from the cache, or None if it
+    needs to be looked up on the platform"""
+    entry = (cache or {}).get("runs", {}).get(folder)
+    if entry is None:
+        return None
+    if entry["state"] == "closed":
+        return "closed"
+    now = time.time() if now is None else now
+    if now - entry["checked"] < config.get('sentinel_cache_ttl', 0):
+        return entry["state"]
+    return None
+
+def check_dnax_folders(run_folders, project, cache=None):
     """Check the RUN folders that have been synced (fully/partially) onto DNAnexus by looking into the
-    RUN_UPLOAD_DEST folder of the given project. """
+    RUN_UPLOAD_DEST folder of the given project. Folders with a sentinel in the cache
+    are known to be synced, the project is only listed for the others."""
+    cached = [folder for folder in run_folders if folder in (cache or {}).get("runs", {})]
+    if len(cached) == len(run_folders):
+        return (list(run_folders), [])
     try:
         dx_proj = dxpy.bindings.DXProject(project)
 
@@ -295,8 +379,8 @@ def check_dnax_folders(run_folders, project):
         dnax_folders = dx_proj.list_folder(RUN_UPLOAD_DEST, only="folders")['folders']
         dnax_folders = [os.path.basename(folder) for folder in dnax_folders]
 
-        synced_folders = list(filter( (lambda folder: folder in dnax_folders), run_folders))
-        unsynced_folders = list(filter( (lambda folder: folder not in dnax_folders), run_folders))
+        synced_folders = list(filter( (lambda folder: folder in dnax_folders or folder in cached), run_folders))
+        unsynced_folders = list(filter( (lambda folder: folder not in synced_folders), run_folders))
 
         return (synced_folders, unsynced_folders)
 
@@ -306,7 +390,7 @@ def check_dnax_folders(run_folders, project):
     except dxpy.exceptions.ResourceNotFound as e:
         if DEBUG: logger.debug("{0} not found in project {1}".format(RUN_UPLOAD_DEST, project))
         if DEBUG: logger.debug("Interpreting this as all local RUN folders are unsynced")
-        return ([], run_folders)
+        return (cached, [folder for folder in run_folders if folder not in cached])
 
     # Dict returned by list_folder did not contian a "folders" key
     # This is an unexpected exception
@@ -314,20 +398,28 @@ def check_dnax_folders(run_folders, project):
         sys.exit("Unknown exception when fetching folders in {0} of {1}. {2}: {3}.".format(
                   RUN_UPLOAD_DEST, project, e.errno, e.strerror))
 
-def find_record(run_name, project):
-    """ Wrapper to find the sentinel record for a given run_name in the given
-    DNAnexus project"""
+def find_sentinel_states(project):
+    """ State of the upload sentinels of all the runs of the given DNAnexus
+    project, {run_name: state}, from a single paged search of the UploadSentinel
+    records below RUN_UPLOAD_DEST, with their describe output. A run uploaded
+    by lane has a sentinel per lane, and is open until all of them are closed."""
+    states = {}
     try:
-        record = dxpy.find_one_data_object(classname="record", name="*{0}*".format(run_name),
-                                       project=project, folder="{0}/{1}/{2}".format(RUN_UPLOAD_DEST.rstrip('/'), run_name, REMOTE_RUN_FOLDER),
-                                       name_mode="glob", return_handler=True, more_ok=False, zero_ok=False)
-
-        return record
-
-    # Either zero or multiple records found, in cases where we cannot resolve uniquely
-    # the upload sentinel, we exit the program with an error
-    except dxpy.exceptions.DXSearchError as e:
-        sys.exit("Unexpected result when searching for upload sentinel of run {0}. {1}".format(run_name, e))
+        records = dxpy.find_data_objects(classname="record", typename="UploadSentinel",
+                                         project=project, folder=RUN_UPLOAD_DEST, recurse=True,
+                                         describe={"fields": {"folder": True, "state": True}},
+                                         first_page_size=SENTINEL_PAGE_SIZE)
+        for record in records:
+            # Sentinels are in <RUN_UPLOAD_DEST>/<run_name>/<REMOTE_RUN_FOLDER>[/<lane>]
+            folder = record["describe"]["folder"][len(RUN_UPLOAD_DEST.rstrip('/')):]
+            parts = folder.strip('/').split('/')
+            if len(parts) < 2 or parts[1] != REMOTE_RUN_FOLDER:
+                continue
+            if states.get(parts[0]) != "open":
+                states[parts[0]] = record["describe"]["state"]
+    except dxpy.exceptions.DXAPIError as e:
+        sys.exit("Unexpected error when searching for upload sentinels in {0}. {1}".format(project, e))
+    return states
 
 
 def local_upload_has_lapsed(folder, config):
@@ -372,31 +464,48 @@ def local_upload_has_lapsed(folder, config):
     # return ((elapsed_time / config['min_interval']) > N_INTERVALS_TO_WAIT)
     return True
 
-def check_incomplete_sync(synced_folders, config):
+def check_incomplete_sync(synced_folders, config, cache=None):
     """ Check whether the RUN folder sync is incomplete by querying the state
     of the sentinel record (closed = complete, open = incomplete). Returns
     a list of incomplete syncs which have been deemed to be inactive, according
-    to the local_upload_has_lapsed function"""
-    incomplete_syncs = []
+    to the local_upload_has_lapsed function.
+    With a cache (see load_sentinel_cache), states are taken from it when
+    still valid, and the states queried are recorded in it. The others are
+    all looked up at once (see find_sentinel_states), as are the cached open
+    states of the runs which would be relaunched, since their sentinel may
+    have been closed since."""
+    states = {}
     for folder in synced_folders:
-        sentinel_record = find_record(folder, config['project'])
-        try:
-            state = sentinel_record.describe()['state']
-            # Upload sentinel is open, signifies that incremental upload
-            # is incomplete
-            if state == "open":
-                if (local_upload_has_lapsed(folder, config)):
-                    incomplete_syncs.append(folder)
+        state = cached_sentinel_state(folder, cache, config)
+        if state == "closed" or (state == "open" and not local_upload_has_lapsed(folder, config)):
+            states[folder] = state
+    to_query = [folder for folder in synced_folders if folder not in states]
+    if to_query:
+        found = find_sentinel_states(config['project'])
+        checked = time.time()
+        for folder in to_query:
+            # Could not resolve the upload sentinel, we exit the program with an error
+            if folder not in found:
+                sys.exit("Unexpected result when searching for upload sentinel of run {0}. "
+                         "No UploadSentinel record found".format(folder))
+            states[folder] = found[folder]
+            if cache is not None:
+                cache["runs"][folder] = {"state": found[folder], "checked": checked}
+    if DEBUG: logger.debug("Queried {0} of {1} upload sentinels".format(len(to_query), len(synced_folders)))
 
-        except KeyError as e:
-            sys.exit("Unknown exception when getting state of record {0}. {1}: {2}".format(sentinel_record, e.errno, e.strerror))
+    incomplete_syncs = []
+    for folder in synced_folders:
+        # Upload sentinel is open, signifies that incremental upload
+        # is incomplete
+        if states[folder] == "open":
+            if (local_upload_has_lapsed(folder, config)):
+                incomplete_syncs.append(folder)
 
     return incomplete_syncs
 
-def _trigger_streaming_upload(folder, config):
-    """ Execute the incremental_upload.py script, assumed to be located
-    in the same directory as the executed monitor_runs.py, potentially multiple
-    instances of this can be triggered using a thread pool"""
+def incremental_upload_command(folder, config):
+    """ Command line of the incremental_upload.py script for the folder,
+    assumed to be located in the same directory as the executed monitor_runs.py"""
     curr_dir = sys.path[0]
     inc_upload_script_loc = "{0}/{1}".format(curr_dir, "incremental_upload.py")
     command = ["python3", inc_upload_script_loc,
@@ -426,6 +535,63 @@ def _trigger_streaming_upload(folder, config):
     if config['hourly_restart']:
         command += ['-Z']
 
+    if config['n_parallel_lanes'] != 1:
+        command += ['--parallel-lanes', config['n_parallel_lanes']]
+
+    if config['probe_interval']:
+        command += ['--probe-interval', config['probe_interval'], '--watch']
+
+    if config['rta_readiness']:
+        command += ['--rta-readiness']
+
+    if config['stable_scans']:
+        command += ['--stable-scans', config['stable_scans']]
+
+    if config['tar_order'] != 'scan':
+        command += ['--tar-order', config['tar_order']]
+
+    if config['tar_packing'] != 'sequential':
+        command += ['--tar-packing', config['tar_packing']]
+
+    if config['compression'] != 'none':
+        command += ['--compression', config['compression']]
+
+    if config['tar_index']:
+        command += ['--tar-index']
+
+    if config['checksums']:
+        command += ['--checksums']
+
+    if float(config['bandwidth_limit']):
+        command += ['--bandwidth-limit', config['bandwidth_limit']]
+
+    for window in config['bandwidth_windows'].split():
+        command += ['--bandwidth-window', window]
+
+    if config['bandwidth_state_file']:
+        command += ['--bandwidth-state-file', config['bandwidth_state_file']]
+
+    if config['stream_upload']:
+        command += ['--stream-upload']
+
+    if config['pipeline_depth']:
+        command += ['--pipeline-depth', config['pipeline_depth']]
+
+    if config['max_staged_size']:
+        command += ['--max-staged-size', config['max_staged_size']]
+
+    if config['n_parallel_uploads'] != 1:
+        command += ['--parallel-uploads', config['n_parallel_uploads']]
+
+    if config['native_upload']:
+        command += ['--native-upload']
+
+    if config['part_size']:
+        command += ['--part-size', config['part_size']]
+
+    if config['state_backend'] != 'json':
+        command += ['--state-backend', config['state_backend']]
+
     if config['exclude'] != '':
         command += ["-x", config['exclude']]
 
@@ -445,8 +611,12 @@ def _trigger_streaming_upload(folder, config):
         command.append("-S")
 
     # Ensure all numerical values are formatted as string
-    command = [str(word) for word in command]
+    return [str(word) for word in command]
 
+def _trigger_streaming_upload(folder, config):
+    """ Execute the incremental_upload.py script, potentially multiple
+    instances of this can be triggered using a thread pool"""
+    command = incremental_upload_command(folder, config)
     logger.info("Triggering incremental upload command: {0}".format(' '.join(command)))
     try:
         inc_out = sub.run(command, check=True, stdout=sub.PIPE, universal_newlines=True, env=os.environ.copy()).stdout
@@ -454,14 +624,79 @@ def _trigger_streaming_upload(folder, config):
         logger.error(
             "Incremental upload command {0} failed.\n\tError code {1}:{2}".format(e.cmd, e.returncode, e.output))
 
+def run_priority(folder, config):
+    """ Priority of a RUN folder, from the first glob pattern of
+    config['run_priorities'] matching its name (0 if none does)"""
+    name = os.path.basename(folder.rstrip('/'))
+    for pattern, priority in (config.get('run_priorities') or {}).items():
+        if fnmatch.fnmatch(name, pattern):
+            return _transform_to_number(priority)
+    return 0
+
+def run_progress(folder, novaseq=False):
+    """ Fraction of the sequencing cycles of a RUN folder that are complete,
+    according to its termination file, RTARead<N>Complete.txt markers and
+    InterOp extraction metrics (see run_readiness.py), in its least
+    advanced lane"""
+    if termination_file_exists(novaseq, folder):
+        return 1.0
+    readiness = run_readiness.for_run(folder)
+    readiness.refresh()
+    if not readiness.read_cycles:
+        return 0.0
+    if readiness.lanes:
+        lanes = range(1, readiness.lanes + 1)
+    else:
+        lanes = sorted(readiness.metrics.tiles) or [1]
+    complete_cycle = min(readiness.complete_cycle(lane) for lane in lanes)
+    return min(complete_cycle / float(sum(readiness.read_cycles)), 1.0)
+
+def schedule_runs(folders, config):
+    """ Order the RUN folders to sync so as to bring the next run to finish to
+    analysis soonest: by weight, the priority of the run (run_priorities)
+    scaled by how close it is to completion, then oldest first (by its
+    RunInfo.xml), folders being otherwise kept in the given order.
+
+    Returns the list of (folder, config of its upload). With
+    total_upload_threads, each run gets a share of them in proportion to its
+    weight, relative to the n_streaming_threads heaviest runs, so that the
+    runs uploaded at the same time never use more than the total between
+    them. The host-wide bandwidth limit (bandwidth_limit) is not weighted by
+    run: Upload Agent uploads each get an equal share of it."""
+    runs = []
+    for index, folder in enumerate(folders):
+        priority = run_priority(folder, config)
+        progress = run_progress(folder, config.get("novaseq", False))
+        try:
+            created = os.path.getmtime(os.path.join(folder, 'RunInfo.xml'))
+        except OSError:
+            created = float('inf')
+        weight = PRIORITY_FACTOR ** priority * (1 + progress)
+        runs.append((-weight, created, index, folder, priority, progress))
+    runs.sort()
+
+    total_threads = int(config.get("total_upload_threads") or 0)
+    concurrent_weight = sum(-run[0] for run in runs[:int(config["n_streaming_threads"])])
+    scheduled = []
+    for neg_weight, _, _, folder, priority, progress in runs:
+        run_config = config
+        if total_threads:
+            threads = max(1, int(total_threads * -neg_weight / concurrent_weight))
+            run_config = dict(config, n_upload_threads=threads)
+        logger.info("Scheduled {0}: priority {1}, {2:.0%} complete, {3} upload threads".format(
+                    folder, priority, progress, run_config['n_upload_threads']))
+        scheduled.append((folder, run_config))
+    return scheduled
+
 def trigger_streaming_upload(folders, config):
     """ Open a thread pool of size N_STREAMING_THREADS
-    and trigger streaming upload for all unsynced and incomplete folders"""
+    and trigger streaming upload for all unsynced and incomplete folders,
+    in the order given by schedule_runs"""
     pool = multiprocessing.Pool(processes=int(config["n_streaming_threads"]))
     results = []
-    for folder in folders:
+    for folder, run_config in schedule_runs(folders, config):
         logger.debug("Adding folder {0} to pool".format(folder))
-        results.append(pool.apply_async(_trigger_streaming_upload, args=(folder, config)))
+        results.append(pool.apply_async(_trigger_streaming_upload, args=(folder, run_config)))
 
     # Retrieve results from all _trigger_streaming_upload calls
     for result in results:
@@ -549,17 +784,20 @@ def main():
             logger.debug("Following folders are deeemed to be STALE runs and will not be uploaded: {0}".format(stale_runs))
 
     syncable_folders = completed_runs + ongoing_runs
-    (synced_folders, unsynced_folders) = check_dnax_folders(syncable_folders, args.project)
+    sentinel_cache = load_sentinel_cache(streaming_config)
+    (synced_folders, unsynced_folders) = check_dnax_folders(syncable_folders, args.project, sentinel_cache)
     if DEBUG: logger.debug("Got synced folders: %s" % synced_folders)
     if DEBUG: logger.debug("Got unsynced folders: %s" % unsynced_folders)
 
     folders_to_sync = []
     if synced_folders:
-        incomplete_syncs = check_incomplete_sync(synced_folders, streaming_config)
+        incomplete_syncs = check_incomplete_sync(synced_folders, streaming_config, sentinel_cache)
+        save_sentinel_cache(sentinel_cache, streaming_config)
         folders_to_sync += incomplete_syncs
         if DEBUG: logger.debug("Got incomplete folders: %s" % incomplete_syncs)
 
-    # Preferentially upload partially-synced folders before unsynced ones
+    # Preferentially upload partially-synced folders before unsynced ones,
+    # all else being equal (see schedule_runs)
     folders_to_sync += unsynced_folders
     folders_to_sync = ["{0}/{1}".format(args.directory, folder) for folder in folders_to_sync]
 
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+"""
+Readiness of the files of a directory being synced, as alternatives to
+waiting for files to reach --min-age:
+
+RunReadiness follows the progress of RTA in an Illumina RUN directory.
+
+The per-cycle files (BCL/CBCL files under
+Data/Intensities/BaseCalls/L<lane>/C<cycle>.1/) of a cycle are complete
+once RTA has moved on past that cycle. Cycle completion is tracked from:
+
+  - RTARead<N>Complete.txt markers, written by RTA when read N is complete:
+    all the cycles of reads 1..N (see the Reads of RunInfo.xml) are complete.
+
+  - InterOp/ExtractionMetricsOut.bin, to which RTA appends a record per
+    lane, tile and cycle as the images of that cycle are extracted. Base
+    calls lag behind extraction, so a cycle is only deemed complete once
+    all the tiles of the lane have been extracted CYCLE_LAG cycles later.
+
+Files which do not belong to a cycle (e.g. RunInfo.xml, InterOp files,
+.filter and .locs files) are left to --min-age.
+
+StabilityTracker releases files whose size and mtime stopped changing across
+successive scans, for instruments without usable cycle markers.
+"""
+
+import os
+import re
+import struct
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+import logging
+
+
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stderr)
+formatter = logging.Formatter(
+    fmt="[proc:%(process)d][%(filename)s][%(asctime)s][%(levelname)s] %(message)s",
+    datefmt="%b %d %Y, %I:%M:%S %p (%Z)"
+)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.DEBUG)
+
+# Number of cycles extraction must be ahead of a cycle for it to be complete.
+# RTA calls the bases of a cycle once the intensities of the next cycle are
+# extracted (the phasing/prephasing correction of a cycle uses its
+# neighbours), and writes its BCL files after that: one cycle for base
+# calling, and one more as a margin for the files to be written out.
+CYCLE_LAG = 2
+
+# Minimum interval (in seconds) between two refreshes of the RTA progress
+REFRESH_INTERVAL = 5
+
+EXTRACTION_METRICS = os.path.join("InterOp", "ExtractionMetricsOut.bin")
+
+# .../L001/C12.1/... -> lane 1, cycle 12
+_CYCLE_PATH = re.compile(r"/L(\d{3})/C(\d+)\.\d+(?:/|$)")
+
+_READ_COMPLETE = re.compile(r"^RTARead(\d+)Complete\.txt$")
+
+
+def parse_run_info(run_dir):
+    """(number of cycles of each read, number of lanes or None, number of
+    tiles of each lane as {lane: tiles}) from RunInfo.xml.
+
+    The tiles of a lane are those listed by the TileSet of the
+    FlowcellLayout ("<lane>_<tile>") if any, otherwise SurfaceCount x
+    SwathCount x TileCount x SectionPerLane (the camera sections of e.g.
+    NextSeq flow cells each image every lane; LanePerSection, the lanes
+    imaged by a section, does not change the tiles of a lane)."""
+
+    root = ET.parse(os.path.join(run_dir, "RunInfo.xml")).getroot()
+    reads = sorted(root.iter("Read"), key=lambda read: int(read.attrib["Number"]))
+    read_cycles = [int(read.attrib["NumCycles"]) for read in reads]
+
+    lanes = None
+    tiles = {}
+    layout = root.find(".//FlowcellLayout")
+    if layout is not None:
+        lanes = int(layout.attrib.get("LaneCount", 1))
+        lane_tiles = 1
+        for key in ("SurfaceCount", "SwathCount", "TileCount", "SectionPerLane"):
+            lane_tiles *= int(layout.attrib.get(key, 1))
+        tiles = {lane: lane_tiles for lane in range(1, lanes + 1)}
+        listed = {}
+        for tile in layout.iter("Tile"):
+            lane = int(tile.text.strip().split("_")[0])
+            listed[lane] = listed.get(lane, 0) + 1
+        tiles.update(listed)
+    return read_cycles, lanes, tiles
+
+
+class ExtractionMetrics:
+    """Incremental reader of the lane/tile/cycle of the records appended to
+    InterOp/ExtractionMetricsOut.bin"""
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.version = None
+        self.record_size = None
+        # {lane: {cycle: set of tiles}}
+        self.tiles = {}
+
+    def read(self):
+        """Read the records appended since the last call"""
+        try:
+            with open(self.path, 'rb') as fh:
+                if self.version is None:
+                    header = fh.read(2)
+                    if len(header) < 2:
+                        return
+                    self.version, self.record_size = header
+                    if self.version not in (2, 3):
+                        logger.warning("Unsupported version %d of %s, ignored" % (self.version, self.path))
+                    # Version 3 has the number of channels after the header
+                    self.offset = 3 if self.version == 3 else 2
+                if self.version not in (2, 3):
+                    return
+                fh.seek(self.offset)
+                data = fh.read()
+        except OSError:
+            return
+
+        # Version 2 has 16-bit tile numbers, version 3 32-bit ones
+        record_id = struct.Struct("<HHH" if self.version == 2 else "<HIH")
+        complete = len(data) - len(data) % self.record_size
+        for offset in range(0, complete, self.record_size):
+            lane, tile, cycle = record_id.unpack_from(data, offset)
+            self.tiles.setdefault(lane, {}).setdefault(cycle, set()).add(tile)
+        self.offset += complete
+
+    def extracted_cycle(self, lane, tiles=None):
+        """Last cycle up to which every cycle was extracted for all the tiles
+        of the lane (tiles, or as many as in the first cycle if not known)"""
+        cycles = self.tiles.get(lane, {})
+        if not cycles:
+            return 0
+        expected = tiles or len(cycles.get(1, ()))
+        cycle = 0
+        while len(cycles.get(cycle + 1, ())) >= max(expected, 1):
+            cycle += 1
+        return cycle
+
+
+class RunReadiness:
+    """Tracks the cycles RTA has completed in a RUN directory"""
+
+    def __init__(self, run_dir):
+        self.run_dir = os.path.abspath(run_dir)
+        self.read_cycles = None
+        self.lanes = None
+        self.tiles = {}
+        self.metrics = ExtractionMetrics(os.path.join(self.run_dir, EXTRACTION_METRICS))
+        self.complete_reads = 0
+        self.last_refresh = None
+        self.lock = threading.Lock()
+
+    def refresh(self, now=None):
+        """Update the RTA progress, at most every REFRESH_INTERVAL seconds"""
+        now = time.time() if now is None else now
+        with self.lock:
+            if self.last_refresh is not None and now - self.last_refresh < REFRESH_INTERVAL:
+                return
+            self.last_refresh = now
+            if self.read_cycles is None:
+                try:
+                    self.read_cycles, self.lanes, self.tiles = parse_run_info(self.run_dir)
+                except (OSError, ET.ParseError, KeyError, ValueError) as e:
+                    logger.warning("Could not read the layout of the run from RunInfo.xml: %s" % e)
+                    return
+            try:
+                names = os.listdir(self.run_dir)
+            except OSError:
+                names = []
+            for name in names:
+                match = _READ_COMPLETE.match(name)
+                if match:
+                    self.complete_reads = max(self.complete_reads, int(match.group(1)))
+            self.metrics.read()
+
+    def complete_cycle(self, lane):
+        """Last cycle up to which all cycles of the lane are complete"""
+        if self.read_cycles is None:
+            return 0
+        from_reads = sum(self.read_cycles[:self.complete_reads])
+        from_metrics = max(self.metrics.extracted_cycle(lane, self.tiles.get(lane)) - CYCLE_LAG, 0)
+        return max(from_reads, from_metrics)
+
+    def is_ready(self, path):
+        """True for the files of a completed cycle, None (left to --min-age)
+        for the others"""
+        match = _CYCLE_PATH.search(path)
+        if match is None:
+            return None
+        lane, cycle = int(match.group(1)), int(match.group(2))
+        return cycle <= self.complete_cycle(lane) or None
+
+
+class StabilityTracker:
+    """Remembers the size and mtime of the files seen by successive scans. A
+    file is stable once they were the same for `scans` observations in a row,
+    or for `quiet_period` seconds since first observed (either being 0 to
+    disable it). Observation times are local, so this does not depend on the
+    clock of the instrument writing the files."""
+
+    def __init__(self, scans=0, quiet_period=0):
+        self.scans = scans
+        self.quiet_period = quiet_period
+        # {path: ((size, mtime), observations, time first observed)}
+        self.observed = {}
+
+    def observe(self, entry, now):
+        state = (entry.size, entry.mtime)
+        previous = self.observed.get(entry.path)
+        if previous is not None and previous[0] == state:
+            self.observed[entry.path] = (state, previous[1] + 1, previous[2])
+        else:
+            self.observed[entry.path] = (state, 1, now)
+
+    def is_stable(self, entry, now):
+        observed = self.observed.get(entry.path)
+        if observed is None or observed[0] != (entry.size, entry.mtime):
+            return False
+        _, observations, since = observed
+        return ((self.scans > 0 and observations >= self.scans) or
+                (self.quiet_period > 0 and now - since >= self.quiet_period))
+
+    def forget(self, path):
+        """Stop tracking a file, once it is synced"""
+        self.observed.pop(path, None)
+
+
+_runs = {}
+_runs_lock = threading.Lock()
+
+def for_run(run_dir):
+    """The RunReadiness of the RUN directory, shared by all its sync sessions"""
+    run_dir = os.path.abspath(run_dir)
+    with _runs_lock:
+        if run_dir not in _runs:
+            _runs[run_dir] = RunReadiness(run_dir)
+        return _runs[run_dir]
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+"""
+SQLite-backed store for the dx_sync_directory.py log.
+
+The JSON log keeps the 'files' and 'tar_files' maps fully in memory and
+finding the tar files in a given status means scanning all of them. For runs
+with millions of files and thousands of tar files, SqliteLog keeps them in
+an SQLite database instead, indexed on file path and on tar status.
+
+SqliteLog behaves like the JSON log dict for reading: top-level keys
+('file_prefix', 'next_tar_index', ...) are plain items, while log['files'] and
+log['tar_files'] are read-only mappings backed by the database. Changes go
+through SqliteLog.apply, which takes the same changes as the log journal (see
+'Log journal' in dx_sync_directory.py), so that the rest of the script does
+not depend on the backend in use.
+"""
+
+import collections.abc
+import contextlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import logging
+
+
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stderr)
+formatter = logging.Formatter(
+    fmt="[proc:%(process)d][%(filename)s][%(asctime)s][%(levelname)s] %(message)s",
+    datefmt="%b %d %Y, %I:%M:%S %p (%Z)"
+)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.DEBUG)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    record TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS tar_files (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT UNIQUE NOT NULL,
+    status TEXT NOT NULL,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tar_files_status ON tar_files (status, id);
+"""
+
+
+class _TableMap(collections.abc.Mapping):
+    """Read-only mapping view over a (path -> JSON record) table"""
+
+    def __init__(self, db, table, order_by):
+        self.db = db
+        self.table = table
+        self.order_by = order_by
+
+    def __getitem__(self, path):
+        row = self.db.query_one("SELECT record FROM %s WHERE path = ?" % self.table, (path,))
+        if row is None:
+            raise KeyError(path)
+        return json.loads(row[0])
+
+    def __contains__(self, path):
+        return self.db.query_one("SELECT 1 FROM %s WHERE path = ?" % self.table, (path,)) is not None
+
+    def __iter__(self):
+        for row in self.db.query_all("SELECT path FROM %s ORDER BY %s" % (self.table, self.order_by)):
+            yield row[0]
+
+    def __len__(self):
+        return self.db.query_one("SELECT COUNT(*) FROM %s" % self.table)[0]
+
+    def items(self):
+        for path, record in self.db.query_all("SELECT path, record FROM %s ORDER BY %s" % (self.table, self.order_by)):
+            yield path, json.loads(record)
+
+
+class SqliteLog(dict):
+    """Log of dx_sync_directory.py stored in an SQLite database"""
+
+    def __init__(self, db_file):
+        super().__init__()
+        self.db_file = db_file
+        self._lock = threading.RLock()
+        self._batch_depth = 0
+        # Shared by the upload threads, access is serialized by self._lock
+        self._conn = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        for key, value in self._conn.execute("SELECT key, value FROM meta"):
+            super().__setitem__(key, json.loads(value))
+        super().__setitem__('files', _TableMap(self, 'files', 'path'))
+        super().__setitem__('tar_files', _TableMap(self, 'tar_files', 'id'))
+
+    def close(self):
+        self._conn.close()
+
+    def query_one(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()
+
+    def query_all(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Group the statements executed within into a single transaction"""
+        with self._lock:
+            if self._batch_depth == 0:
+                self._conn.execute("BEGIN")
+            self._batch_depth += 1
+            try:
+                yield self
+            except BaseException:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self._conn.execute("ROLLBACK")
+                raise
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self._conn.execute("COMMIT")
+
+    def is_empty(self):
+        return not self.query_one("SELECT 1 FROM meta LIMIT 1")
+
+    def apply(self, changes):
+        """Apply log changes ('tar', 'files' and 'set' operations) in one transaction"""
+        with self.batch():
+            for change in changes:
+                if change['op'] == 'tar':
+                    value = change['value']
+                    self._conn.execute(
+                        "INSERT INTO tar_files (path, status, record) VALUES (?, ?, ?) "
+                        "ON CONFLICT (path) DO UPDATE SET status = excluded.status, record = excluded.record",
+                        (change['path'], value['status'], json.dumps(value)))
+                elif change['op'] == 'files':
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO files (path, record) VALUES (?, ?)",
+                        ((path, json.dumps(record)) for path, record in change['value'].items()))
+                elif change['op'] == 'set':
+                    if change['key'] in ('files', 'tar_files'):
+                        raise ValueError("Cannot set %s, use 'files'/'tar' changes instead" % change['key'])
+                    self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                       (change['key'], json.dumps(change['value'])))
+                    super().__setitem__(change['key'], change['value'])
+                else:
+                    raise ValueError("Unknown log operation %s" % change['op'])
+
+    def tars_with_status(self, status):
+        """(path, record) of the tar files in the given status, in creation order"""
+        return [(path, json.loads(record)) for path, record in self.query_all(
+            "SELECT path, record FROM tar_files WHERE status = ? ORDER BY id", (status,))]
+
+    def import_log(self, log):
+        """Load a log in the JSON format into the (empty) database"""
+        changes = [{'op': 'set', 'key': key, 'value': value}
+                   for key, value in log.items() if key not in ('files', 'tar_files')]
+        changes.append({'op': 'files', 'value': log['files']})
+        changes.extend({'op': 'tar', 'path': path, 'value': value} for path, value in log['tar_files'].items())
+        self.apply(changes)
+        logger.info("Imported %d files and %d tar files into %s" %
+                    (len(log['files']), len(log['tar_files']), self.db_file))
+
+    def export(self):
+        """The whole log as a plain dict, in the JSON log format"""
+        log = {key: value for key, value in self.items() if key not in ('files', 'tar_files')}
+        log['files'] = dict(self['files'].items())
+        log['tar_files'] = dict(self['tar_files'].items())
+        return log
+
+
+def open_log(db_file, read_json_log):
+    """Open the SQLite log at db_file. If it does not exist yet, it is
+    initialised from the JSON log returned by read_json_log(), so that a run
+    started with the JSON log can carry on with SQLite."""
+
+    exists = os.path.exists(db_file)
+    log = SqliteLog(db_file)
+    if not exists or log.is_empty():
+        logger.info("Initialising SQLite log %s" % db_file)
+        log.import_log(read_json_log())
+    return log
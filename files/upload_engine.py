@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+"""
+In-process upload of files to the platform through the multipart file API
+(/file/new, /file-xxxx/upload, /file-xxxx/close), used by dx_sync_directory.py
+as an alternative to Upload Agent.
+
+Parts are uploaded in parallel by upload_file, and sent over a pool of HTTP
+connections shared by all the uploads of the process, so that successive tar
+files reuse the connections (and TLS sessions) opened for the previous ones.
+
+The platform side is accessed through DXFileAPI, so that tests can replace
+the API calls with a local stand-in. DXFileAPI paces the parts it sends
+through a bandwidth.HostLimiter, if given.
+"""
+
+import concurrent.futures
+import hashlib
+import math
+import os
+import sys
+import threading
+import time
+import dxpy
+import urllib3
+import logging
+
+
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stderr)
+formatter = logging.Formatter(
+    fmt="[proc:%(process)d][%(filename)s][%(asctime)s][%(levelname)s] %(message)s",
+    datefmt="%b %d %Y, %I:%M:%S %p (%Z)"
+)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.DEBUG)
+
+# Limits of the multipart file API
+MIN_PART_SIZE = 5 * 2**20
+MAX_PART_SIZE = 5 * 2**30
+MAX_PARTS = 10000
+
+# Part size used for files large enough to keep all the upload threads busy
+DEFAULT_PART_SIZE = 64 * 2**20
+
+# Attempts made at uploading a part before giving up
+PART_ATTEMPTS = 5
+
+class UploadError(Exception):
+    """A file could not be uploaded"""
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def shared_pool():
+    """HTTP connection pool shared by all the uploads of the process"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = urllib3.PoolManager(maxsize=32, block=True,
+                                        timeout=urllib3.Timeout(connect=30, read=600))
+        return _pool
+
+
+class DXFileAPI:
+    """Thin wrapper around the file API calls made by the upload code"""
+
+    def __init__(self, pool=None, limiter=None):
+        self.pool = pool or shared_pool()
+        self.limiter = limiter
+        # Seconds spent waiting on the limiter, summed over the upload threads
+        self.throttled = 0.0
+        self.throttled_lock = threading.Lock()
+
+    def new_file(self, project, folder, name):
+        return dxpy.api.file_new({"project": project, "folder": folder,
+                                  "name": name, "parents": True})["id"]
+
+    def get_upload_url(self, file_id, index, size, md5):
+        """Pre-authenticated URL and headers to upload a part to"""
+        resp = dxpy.api.file_upload(file_id, {"index": index, "size": size, "md5": md5})
+        return resp["url"], resp.get("headers", {})
+
+    def upload_part(self, file_id, index, data):
+        md5 = hashlib.md5(data).hexdigest()
+        for attempt in range(1, PART_ATTEMPTS + 1):
+            # Upload URLs expire, a new one is requested for each attempt
+            url, headers = self.get_upload_url(file_id, index, len(data), md5)
+            if self.limiter is not None:
+                waited = self.limiter.acquire(len(data))
+                with self.throttled_lock:
+                    self.throttled += waited
+            try:
+                resp = self.pool.request("PUT", url, body=data, headers=headers, retries=False)
+            except (urllib3.exceptions.HTTPError, OSError) as e:
+                error = e
+            else:
+                if resp.status < 300:
+                    return
+                if resp.status < 500 and resp.status not in (408, 429):
+                    raise UploadError("Upload of part %d of %s failed: HTTP %d %s" %
+                                      (index, file_id, resp.status, resp.data[:200]))
+                error = "HTTP %d" % resp.status
+            if attempt == PART_ATTEMPTS:
+                raise UploadError("Upload of part %d of %s failed after %d attempts: %s" %
+                              (index, file_id, attempt, error))
+            logger.warning("Upload of part %d of %s failed (%s), retrying ..." % (index, file_id, error))
+            time.sleep(min(2 ** attempt, 60))
+
+    def close(self, file_id):
+        dxpy.DXFile(file_id).close(block=True)
+
+    def wait_on_close(self, file_id):
+        dxpy.DXFile(file_id).wait_on_close()
+
+    def describe(self, file_id):
+        return dxpy.api.file_describe(file_id, {"fields": {"state": True, "parts": True, "project": True}})
+
+    def set_properties(self, file_id, project, properties):
+        dxpy.api.file_set_properties(file_id, {"project": project, "properties": properties})
+
+
+def adaptive_part_size(total_size, threads):
+    """Part size giving each of the upload threads a few parts of a file of
+    total_size bytes, so that small files still upload in parallel while
+    large ones are not split into more requests than needed"""
+    size = total_size // (threads * 4)
+    return choose_part_size(total_size, min(max(size, MIN_PART_SIZE), DEFAULT_PART_SIZE))
+
+def choose_part_size(total_size, part_size=None):
+    """Part size to upload total_size bytes with. Uses part_size if given,
+    raised as needed to stay within the API limits, rounded up to a MiB."""
+
+    needed = int(math.ceil(total_size / float(MAX_PARTS - 1)))
+    size = max(part_size or MIN_PART_SIZE, needed, MIN_PART_SIZE)
+    size = int(math.ceil(size / float(2**20))) * 2**20
+    if size > MAX_PART_SIZE:
+        raise ValueError("%d bytes cannot be uploaded within %d parts" % (total_size, MAX_PARTS))
+    return size
+
+
+class MultipartWriter:
+    """Write-only file object that uploads what is written to it as the parts
+    of an open platform file, holding at most one part in memory.
+
+    Parts listed in skip_parts were uploaded by an earlier, interrupted
+    attempt: their bytes are consumed but not sent again, which requires the
+    data written to be identical to that of the earlier attempt. on_part is
+    called with the index of each part once it is uploaded."""
+
+    def __init__(self, api, file_id, part_size, skip_parts=(), on_part=None):
+        self.api = api
+        self.file_id = file_id
+        self.part_size = part_size
+        self.skip_parts = set(skip_parts)
+        self.on_part = on_part
+        self.buffer = bytearray()
+        self.next_index = 1
+        self.bytes_written = 0
+        self.bytes_sent = 0
+        self.closed = False
+
+    def write(self, data):
+        self.buffer += data
+        self.bytes_written += len(data)
+        while len(self.buffer) >= self.part_size:
+            part = bytes(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+            self._upload(part)
+        return len(data)
+
+    def _upload(self, part):
+        index = self.next_index
+        self.next_index += 1
+        if index > MAX_PARTS:
+            raise ValueError("File %s exceeds %d parts of %d bytes" % (self.file_id, MAX_PARTS, self.part_size))
+        if index in self.skip_parts:
+            return
+        self.api.upload_part(self.file_id, index, part)
+        self.bytes_sent += len(part)
+        if self.on_part is not None:
+            self.on_part(index)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Upload the last, possibly short, part. An empty file is uploaded as
+        a single empty part."""
+        if self.closed:
+            return
+        if self.buffer or self.next_index == 1:
+            part = bytes(self.buffer)
+            self.buffer = bytearray()
+            self._upload(part)
+        self.closed = True
+
+
+def remote_parts(api, file_id):
+    """(state, indexes of the complete parts) of a platform file"""
+    desc = api.describe(file_id)
+    parts = set(int(index) for index, part in desc.get("parts", {}).items()
+                if part.get("state") == "complete")
+    return desc["state"], parts
+
+
+def upload_file(path, project, folder, name=None, api=None, threads=4, part_size=None, progress=None,
+                file_id=None, skip_parts=(), on_start=None, on_part=None):
+    """Upload a local file to the platform, `threads` parts at a time, and
+    return its file ID once it is closed.
+
+    The part size is chosen from the file size unless part_size is given.
+    progress, if given, is called with (bytes uploaded, total bytes) after
+    each part.
+
+    To resume an interrupted upload, pass the file_id and part_size it used,
+    and the parts already uploaded in skip_parts. Otherwise a new file is
+    created, and on_start is called with its (file_id, part_size) before any
+    part is uploaded. on_part is called with the index of each part once it
+    is uploaded, from one thread at a time."""
+
+    api = api or DXFileAPI()
+    total_size = os.path.getsize(path)
+    if part_size:
+        part_size = choose_part_size(total_size, part_size)
+    else:
+        part_size = adaptive_part_size(total_size, threads)
+    num_parts = max(1, int(math.ceil(total_size / float(part_size))))
+
+    if file_id is None:
+        file_id = api.new_file(project, folder, name or os.path.basename(path))
+        if on_start is not None:
+            on_start(file_id, part_size)
+    to_upload = [index for index in range(1, num_parts + 1) if index not in skip_parts]
+    logger.info("Uploading %s to %s in %d parts of %d bytes (%d left), %d at a time" %
+                (path, file_id, num_parts, part_size, len(to_upload), threads))
+
+    done = [sum(min(part_size, total_size - (index - 1) * part_size)
+                for index in range(1, num_parts + 1) if index in skip_parts)]
+    done_lock = threading.Lock()
+
+    def upload(index):
+        with open(path, 'rb') as fh:
+            fh.seek((index - 1) * part_size)
+            data = fh.read(part_size)
+        api.upload_part(file_id, index, data)
+        with done_lock:
+            done[0] += len(data)
+            if on_part is not None:
+                on_part(index)
+            if progress is not None:
+                progress(done[0], total_size)
+
+    # Only a few parts are read ahead of the upload threads, to bound memory use
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = set()
+        try:
+            for index in to_upload:
+                if len(pending) >= threads * 2:
+                    finished, pending = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in finished:
+                        future.result()
+                pending.add(executor.submit(upload, index))
+            for future in concurrent.futures.as_completed(pending):
+                future.result()
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
+
+    api.close(file_id)
+    return file_id
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmark of include/exclude pattern matching in dx_sync_directory.py.
+
+Compares the per-pattern re.search loop (full_path_matches_pattern as it
+used to be) with the precompiled PathMatcher over a synthetic set of paths
+laid out like an Illumina RUN directory. Not collected by pytest, run with:
+
+    python3 tests/bench_path_matcher.py [-n 1000000]
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+
+src_dir = os.path.join(os.path.dirname(__file__), "..")
+files_dir = os.path.join(src_dir, "files")
+sys.path.append(files_dir)
+import dx_sync_directory as dsd
+
+CONFIG_FILES = ["RTAConfiguration.xml", "RunInfo.xml", "RunParameters.xml", "config.xml", "s.locs"]
+
+
+def synthetic_paths(n):
+    """Yield n paths: BCLs, filters, thumbnails and InterOp files over 8 lanes"""
+    run = "/data/runs/180731_A00123_0042_BHXXXXXXXX"
+    count = 0
+    cycle = 1
+    while True:
+        for lane in range(1, 9):
+            for tile in range(1101, 1125):
+                for path in ("%s/Data/Intensities/BaseCalls/L00%d/C%d.1/s_%d_%d.bcl.gz" % (run, lane, cycle, lane, tile),
+                             "%s/Images/L00%d/C%d.1/s_%d_%d_a.jpg" % (run, lane, cycle, lane, tile),
+                             "%s/Data/Intensities/BaseCalls/L00%d/s_%d_%d.filter" % (run, lane, lane, tile),
+                             "%s/InterOp/C%d.1/ExtractionMetricsOut.bin" % (run, cycle)):
+                    yield path
+                    count += 1
+                    if count == n:
+                        return
+        cycle += 1
+
+
+def legacy_matches(path, include_patterns, exclude_patterns):
+    def matches_any(patterns):
+        for pattern in patterns:
+            if re.search(pattern, path):
+                return True
+        return False
+    if exclude_patterns and matches_any(exclude_patterns):
+        return False
+    if include_patterns and not matches_any(include_patterns):
+        return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark path pattern matching")
+    parser.add_argument("-n", "--num-paths", type=int, default=1000000)
+    args = parser.parse_args()
+
+    paths = list(synthetic_paths(args.num_paths))
+    include_patterns = CONFIG_FILES + ["s_3_"]
+    # What incremental_upload used to pass after a few sync intervals
+    exclude_patterns = ["Images", "SampleSheet.csv"] * 4
+
+    start = time.perf_counter()
+    legacy = sum(legacy_matches(path, include_patterns, exclude_patterns) for path in paths)
+    legacy_time = time.perf_counter() - start
+
+    matcher = dsd.PathMatcher(include_patterns, exclude_patterns)
+    start = time.perf_counter()
+    compiled = sum(matcher.matches(path) for path in paths)
+    compiled_time = time.perf_counter() - start
+
+    pruned = sum(1 for path in paths if matcher.prunes(os.path.dirname(path)))
+
+    assert legacy == compiled
+    print("%d paths, %d selected" % (len(paths), compiled))
+    print("re.search per pattern: %.2fs" % legacy_time)
+    print("PathMatcher:           %.2fs (%.1fx)" % (compiled_time, legacy_time / compiled_time))
+    print("paths below pruned directories (never stat'ed): %d" % pruned)
+
+
+if __name__ == "__main__":
+    main()
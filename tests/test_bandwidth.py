@@ -0,0 +1,106 @@
+import sys
+import os
+import datetime
+import time
+import tempfile
+import shutil
+import pytest
+
+src_dir = os.path.join(os.path.dirname(__file__), "..")
+files_dir = os.path.join(src_dir, "files")
+sys.path.append(files_dir)
+import bandwidth
+import dx_sync_directory as dsd
+
+
+def at(hour, minute=0):
+    return datetime.datetime(2018, 7, 31, hour, minute).timestamp()
+
+
+@pytest.fixture
+def state_file():
+    tmp_folder = tempfile.mkdtemp()
+    yield os.path.join(tmp_folder, "bandwidth")
+    shutil.rmtree(tmp_folder)
+
+
+def test_schedule_windows():
+    schedule = bandwidth.Schedule.parse(10, ["08:00-20:00=2", "22:30-02:00=0"])
+    assert schedule.rate(at(7, 59)) == 10 * 2**20
+    assert schedule.rate(at(8)) == 2 * 2**20
+    assert schedule.rate(at(23)) == 0
+    assert schedule.rate(at(1, 59)) == 0
+    assert schedule.rate(at(2)) == 10 * 2**20
+    assert schedule.is_limited()
+    assert not bandwidth.Schedule.parse(0, ["00:00-24:00=0"]).is_limited()
+
+    for spec in ["8-20=2", "08:00-20:00", "25:00-02:00=1"]:
+        with pytest.raises(ValueError):
+            bandwidth.Schedule.parse(0, [spec])
+
+
+def test_limiter_shares_rate_across_instances(state_file, monkeypatch):
+    slept = []
+    monkeypatch.setattr(bandwidth.time, "sleep", slept.append)
+    schedule = bandwidth.Schedule(default_rate=100)
+    # Two limiters on the same state file, as in two processes
+    first = bandwidth.HostLimiter(schedule, state_file)
+    second = bandwidth.HostLimiter(schedule, state_file)
+
+    now = time.time()
+    assert first.acquire(100, now=now) == 0
+    assert second.acquire(100, now=now) == 0
+    # 2 seconds worth of data are reserved, 1 second ahead of the burst allowance
+    assert second.acquire(100, now=now) == pytest.approx(1.0)
+    assert slept == [pytest.approx(1.0)]
+
+    with first.register():
+        with second.register():
+            assert first.fair_share() == 50
+        assert first.fair_share() == 100
+
+
+def test_state_file_is_private_and_not_followed(state_file):
+    limiter = bandwidth.HostLimiter(bandwidth.Schedule(default_rate=100), state_file)
+    limiter.acquire(100)
+    assert os.stat(state_file).st_mode & 0o777 & ~0o660 == 0
+
+    target = state_file + ".target"
+    os.rename(state_file, target)
+    os.symlink(target, state_file)
+    with pytest.raises(OSError):
+        limiter.acquire(100)
+
+
+def test_bandwidth_options(state_file):
+    argv = ["--log-file", "/tmp/sync.log", "--tar-destination", "project-xxxx:/", "--auth-token", "token",
+            "--prefix", "run", "--bandwidth-limit", "10", "--bandwidth-window", "00:00-06:00=0",
+            "--bandwidth-state-file", state_file, "/tmp"]
+    args = dsd.check_inputs(dsd.parse_args(argv))
+    limiter = dsd.get_limiter(args)
+    assert limiter.state_file == state_file
+    assert limiter.schedule.rate(at(12)) == 10 * 2**20
+
+    with pytest.raises(dsd.SyncError, match="Invalid bandwidth window"):
+        dsd.check_inputs(dsd.parse_args(argv + ["--bandwidth-window", "6-8=1"]))
+    with pytest.raises(dsd.SyncError, match="dxpy-upload"):
+        dsd.check_inputs(dsd.parse_args(argv + ["--dxpy-upload"]))
+    assert dsd.get_limiter(dsd.parse_args(argv[:8] + ["/tmp"])) is None
+    # By default, in the directory of the log file
+    assert dsd.get_limiter(dsd.parse_args(argv[:10] + ["/tmp"])).state_file == "/tmp/bandwidth.state"
+
+
+def test_small_files_are_registered_with_the_limiter(state_file, monkeypatch):
+    argv = ["--log-file", "/tmp/sync.log", "--tar-destination", "project-xxxx:/", "--auth-token", "token",
+            "--prefix", "run", "--native-upload", "--bandwidth-limit", "10",
+            "--bandwidth-state-file", state_file, "/tmp"]
+    args = dsd.check_inputs(dsd.parse_args(argv))
+    uploads = []
+    def upload_file(path, project, folder, api, threads):
+        uploads.append((api.limiter.state_file, api.limiter.active_uploads()))
+        return "file-1"
+    monkeypatch.setattr(dsd, "get_tar_destination", lambda args: ("project-xxxx", "/"))
+    monkeypatch.setattr(dsd.upload_engine, "upload_file", upload_file)
+    assert dsd.upload_small_file("/tmp/run_000.tar.index", args) == "file-1"
+    assert uploads == [(state_file, 1)]
+    assert dsd.get_limiter(args).active_uploads() == 0
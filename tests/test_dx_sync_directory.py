@@ -0,0 +1,730 @@
+import sys
+import os
+import argparse
+import io
+import hashlib
+import json
+import tarfile
+import tempfile
+import threading
+import shutil
+import pytest
+
+src_dir = os.path.join(os.path.dirname(__file__), "..")
+files_dir = os.path.join(src_dir, "files")
+sys.path.append(files_dir)
+import dx_sync_directory as dsd
+import dir_watcher
+
+
+def make_args(sync_dir, **kwargs):
+    args = argparse.Namespace(sync_dir=sync_dir, include_patterns=[], exclude_patterns=[], min_age=-1)
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
+
+
+def tar_args(run_dir, sync_dir=None, **kwargs):
+    """Arguments of a sync of sync_dir (default run_dir), logged in run_dir,
+    to project-xxxx:/"""
+    return make_args(sync_dir or run_dir, log_file=os.path.join(run_dir, "sync.log"),
+                     tar_destination="project-xxxx:/", prefix="run", **kwargs)
+
+
+def sync_argv(run_dir, sync_dir, *options):
+    """Command line of a dxpy sync of sync_dir, logged and tarred in run_dir"""
+    return ["--log-file", os.path.join(run_dir, "sync.log"), "--tar-destination", "project-xxxx:/",
+            "--tar-directory", run_dir, "--prefix", "run", "--auth-token", "token",
+            "--dxpy-upload"] + list(options) + [sync_dir]
+
+
+def paths(entries):
+    return sorted(entry.path for entry in entries)
+
+
+def write_file(path, content="foo"):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as fh:
+        fh.write(content)
+
+
+@pytest.fixture
+def run_dir():
+    tmp_folder = tempfile.mkdtemp()
+    yield tmp_folder
+    shutil.rmtree(tmp_folder)
+
+
+class FakeUploader:
+    """dxpy.upload_local_file recording the names of the files uploaded, with
+    file IDs numbered in upload order. before_upload, if set, is called with
+    the path of each file before it is uploaded."""
+
+    def __init__(self):
+        self.uploaded = []
+        self.file_ids = {}
+        self.before_upload = None
+        self.lock = threading.Lock()
+
+    def upload_local_file(self, path, project, folder):
+        if self.before_upload is not None:
+            self.before_upload(path)
+        with self.lock:
+            self.uploaded.append(os.path.basename(path))
+            file_id = "file-%d" % len(self.uploaded)
+            self.file_ids[os.path.basename(path)] = file_id
+        return argparse.Namespace(get_id=lambda: file_id)
+
+
+@pytest.fixture
+def uploader(monkeypatch):
+    """FakeUploader of the files uploaded to project-xxxx:/"""
+    uploader = FakeUploader()
+    monkeypatch.setattr(dsd, "get_tar_destination", lambda args: ("project-xxxx", "/"))
+    monkeypatch.setattr(dsd.dxpy, "upload_local_file", uploader.upload_local_file)
+    return uploader
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is Linux only")
+def test_watcher_only_reports_changed_paths(run_dir):
+    write_file(os.path.join(run_dir, "RunInfo.xml"))
+    args = make_args(run_dir)
+    log = {'files': {}}
+
+    with dir_watcher.InotifyWatcher(run_dir) as watcher:
+        # Initial call walks the whole tree
+        assert paths(dsd.get_files_to_upload(log, args, watcher)) == [os.path.join(run_dir, "RunInfo.xml")]
+        log['files'][os.path.join(run_dir, "RunInfo.xml")] = {'mtime': float("inf")}
+
+        new_file = os.path.join(run_dir, "Data", "L001", "s_1_1101.bcl")
+        write_file(new_file)
+        assert not watcher.needs_full_scan()
+        to_upload = dsd.get_files_to_upload(log, args, watcher)
+        assert paths(to_upload) == [os.path.join(run_dir, "Data"),
+                                     os.path.join(run_dir, "Data", "L001"),
+                                     new_file]
+
+        # Nothing changed since, nothing to look at
+        assert dsd.get_files_to_upload(log, args, watcher) == []
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is Linux only")
+def test_watcher_requeues_files_not_old_enough(run_dir):
+    args = make_args(run_dir, min_age=3600)
+    log = {'files': {}}
+
+    with dir_watcher.InotifyWatcher(run_dir) as watcher:
+        dsd.get_files_to_upload(log, args, watcher)
+        young_file = os.path.join(run_dir, "young.txt")
+        write_file(young_file)
+        assert dsd.get_files_to_upload(log, args, watcher) == []
+        assert young_file in watcher.dirty
+
+        args.min_age = -1
+        assert paths(dsd.get_files_to_upload(log, args, watcher)) == [young_file]
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is Linux only")
+def test_watcher_requeues_files_below_min_tar_size(run_dir, uploader):
+    sync_dir = os.path.join(run_dir, "run")
+    os.makedirs(sync_dir)
+    argv = sync_argv(run_dir, sync_dir, "--min-age", "0", "--min-tar-size", "1", "--max-tar-size", "2")
+
+    with dir_watcher.InotifyWatcher(sync_dir) as watcher, \
+            dsd.SyncSession(dsd.parse_args(argv), watcher=watcher) as session:
+        session.sync()
+        small_file = os.path.join(sync_dir, "small.txt")
+        write_file(small_file)
+        os.utime(small_file, (1, 1))
+        # Below --min-tar-size: not uploaded, but reported again by the watcher
+        assert session.sync() == []
+        assert small_file in watcher.dirty
+        assert session.sync(finish=True) == ["file-1"]
+    assert uploader.uploaded == ["run_000.tar"]
+
+
+def test_stable_files_are_synced_before_min_age(run_dir, monkeypatch):
+    args = make_args(run_dir, min_age=3600)
+    stability = dsd.run_readiness.StabilityTracker(scans=2, quiet_period=600)
+    log = {'files': {}}
+    growing = os.path.join(run_dir, "growing.txt")
+    stable = os.path.join(run_dir, "stable.txt")
+    write_file(growing)
+    write_file(stable)
+
+    assert dsd.get_files_to_upload(log, args, stability=stability) == []
+    # Unchanged over 2 scans
+    write_file(growing, "foobar")
+    assert paths(dsd.get_files_to_upload(log, args, stability=stability)) == [stable]
+    assert stable not in stability.observed
+    log['files'][stable] = {'mtime': float("inf")}
+
+    # Unchanged for the quiet period, by the local clock
+    stability.scans = 0
+    write_file(growing, "foobarbaz")
+    now = dsd.time.time()
+    assert dsd.get_files_to_upload(log, args, stability=stability) == []
+    assert dsd.get_files_to_upload(log, args, stability=stability) == []
+    monkeypatch.setattr(dsd.time, "time", lambda: now + 601)
+    assert paths(dsd.get_files_to_upload(log, args, stability=stability)) == [growing]
+
+
+def test_scan_directory_matches_os_walk(run_dir):
+    for name in ["RunInfo.xml", "Data/L001/C1.1/s_1_1101.bcl", "Data/L001/C2.1/s_1_1101.bcl",
+                 "InterOp/ExtractionMetricsOut.bin", "Data/L002/s_2_1101.filter"]:
+        write_file(os.path.join(run_dir, name))
+
+    expected = []
+    for root, dirs, files in os.walk(run_dir):
+        expected.extend(os.path.join(root, name) for name in dirs + files)
+    entries = list(dsd.scan_directory(run_dir))
+    assert [entry.path for entry in entries] == expected
+    for entry in entries:
+        st = os.lstat(entry.path)
+        assert entry.mtime == st.st_mtime
+        assert entry.inode == st.st_ino
+        assert entry.size == (st.st_size if os.path.isfile(entry.path) else 0)
+
+
+def test_create_tar_file_uses_scanned_metadata(run_dir):
+    sync_dir = os.path.join(run_dir, "run")
+    tar_dir = os.path.join(run_dir, "tmp")
+    os.makedirs(tar_dir)
+    write_file(os.path.join(sync_dir, "RunInfo.xml"), "runinfo")
+    write_file(os.path.join(sync_dir, "Data", "s_1_1101.bcl"), "x" * 1000)
+    args = tar_args(run_dir, sync_dir, tar_directory=tar_dir, max_tar_size=2**20, min_tar_size=0)
+    log = dsd.read_log(args)
+
+    entries = list(dsd.scan_directory(sync_dir))
+    tars = dsd.split_into_tar_files(entries, log, args)
+    assert len(tars) == 1 and tars[0]["size"] == 1007
+
+    # Shrink a file after it was scanned: the member is padded and the file left to be resynced
+    write_file(os.path.join(sync_dir, "Data", "s_1_1101.bcl"), "x" * 10)
+    log = dsd.create_tar_file(tar_object=tars[0], log=log, args=args)
+
+    tar_path = os.path.join(tar_dir, "run_000.tar")
+    with tarfile.open(tar_path) as tar:
+        members = {member.name: member for member in tar.getmembers()}
+        assert tar.extractfile("RunInfo.xml").read() == b"runinfo"
+        assert tar.extractfile("Data/s_1_1101.bcl").read() == b"x" * 10 + b"\0" * 990
+    assert members["Data"].isdir()
+    assert log["tar_files"][tar_path]["status"] == "tarred"
+    assert log["files"][os.path.join(sync_dir, "RunInfo.xml")]["size"] == 7
+    assert log["files"][os.path.join(sync_dir, "Data", "s_1_1101.bcl")]["mtime"] == 0
+
+
+@pytest.mark.parametrize("compression", ["gzip", "zstd"])
+def test_compressible_files_go_into_compressed_tar_files(run_dir, compression):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    sync_dir = os.path.join(run_dir, "run")
+    tar_dir = os.path.join(run_dir, "tmp")
+    os.makedirs(tar_dir)
+    write_file(os.path.join(sync_dir, "RunInfo.xml"), "<RunInfo/>" * 1000)
+    write_file(os.path.join(sync_dir, "InterOp", "TileMetricsOut.bin"), "\0" * 10000)
+    write_file(os.path.join(sync_dir, "Data", "s_1_1101.bcl.gz"), "x" * 100)
+    argv = ["--log-file", os.path.join(run_dir, "sync.log"), "--tar-destination", "project-xxxx:/",
+            "--tar-directory", tar_dir, "--prefix", "run", "--auth-token", "token", "--compression", compression,
+            "--min-age", "-1", sync_dir]
+    args = dsd.check_inputs(dsd.parse_args(argv))
+    log = dsd.read_log(args)
+
+    tars = dsd.split_into_tar_files(list(dsd.scan_directory(sync_dir)), log, args)
+    assert [(tar["compression"], sorted(os.path.basename(entry.path) for entry in tar["files"])) for tar in tars] == [
+        (None, ["Data", "InterOp", "s_1_1101.bcl.gz"]), (compression, ["RunInfo.xml", "TileMetricsOut.bin"])]
+    for tar in tars:
+        log = dsd.create_tar_file(tar_object=tar, log=log, args=args)
+
+    suffix = dsd.TAR_SUFFIXES[compression]
+    state = log["tar_files"][os.path.join(tar_dir, "run_001.tar" + suffix)]
+    assert state["compression"] == compression and state["compressed_size"] < 1000
+    if compression == "gzip":
+        with tarfile.open(os.path.join(tar_dir, "run_001.tar" + suffix)) as tar:
+            assert tar.extractfile("RunInfo.xml").read() == b"<RunInfo/>" * 1000
+    assert "compression" not in log["tar_files"][os.path.join(tar_dir, "run_000.tar")]
+
+
+def test_locality_order_groups_lane_cycle_tile(run_dir):
+    base_calls = os.path.join(run_dir, "Data", "Intensities", "BaseCalls")
+    names = ["L002/C1.1/s_2_1101.bcl.gz", "L001/C2.1/s_1_2101.bcl.gz", "L001/C10.1/s_1_1101.bcl.gz",
+             "L001/C2.1/s_1_1101.bcl.gz", "L001/C2.1", "L001/s_1_1101.filter", "L001/C1.1/s_1_1102.bcl.gz"]
+    entries = [dsd.FileEntry(os.path.join(base_calls, name), 1, 0, i, 0o100644, 0, 0)
+               for i, name in enumerate(names)]
+    entries.append(dsd.FileEntry(os.path.join(run_dir, "RunInfo.xml"), 1, 0, 99, 0o100644, 0, 0))
+    args = make_args(run_dir, max_tar_size=4, min_tar_size=0, tar_packing="sequential", tar_order="locality")
+
+    tars = dsd.split_into_tar_files(entries, {}, args)
+    assert [[os.path.relpath(entry.path, base_calls) for entry in tar["files"]] for tar in tars] == [
+        ["../../../RunInfo.xml", "L001/s_1_1101.filter", "L001/C1.1/s_1_1102.bcl.gz", "L001/C2.1"],
+        ["L001/C2.1/s_1_1101.bcl.gz", "L001/C2.1/s_1_2101.bcl.gz", "L001/C10.1/s_1_1101.bcl.gz",
+         "L002/C1.1/s_2_1101.bcl.gz"]]
+    assert dsd.locality_key("Data/Intensities/BaseCalls/L001/C3.1/L001_2.cbcl")[:3] == (1, 3, 2)
+    assert dsd.locality_key("Data/Intensities/BaseCalls/L003/0012.bcl.bgzf")[:3] == (3, 12, -1)
+
+
+def test_locality_order_packs_contiguous_cycles(run_dir):
+    base_calls = os.path.join(run_dir, "Data", "Intensities", "BaseCalls")
+    entries = [dsd.FileEntry(os.path.join(base_calls, "L001", "C%d.1" % cycle, "s_1_%d.bcl.gz" % tile),
+                             (cycle * 7 + tile) % 5 + 1, 0, cycle * 10 + tile, 0o100644, 0, 0)
+               for cycle in range(1, 21) for tile in range(1101, 1104)]
+    # Packing by size is ignored, it would spread the cycles across the tar files
+    args = make_args(run_dir, max_tar_size=20, min_tar_size=0, tar_packing="ffd", tar_order="locality")
+
+    tars = dsd.split_into_tar_files(entries, {}, args)
+    cycles = [sorted({dsd.locality_key(entry.path)[1] for entry in tar["files"]}) for tar in tars]
+    assert len(tars) > 2
+    for tar_cycles in cycles:
+        assert tar_cycles == list(range(tar_cycles[0], tar_cycles[-1] + 1))
+    assert all(previous[-1] <= following[0] for previous, following in zip(cycles, cycles[1:]))
+
+
+def test_pack_tar_files_fills_tar_files(run_dir):
+    sizes = [6, 5, 3, 4, 2, 12, 1, 0]
+    entries = [dsd.FileEntry(os.path.join(run_dir, "f%d" % i), size, 0, i, 0o100644, 0, 0)
+               for i, size in enumerate(sizes)]
+    args = make_args(run_dir, max_tar_size=10, min_tar_size=0, tar_packing="ffd", tar_holdback=0)
+
+    tars = dsd.split_into_tar_files(entries, {}, args)
+    # Files keep their order, the oversized file gets its own tar file
+    assert [[entries.index(entry) for entry in tar["files"]] for tar in tars] == [[0, 3, 7], [1, 2, 4], [5], [6]]
+    assert [tar["size"] for tar in tars] == [10, 10, 12, 1]
+    # Packed sequentially, the same files take one more tar file
+    args.tar_packing = "sequential"
+    assert len(dsd.split_into_tar_files(entries, {}, args)) == 5
+
+    # The least full tar file is held back, within the bound
+    args.tar_packing, args.tar_holdback = "ffd", 1
+    assert [tar["size"] for tar in dsd.split_into_tar_files(entries, {}, args)] == [10, 10, 12]
+    assert dsd.packing_efficiency(tars, 10) == 33 / 42.0
+
+
+@pytest.mark.parametrize("include,exclude,path,result", [
+    ([], [], "/run/Data/s_1_1101.bcl", True),
+    ([], ["Images"], "/run/Images/L001/C1.1/s_1_1101_a.jpg", False),
+    (["s_1_", "RunInfo.xml"], [], "/run/Data/s_1_1101.bcl", True),
+    (["s_1_", "RunInfo.xml"], [], "/run/Data/s_2_1101.bcl", False),
+    (["s_1_"], ["Images"], "/run/Images/s_1_1101_a.jpg", False),
+    ([], ["(?i)images"], "/run/IMAGES/s_1_1101_a.jpg", False),
+    ([], [r"(a)\1"], "/run/aa", False),
+])
+def test_path_matcher(include, exclude, path, result):
+    matcher = dsd.PathMatcher(include, exclude)
+    assert matcher.matches(path) == result
+    if exclude and not include:
+        assert dsd.full_path_matches_pattern(path, exclude) != result
+
+
+def test_path_matcher_prunes_only_prefix_safe_patterns():
+    matcher = dsd.PathMatcher([], ["Images", "Thumbnails$", "Logs(?!/keep)", "Images"])
+    assert matcher.exclude_patterns == ["Images", "Thumbnails$", "Logs(?!/keep)"]
+    assert matcher.prunes("/run/Images")
+    # Children of a directory matching an end-anchored pattern do not match it
+    assert not matcher.prunes("/run/Thumbnails")
+    assert matcher.matches("/run/Thumbnails/s_1_1101_a.jpg")
+    assert not matcher.prunes("/run/Logs")
+    assert matcher.matches("/run/Logs/keep/foo.log")
+
+
+def test_scan_directory_prunes_excluded_directories(run_dir):
+    for name in ["RunInfo.xml", "Images/L001/C1.1/s_1_1101_a.jpg", "Data/L001/s_1_1101.bcl"]:
+        write_file(os.path.join(run_dir, name))
+    args = make_args(run_dir, exclude_patterns=["Images", "Images"])
+    matcher = dsd.get_path_matcher(args)
+    assert matcher is dsd.get_path_matcher(make_args(run_dir, exclude_patterns=["Images", "Images"]))
+
+    entries = list(dsd.scan_directory(run_dir, matcher))
+    assert [os.path.relpath(entry.path, run_dir) for entry in entries] == [
+        "Data", "RunInfo.xml", "Data/L001", "Data/L001/s_1_1101.bcl"]
+
+
+def test_log_changes_are_journaled_and_replayed(run_dir, monkeypatch):
+    args = tar_args(run_dir)
+    log_file = args.log_file
+    log = dsd.read_log(args)
+
+    # First change writes the snapshot, later ones only append to the journal
+    log = dsd.update_log(log, args, [{'op': 'files', 'value': {"/run/a": {'mtime': 1, 'size': 2}}}])
+    assert os.path.exists(log_file) and not os.path.exists(dsd.journal_path(log_file))
+    snapshot = open(log_file).read()
+    log = dsd.update_log(log, args, [dsd.tar_change("/tmp/run_000.tar", {'status': 'tarred', 'size': 2, 'timestamps': {}}),
+                                     {'op': 'set', 'key': 'next_tar_index', 'value': 1}])
+    assert open(log_file).read() == snapshot
+    assert dsd.read_log(args) == log
+
+    # A change cut short by an interruption is dropped
+    with open(dsd.journal_path(log_file), 'a') as journalf:
+        journalf.write('{"op": "set", "key": "next_tar_')
+    assert dsd.read_log(args)['next_tar_index'] == 1
+    log = dsd.update_log(log, args, [{'op': 'set', 'key': 'file_prefix', 'value': "run2"}])
+    assert dsd.read_log(args) == log
+
+    # The journal is folded into the snapshot once it outgrows it
+    monkeypatch.setattr(dsd, "JOURNAL_MIN_COMPACT_SIZE", 0)
+    log = dsd.read_log(args)
+    log = dsd.update_log(log, args, [{'op': 'set', 'key': 'next_tar_index', 'value': 2}])
+    assert not os.path.exists(dsd.journal_path(log_file))
+    assert dsd.read_log(args) == log
+
+
+def test_sqlite_log_imports_json_log(run_dir):
+    args = tar_args(run_dir)
+    log_file = args.log_file
+    json_log = dsd.read_log(args)
+    json_log = dsd.update_log(json_log, args, [
+        {'op': 'files', 'value': {"/run/a": {'mtime': 1, 'size': 2}}},
+        dsd.tar_change("/tmp/run_000.tar", {'status': 'removed', 'file_id': "file-1", 'timestamps': {}}),
+        dsd.tar_change("/tmp/run_001.tar", {'status': 'tarred', 'size': 2, 'timestamps': {}}),
+        {'op': 'set', 'key': 'next_tar_index', 'value': 2}])
+
+    args.state_backend = "sqlite"
+    log = dsd.read_log(args)
+    assert isinstance(log, dsd.sqlite_log.SqliteLog)
+    dsd.check_log(log, args)
+    assert log['next_tar_index'] == 2
+    assert log['files']["/run/a"] == {'mtime': 1, 'size': 2}
+    assert "/run/b" not in log['files']
+    assert dsd.tars_with_status(log, 'tarred') == [("/tmp/run_001.tar", json_log['tar_files']["/tmp/run_001.tar"])]
+
+    state = log['tar_files']["/tmp/run_001.tar"]
+    state['status'] = 'uploaded'
+    log = dsd.update_log(log, args, [dsd.tar_change("/tmp/run_001.tar", state)])
+    assert dsd.tars_with_status(log, 'tarred') == []
+    assert [path for path, _ in dsd.tars_with_status(log, 'uploaded')] == ["/tmp/run_001.tar"]
+    log.close()
+
+    # State survives reopening, and is written back as a JSON log when compacted
+    log = dsd.read_log(args)
+    assert list(log['tar_files']) == ["/tmp/run_000.tar", "/tmp/run_001.tar"]
+    dsd.compact_log(log, args)
+    args.state_backend = "json"
+    exported = dsd.read_log(args)
+    assert exported['tar_files']["/tmp/run_001.tar"]['status'] == 'uploaded'
+    assert exported['files'] == {"/run/a": {'mtime': 1, 'size': 2}}
+    log.close()
+
+
+class FakeFileAPI:
+    def __init__(self, fail_at_part=None):
+        self.files = {}
+        self.closed = set()
+        self.fail_at_part = fail_at_part
+
+    def new_file(self, project, folder, name):
+        file_id = "file-%04d" % len(self.files)
+        self.files[file_id] = {}
+        return file_id
+
+    def upload_part(self, file_id, index, data):
+        if index == self.fail_at_part:
+            raise IOError("Connection reset")
+        self.files[file_id][index] = data
+
+    def close(self, file_id):
+        self.closed.add(file_id)
+
+    def describe(self, file_id):
+        return {'state': 'closed' if file_id in self.closed else 'open',
+                'parts': {str(index): {'state': 'complete'} for index in self.files[file_id]}}
+
+    def wait_on_close(self, file_id):
+        pass
+
+    def content(self, file_id):
+        parts = self.files[file_id]
+        return b"".join(parts[index] for index in sorted(parts))
+
+
+def test_stream_tar_file_uploads_parts_and_resumes(run_dir, uploader):
+    sync_dir = os.path.join(run_dir, "run")
+    for lane in (1, 2):
+        write_file(os.path.join(sync_dir, "Data", "s_%d_1101.bcl" % lane), os.urandom(3 * 2**20).hex())
+    args = tar_args(run_dir, sync_dir, tar_directory=os.path.join(run_dir, "tmp"), max_tar_size=2**30,
+                    min_tar_size=0, part_size=dsd.upload_engine.MIN_PART_SIZE)
+    log = dsd.read_log(args)
+    tars = dsd.split_into_tar_files(list(dsd.scan_directory(sync_dir)), log, args)
+
+    # Interrupted after the first part, before the parts were recorded
+    api = FakeFileAPI(fail_at_part=2)
+    with pytest.raises(IOError):
+        dsd.stream_tar_file(tars[0], log, args, api)
+    log = dsd.read_log(args)
+    [(tar_path, state)] = dsd.tars_with_status(log, 'streaming')
+    assert state['parts'] == []
+    assert not os.path.exists(tar_path)
+
+    # Only the parts missing on the platform are sent again
+    api.fail_at_part = None
+    sent = []
+    upload_part = api.upload_part
+    api.upload_part = lambda file_id, index, data: sent.append(index) or upload_part(file_id, index, data)
+    log = dsd.resume_streamed_tars(log, args, api)
+    assert sent == [2, 3]
+    assert api.closed == {state['file_id']}
+    state = dsd.read_log(args)['tar_files'][tar_path]
+    assert state['status'] == 'removed' and state['parts'] == [1, 2, 3]
+
+    with tarfile.open(fileobj=io.BytesIO(api.content(state['file_id']))) as tar:
+        assert sorted(tar.getnames()) == ["Data", "Data/s_1_1101.bcl", "Data/s_2_1101.bcl"]
+        with open(os.path.join(sync_dir, "Data", "s_2_1101.bcl"), 'rb') as fh:
+            assert tar.extractfile("Data/s_2_1101.bcl").read() == fh.read()
+
+
+def test_tar_pipeline_overlaps_tarring_and_upload(run_dir, uploader):
+    sync_dir = os.path.join(run_dir, "run")
+    tar_dir = os.path.join(run_dir, "tmp")
+    os.makedirs(tar_dir)
+    for i in range(6):
+        write_file(os.path.join(sync_dir, "s_1_%04d.bcl" % i), "x" * 2**19)
+    args = tar_args(run_dir, sync_dir, tar_directory=tar_dir, max_tar_size=2**20, min_tar_size=0,
+                    pipeline_depth=2, max_staged_size=5 * 2**19, dxpy_upload=True, hourly_restart=False)
+
+    def check_staged_size(tar_file):
+        staged = [name for name in os.listdir(tar_dir) if name.endswith(".tar")]
+        assert sum(os.path.getsize(os.path.join(tar_dir, name)) for name in staged) <= args.max_staged_size
+    uploader.before_upload = check_staged_size
+
+    log = dsd.read_log(args)
+    tars = dsd.split_into_tar_files(list(dsd.scan_directory(sync_dir)), log, args)
+    assert len(tars) == 3
+    log = dsd.run_tar_pipeline(tars, log, args)
+
+    assert uploader.uploaded == ["run_%03d.tar" % i for i in range(3)]
+    assert os.listdir(tar_dir) == []
+    log = dsd.read_log(args)
+    assert [state['status'] for state in log['tar_files'].values()] == ['removed'] * 3
+    assert [state['file_id'] for state in log['tar_files'].values()] == ["file-1", "file-2", "file-3"]
+    assert len(log['files']) == 6
+
+
+def test_upload_tar_files_in_parallel(run_dir, uploader):
+    tar_dir = os.path.join(run_dir, "tmp")
+    args = tar_args(run_dir, dxpy_upload=True, parallel_uploads=2, upload_threads=8)
+    log = dsd.read_log(args)
+    for i in range(4):
+        tar_file = os.path.join(tar_dir, "run_%03d.tar" % i)
+        write_file(tar_file)
+        log = dsd.update_log(log, args, [dsd.tar_change(tar_file, {'status': 'tarred', 'size': 3, 'timestamps': {}})])
+
+    # Both uploads of a pair have to be in flight at once to get past the barrier
+    barrier = threading.Barrier(2, timeout=10)
+    uploader.before_upload = lambda tar_file: barrier.wait()
+
+    log = dsd.upload_tar_files(log, args)
+    log = dsd.read_log(args)
+    assert [(state['status'], state['file_id']) for state in log['tar_files'].values()] == [
+        ('uploaded', uploader.file_ids["run_%03d.tar" % i]) for i in range(4)]
+
+    assert dsd.upload_threads_per_tar(args) == 4
+    args.upload_threads = None
+    assert dsd.upload_threads_per_tar(args) == 4
+    args.parallel_uploads = 1
+    assert dsd.upload_threads_per_tar(args) is None
+
+
+def test_native_upload_resumes_missing_parts(run_dir, uploader, monkeypatch):
+    tar_file = os.path.join(run_dir, "run_000.tar")
+    write_file(tar_file, "x" * (3 * dsd.upload_engine.MIN_PART_SIZE))
+    args = tar_args(run_dir, native_upload=True, parallel_uploads=1, upload_threads=1,
+                    part_size=dsd.upload_engine.MIN_PART_SIZE)
+    monkeypatch.setattr(dsd, "PARTS_LOG_INTERVAL", 0)
+    log = dsd.read_log(args)
+    log = dsd.update_log(log, args, [dsd.tar_change(tar_file, {'status': 'tarred', 'size': 3, 'timestamps': {}})])
+
+    api = FakeFileAPI(fail_at_part=3)
+    with pytest.raises(IOError):
+        dsd.upload_tar_file_native(tar_file, log['tar_files'][tar_file], log, args, api)
+    state = dsd.read_log(args)['tar_files'][tar_file]
+    assert state['status'] == 'tarred'
+    assert state['file_id'] == "file-0000" and state['parts'] == [1, 2]
+
+    # Only the missing part is sent on the next attempt, to the same file
+    api.fail_at_part = None
+    sent = []
+    upload_part = api.upload_part
+    api.upload_part = lambda file_id, index, data: sent.append(index) or upload_part(file_id, index, data)
+    assert dsd.upload_tar_file_native(tar_file, state, log, args, api) == "file-0000"
+    assert sent == [3] and api.closed == {"file-0000"}
+    assert api.content("file-0000") == b"x" * (3 * dsd.upload_engine.MIN_PART_SIZE)
+
+
+def test_sync_session_keeps_state_between_syncs(run_dir, uploader):
+    sync_dir = os.path.join(run_dir, "run")
+    write_file(os.path.join(sync_dir, "RunInfo.xml"))
+    argv = sync_argv(run_dir, sync_dir, "--min-age", "-1")
+
+    with dsd.SyncSession(dsd.parse_args(argv)) as session:
+        assert session.sync() == ["file-1"]
+        write_file(os.path.join(sync_dir, "Data", "s_1_1101.bcl"))
+        os.utime(os.path.join(sync_dir, "Data", "s_1_1101.bcl"), (1, 1))
+        os.utime(os.path.join(sync_dir, "Data"), (1, 1))
+        assert session.sync(finish=True) == ["file-1", "file-2"]
+        assert session.sync() == ["file-1", "file-2"]
+    assert uploader.uploaded == ["run_000.tar", "run_001.tar"]
+    assert not os.path.exists(dsd.journal_path(os.path.join(run_dir, "sync.log")))
+
+    # The log belongs to another directory
+    argv[-1] = run_dir
+    with pytest.raises(dsd.SyncError, match="Sync dir"):
+        dsd.SyncSession(dsd.parse_args(argv))
+
+
+def test_tar_index_locates_members(run_dir, uploader, monkeypatch):
+    sync_dir = os.path.join(run_dir, "run")
+    write_file(os.path.join(sync_dir, "RunInfo.xml"), "runinfo")
+    write_file(os.path.join(sync_dir, "Data", "s_1_1101.bcl"), "x" * 1000)
+    for path in ["RunInfo.xml", "Data", "Data/s_1_1101.bcl"]:
+        os.utime(os.path.join(sync_dir, path), (1, 1))
+    argv = sync_argv(run_dir, sync_dir, "--tar-index", "--finish")
+
+    tar_path = os.path.join(run_dir, "run_000.tar")
+    monkeypatch.setattr(dsd, "remove_tar_file", lambda tar_file, tar_state, log, args: log)
+    with dsd.SyncSession(dsd.parse_args(argv)) as session:
+        assert session.sync() == ["file-2"]
+    # The index goes first, next to the log
+    assert uploader.uploaded == ["run_000.tar.index.json", "run_000.tar"]
+
+    with open(os.path.join(run_dir, "run_000.tar.index.json")) as fh:
+        index = json.load(fh)
+    members = {member[0]: member[1:] for member in index["members"]}
+    offset, size, mtime = members["Data/s_1_1101.bcl"]
+    with open(tar_path, 'rb') as fh:
+        fh.seek(offset)
+        assert fh.read(size) == b"x" * 1000
+
+    with open(os.path.join(run_dir, "sync.log.manifest.json")) as fh:
+        manifest = json.load(fh)
+    assert manifest["tars"] == {"run_000.tar": {"file_id": "file-2", "index_file_id": "file-1"}}
+    assert manifest["files"]["RunInfo.xml"] == "run_000.tar"
+
+
+def test_checksums_computed_while_tarring(run_dir, monkeypatch):
+    sync_dir = os.path.join(run_dir, "run")
+    write_file(os.path.join(sync_dir, "RunInfo.xml"), "runinfo")
+    write_file(os.path.join(sync_dir, "Data", "s_1_1101.bcl"), "x" * 3000)
+    for path in ["RunInfo.xml", "Data", "Data/s_1_1101.bcl"]:
+        os.utime(os.path.join(sync_dir, path), (1, 1))
+    args = dsd.parse_args(sync_argv(run_dir, sync_dir, "--max-tar-size", "75", "--checksums", "--fast-hash", "blake2b"))
+    monkeypatch.setattr(dsd, "checksum_part_size", lambda args, tar_size: 4096)
+    log = {'files': {}, 'tar_files': {}, 'next_tar_index': 0, 'file_prefix': 'run'}
+    entries = [dsd.entry_from_stat(os.path.join(sync_dir, path), os.lstat(os.path.join(sync_dir, path)))
+               for path in ["RunInfo.xml", "Data/s_1_1101.bcl"]]
+    log = dsd.create_tar_file({"files": entries, "size": 3007}, log, args)
+
+    tar_path = os.path.join(run_dir, "run_000.tar")
+    with open(tar_path, 'rb') as fh:
+        content = fh.read()
+    state = log['tar_files'][tar_path]
+    assert state['md5'] == hashlib.md5(content).hexdigest()
+    assert state['blake2b'] == hashlib.blake2b(content).hexdigest()
+    assert state['part_md5s'] == [hashlib.md5(content[offset:offset + 4096]).hexdigest()
+                                  for offset in range(0, len(content), 4096)]
+    assert log['files'][os.path.join(sync_dir, "Data", "s_1_1101.bcl")]['md5'] == \
+        hashlib.md5(b"x" * 3000).hexdigest()
+
+    class API:
+        def __init__(self, part_md5s):
+            self.part_md5s = part_md5s
+            self.properties = None
+        def describe(self, file_id):
+            return {'project': 'project-xxxx',
+                    'parts': {str(index + 1): {'md5': md5} for index, md5 in enumerate(self.part_md5s)}}
+        def set_properties(self, file_id, project, properties):
+            self.properties = properties
+
+    api = API(state['part_md5s'])
+    dsd.verify_upload("file-1", tar_path, state, api)
+    assert api.properties == {'md5': state['md5'], 'blake2b': state['blake2b']}
+
+    api = API(state['part_md5s'][:-1] + ["0" * 32])
+    with pytest.raises(dsd.SyncError, match="corrupted"):
+        dsd.verify_upload("file-1", tar_path, state, api)
+    assert api.properties is None
+
+
+def test_shared_scan_buckets_entries_per_session(run_dir, monkeypatch):
+    for name in ["RunInfo.xml", "Data/L001/s_1_1101.bcl", "Data/L002/s_2_1101.bcl", "Images/s_1_1101.jpg"]:
+        write_file(os.path.join(run_dir, name))
+    class Session:
+        def __init__(self, args):
+            self.args = args
+
+    shared_scan = dsd.SharedScan(run_dir)
+    sessions = []
+    for lane in ("1", "2"):
+        session = Session(make_args(run_dir, include_patterns=["RunInfo.xml", "s_%s_" % lane],
+                                                    exclude_patterns=["Images"]))
+        sessions.append(session)
+        shared_scan.register(session)
+
+    scans = []
+    scan_directory = dsd.scan_directory
+    monkeypatch.setattr(dsd, "scan_directory", lambda top, matcher: scans.append(top) or scan_directory(top, matcher))
+    lane_1 = shared_scan.files_to_upload(sessions[0], {'files': {}}, sessions[0].args)
+    lane_2 = shared_scan.files_to_upload(sessions[1], {'files': {}}, sessions[1].args)
+    assert len(scans) == 1
+    assert [os.path.relpath(path, run_dir) for path in paths(lane_1)] == ["Data/L001/s_1_1101.bcl", "RunInfo.xml"]
+    assert [os.path.relpath(path, run_dir) for path in paths(lane_2)] == ["Data/L002/s_2_1101.bcl", "RunInfo.xml"]
+
+    # A session which missed the scan of the cycle is scanned on its own
+    shared_scan.unregister(sessions[0])
+    shared_scan.register(sessions[0])
+    assert paths(shared_scan.files_to_upload(sessions[0], {'files': {}}, sessions[0].args)) == paths(lane_1)
+    assert len(scans) == 2
+    shared_scan.new_cycle()
+    shared_scan.files_to_upload(sessions[1], {'files': {}}, sessions[1].args)
+    assert len(scans) == 3
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is Linux only")
+def test_shared_scan_probe_only_stats_watched_paths(run_dir, monkeypatch):
+    write_file(os.path.join(run_dir, "Data/L001/s_1_1101.bcl"))
+    class Session:
+        def __init__(self, args):
+            self.args = args
+            self.log = {'files': {}}
+    session = Session(make_args(run_dir, include_patterns=["s_1_"]))
+
+    scans = []
+    scan_directory = dsd.scan_directory
+    monkeypatch.setattr(dsd, "scan_directory", lambda top, matcher: scans.append(top) or scan_directory(top, matcher))
+    with pytest.raises(dsd.SyncError):
+        dsd.SharedScan(run_dir).probe()
+    with dir_watcher.InotifyWatcher(run_dir) as watcher:
+        shared_scan = dsd.SharedScan(run_dir, watcher)
+        shared_scan.register(session)
+        # The full walk at startup is left to the sync
+        assert shared_scan.probe() is None
+        assert paths(shared_scan.files_to_upload(session, session.log, session.args)) == \
+            [os.path.join(run_dir, "Data/L001/s_1_1101.bcl")]
+        assert len(scans) == 1
+
+        write_file(os.path.join(run_dir, "Data/L001/s_1_1102.bcl"), "foobar")
+        for _ in range(3):
+            assert shared_scan.probe() == {session: (6, os.path.getmtime(os.path.join(run_dir, "Data/L001/s_1_1102.bcl")))}
+        assert len(scans) == 1
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is Linux only")
+def test_shared_scan_keeps_changes_of_lanes_not_synced(run_dir):
+    class Session:
+        def __init__(self, lane):
+            self.args = make_args(run_dir, include_patterns=["s_%s_" % lane])
+            self.log = {'files': {}}
+    sessions = [Session(1), Session(2)]
+    with dir_watcher.InotifyWatcher(run_dir) as watcher:
+        shared_scan = dsd.SharedScan(run_dir, watcher)
+        for session in sessions:
+            shared_scan.register(session)
+            shared_scan.files_to_upload(session, session.log, session.args)
+        shared_scan.new_cycle()
+
+        lane_2_file = os.path.join(run_dir, "s_2_1101.bcl")
+        write_file(os.path.join(run_dir, "s_1_1101.bcl"))
+        write_file(lane_2_file, "12345")
+        assert shared_scan.probe()[sessions[1]][0] == 5
+        # Only lane 1 is due: the changes of lane 2 are kept for a later cycle
+        assert len(shared_scan.files_to_upload(sessions[0], sessions[0].log, sessions[0].args)) == 1
+        shared_scan.new_cycle()
+        assert shared_scan.probe()[sessions[1]][0] == 5
+        assert paths(shared_scan.files_to_upload(sessions[1], sessions[1].log, sessions[1].args)) == [lane_2_file]
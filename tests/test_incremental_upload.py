@@ -2,6 +2,8 @@ import sys
 import os
 import tempfile
 import shutil
+import argparse
+import threading
 import pytest
 
 src_dir = os.path.join(os.path.dirname(__file__), "..")
@@ -24,6 +26,19 @@ def create_files(rtacomplete_txt, rtacomplete_xml, copycomplete_txt):
     return tmp_folder
 
 
+def parse_args(monkeypatch, *options):
+    monkeypatch.setattr(sys, "argv", ["incremental_upload.py", "-a", "token", "-p", "project-xxxx", "-r", "/run",
+                                      "-t", "/tmp", "-L", "/log", "-l", "8"] + list(options))
+    return iu.parse_args()
+
+
+def sync_args(monkeypatch, *options):
+    """dx_sync_directory.py arguments of a lane synced with the given options"""
+    lane = {"lane": "1", "log_path": "/log", "remote_folder": "/run/runs/1", "prefix": "run.lane.1"}
+    command = iu.sync_dir_argv(lane, parse_args(monkeypatch, *options))
+    return iu.dx_sync_directory.parse_args(command)
+
+
 # parametrized with ((RTAComplete.txt, RTAComplete.xml, CopyComplete.txt), result, result_novaseq)
 @pytest.mark.parametrize("permutation,result,result_novaseq", [((False, False, False), False, False), ((False, False, True), False, True),
                                                                ((False, True, False), True, False), ((False, True, True), True, True),
@@ -36,3 +51,94 @@ def test_termination_file_exists(permutation, result, result_novaseq):
     shutil.rmtree(run_dir)  # deleting before potential assert failure
     assert actual == result
     assert actual_novaseq == result_novaseq
+
+
+def test_sync_dir_argv_does_not_accumulate_patterns(monkeypatch):
+    args = parse_args(monkeypatch, "-x", "Analysis", "-S", "-z", "100", "-M", "1000")
+    lane = {"lane": "1", "log_path": "/log", "remote_folder": "/run/runs/1", "prefix": "run.lane.1"}
+
+    for _ in range(3):
+        command = iu.sync_dir_argv(lane, args)
+
+    assert args.exclude_patterns == ["Analysis"]
+    excluded = command[command.index("--exclude-patterns") + 1:command.index("--min-tar-size")]
+    assert excluded == ["Analysis", "Images", "SampleSheet.csv"]
+    included = command[command.index("--include-patterns") + 1:command.index("--exclude-patterns")]
+    assert included == ["RTAConfiguration.xml", "RunInfo.xml", "RunParameters.xml", "config.xml", "s.locs", "s_1_"]
+
+    sync_args = iu.dx_sync_directory.parse_args(command)
+    assert sync_args.sync_dir == "/run" and sync_args.prefix == "run.lane.1"
+
+
+def test_sync_lanes_in_parallel():
+    args = argparse.Namespace(parallel_lanes=4, num_lanes=8, upload_threads=8)
+    assert iu.lane_upload_threads(args) == 2
+
+    # Lanes 1-4 have to be synced at the same time to get past the barrier
+    barrier = threading.Barrier(4, timeout=10)
+    synced = []
+    def sync_lane(lane):
+        if lane["lane"] in "1234":
+            barrier.wait()
+        synced.append(lane["lane"])
+    iu.sync_lanes([{"lane": str(i)} for i in range(1, 9)], args, sync_lane)
+    assert sorted(synced) == [str(i) for i in range(1, 9)]
+
+    def fail(lane):
+        raise SystemExit()
+    with pytest.raises(SystemExit):
+        iu.sync_lanes([{"lane": str(i)} for i in range(1, 9)], args, fail)
+
+
+def test_lanes_due_on_backlog_or_latency():
+    class SharedScan:
+        def probe(self):
+            return pending
+    sessions = [object() for _ in range(4)]
+    lanes = [{"lane": str(i + 1), "session": session} for i, session in enumerate(sessions)]
+    lanes.append({"lane": "5"})
+    now = 10000
+    pending = {sessions[0]: (200 * 2**20, now - 200),   # enough data
+               sessions[1]: (2**20, now - 3000),        # waited too long
+               sessions[2]: (2**20, now - 200),         # waiting for more
+               sessions[3]: (0, None)}                  # nothing to sync
+    args = argparse.Namespace(min_size=100, min_age=100, max_latency=1800)
+
+    assert iu.lanes_due(lanes, args, SharedScan(), now) == {"1": False, "2": True, "5": False}
+
+
+def test_upload_options_reach_sync_dir_argv(monkeypatch):
+    assert not sync_args(monkeypatch).stream_upload
+    assert sync_args(monkeypatch, "--stream-upload").stream_upload
+    args = sync_args(monkeypatch, "--pipeline-depth", "2", "--max-staged-size", "5000")
+    assert (args.pipeline_depth, args.max_staged_size) == (2, 5000)
+    args = sync_args(monkeypatch, "--parallel-lanes", "2", "--parallel-uploads", "2")
+    # The 8 upload threads are shared by 2 lanes, and by 2 uploads within a lane
+    assert (args.upload_threads, args.parallel_uploads) == (4, 2)
+    assert iu.dx_sync_directory.upload_threads_per_tar(args) == 2
+
+    # Native uploads interrupted by the hourly restart are resumed by the next run
+    args = sync_args(monkeypatch, "-Z", "--native-upload", "--part-size", "16")
+    assert args.native_upload and args.hourly_restart
+    assert iu.dx_sync_directory.check_inputs(args).part_size == 16 * 2**20
+
+    args = sync_args(monkeypatch, "--bandwidth-limit", "10", "--bandwidth-state-file", "/var/lib/dnanexus/bandwidth.state")
+    assert args.bandwidth_state_file == "/var/lib/dnanexus/bandwidth.state"
+    assert sync_args(monkeypatch).bandwidth_state_file is None
+
+    assert sync_args(monkeypatch).tar_packing == "sequential"
+    assert sync_args(monkeypatch, "--tar-packing", "ffd").tar_packing == "ffd"
+
+
+def test_probe_interval_requires_watch(monkeypatch):
+    with pytest.raises(SystemExit):
+        parse_args(monkeypatch, "--probe-interval", "60")
+    assert parse_args(monkeypatch, "--probe-interval", "60", "--watch").probe_interval == 60
+
+    class SharedScan:
+        def probe(self):
+            # The watcher asks for a full walk, left to the sync
+            return None
+    lanes = [{"lane": "1", "session": object()}, {"lane": "2", "session": object()}]
+    args = argparse.Namespace(min_size=100, min_age=100, max_latency=1800)
+    assert iu.lanes_due(lanes, args, SharedScan()) == {"1": False, "2": False}
@@ -1,5 +1,6 @@
 import sys
 import os
+import struct
 import pytest
 
 src_dir = os.path.join(os.path.dirname(__file__), "..")
@@ -23,3 +24,132 @@ def test_translate_integers(example, result):
     for key in transformation:
         assert transformation[key] == result[key]
         assert isinstance(transformation[key], type(result[key]))
+
+
+def make_run(base_dir, name, created, complete=False):
+    folder = os.path.join(base_dir, name)
+    os.makedirs(folder)
+    run_info = os.path.join(folder, "RunInfo.xml")
+    with open(run_info, 'w') as fh:
+        fh.write('<RunInfo><Run><Reads><Read Number="1" NumCycles="10" /></Reads></Run></RunInfo>')
+    os.utime(run_info, (created, created))
+    if complete:
+        open(os.path.join(folder, "RTAComplete.txt"), 'w').close()
+    return folder
+
+
+def test_schedule_runs_by_priority_completion_and_age(tmp_path):
+    new = make_run(str(tmp_path), "run_new", 2000)
+    old = make_run(str(tmp_path), "run_old", 1000)
+    done = make_run(str(tmp_path), "run_done", 3000, complete=True)
+    urgent = make_run(str(tmp_path), "urgent_run", 4000)
+    config = {"n_streaming_threads": 2, "n_upload_threads": 8, "total_upload_threads": 12,
+              "run_priorities": {"urgent_*": 1}}
+
+    scheduled = mr.schedule_runs([new, old, done, urgent], config)
+    # The completed run and the prioritized one weigh twice as much as the others
+    assert [folder for folder, _ in scheduled] == [done, urgent, old, new]
+    assert [run_config["n_upload_threads"] for _, run_config in scheduled] == [6, 6, 3, 3]
+
+    # Without a total, every run keeps n_upload_threads
+    config["total_upload_threads"] = 0
+    assert all(run_config["n_upload_threads"] == 8 for _, run_config in mr.schedule_runs([new, done], config))
+
+
+def test_run_progress_of_least_advanced_lane(tmp_path):
+    folder = make_run(str(tmp_path), "run", 1000)
+    with open(os.path.join(folder, "RunInfo.xml"), 'w') as fh:
+        fh.write('<RunInfo><Run><Reads><Read Number="1" NumCycles="10" /></Reads>'
+                 '<FlowcellLayout LaneCount="2" SurfaceCount="1" SwathCount="1" TileCount="1" /></Run></RunInfo>')
+    os.makedirs(os.path.join(folder, "InterOp"))
+    # Lane 1 extracted up to cycle 6, lane 2 up to cycle 4
+    with open(os.path.join(folder, mr.run_readiness.EXTRACTION_METRICS), 'wb') as fh:
+        fh.write(bytes([2, 38]))
+        for lane, cycles in ((1, 6), (2, 4)):
+            for cycle in range(1, cycles + 1):
+                fh.write(struct.pack("<HHH", lane, 1101, cycle) + b"\x00" * 32)
+
+    assert mr.run_progress(folder) == pytest.approx(0.2)
+    # The progress of the run is followed by the same reader from then on
+    assert mr.run_readiness.for_run(folder).last_refresh is not None
+
+
+def test_sentinel_cache_skips_closed_runs(tmp_path, monkeypatch):
+    config = {"project": "project-xxxx", "log_dir": str(tmp_path), "sentinel_cache_ttl": 60}
+    states = {"run_closed": "closed", "run_open": "open", "run_other": "open"}
+    queried = []
+    def find_sentinel_states(project):
+        queried.append(project)
+        return dict(states)
+    monkeypatch.setattr(mr, "find_sentinel_states", find_sentinel_states)
+    lapsed = set()
+    monkeypatch.setattr(mr, "local_upload_has_lapsed", lambda folder, config: folder in lapsed)
+
+    cache = mr.load_sentinel_cache(config)
+    assert mr.check_incomplete_sync(["run_closed", "run_open"], config, cache) == []
+    mr.save_sentinel_cache(cache, config)
+    assert queried == ["project-xxxx"]
+
+    # Cached runs are known to be synced without listing the project
+    cache = mr.load_sentinel_cache(config)
+    assert mr.check_dnax_folders(["run_closed", "run_open"], "project-xxxx", cache) == (["run_closed", "run_open"], [])
+    assert mr.check_incomplete_sync(["run_closed", "run_open"], config, cache) == []
+    assert queried == ["project-xxxx"]
+
+    # Open runs are looked up again once their state is older than the TTL
+    cache["runs"]["run_open"]["checked"] -= 60
+    lapsed.add("run_open")
+    assert mr.check_incomplete_sync(["run_closed", "run_open"], config, cache) == ["run_open"]
+    assert queried == ["project-xxxx"] * 2
+
+    # or before being relaunched, in case the sentinel was closed while cached as open
+    states["run_open"] = "closed"
+    assert cache["runs"]["run_open"]["state"] == "open"
+    assert mr.check_incomplete_sync(["run_closed", "run_open"], config, cache) == []
+    assert queried == ["project-xxxx"] * 3
+    assert mr.check_incomplete_sync(["run_closed", "run_open"], config, cache) == []
+    assert queried == ["project-xxxx"] * 3
+
+    # The cache of another project is not used
+    assert mr.load_sentinel_cache(dict(config, project="project-yyyy"))["runs"] == {}
+
+
+def test_find_sentinel_states_in_one_search(monkeypatch):
+    searches = []
+    def find_data_objects(**kwargs):
+        searches.append(kwargs)
+        records = [("/run_a/runs", "closed"), ("/run_b/runs/1", "closed"), ("/run_b/runs/2", "open"),
+                   ("/run_c/runs/1", "closed"), ("/run_c/reads", "open"), ("/misc", "open")]
+        return iter({"id": "record-%d" % i, "describe": {"folder": folder, "state": state}}
+                    for i, (folder, state) in enumerate(records))
+    monkeypatch.setattr(mr.dxpy, "find_data_objects", find_data_objects)
+
+    assert mr.find_sentinel_states("project-xxxx") == {"run_a": "closed", "run_b": "open", "run_c": "closed"}
+    assert len(searches) == 1
+    assert searches[0]["typename"] == "UploadSentinel" and searches[0]["recurse"]
+
+
+def incremental_upload_argv(**config):
+    config = dict(mr.CONFIG_DEFAULT, token="token", project="project-xxxx", **config)
+    return mr.incremental_upload_command("/runs/run_1", config)
+
+
+def test_upload_options_reach_incremental_upload():
+    assert "--stream-upload" not in incremental_upload_argv()
+    assert "--stream-upload" in incremental_upload_argv(stream_upload=True)
+    argv = incremental_upload_argv(pipeline_depth=2, max_staged_size=5000)
+    assert argv[argv.index("--pipeline-depth") + 1] == "2"
+    assert argv[argv.index("--max-staged-size") + 1] == "5000"
+    assert "--pipeline-depth" not in incremental_upload_argv()
+    argv = incremental_upload_argv(n_parallel_uploads=3)
+    assert argv[argv.index("--parallel-uploads") + 1] == "3"
+    argv = incremental_upload_argv(native_upload=True, part_size=16, hourly_restart=True)
+    assert "--native-upload" in argv and "-Z" in argv
+    assert argv[argv.index("--part-size") + 1] == "16"
+    assert "--part-size" not in incremental_upload_argv()
+    argv = incremental_upload_argv(bandwidth_limit=10, bandwidth_state_file="/var/lib/dnanexus/bandwidth.state")
+    assert argv[argv.index("--bandwidth-state-file") + 1] == "/var/lib/dnanexus/bandwidth.state"
+    assert "--bandwidth-state-file" not in incremental_upload_argv()
+    assert "--tar-packing" not in incremental_upload_argv()
+    argv = incremental_upload_argv(tar_packing="ffd")
+    assert argv[argv.index("--tar-packing") + 1] == "ffd"
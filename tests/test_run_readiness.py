@@ -0,0 +1,123 @@
+import sys
+import os
+import argparse
+import struct
+import tempfile
+import shutil
+import pytest
+
+src_dir = os.path.join(os.path.dirname(__file__), "..")
+files_dir = os.path.join(src_dir, "files")
+sys.path.append(files_dir)
+import run_readiness
+import dx_sync_directory as dsd
+
+
+RUN_INFO = """<?xml version="1.0"?>
+<RunInfo Version="5">
+  <Run Id="180731_A00000_0001_AH00000000" Number="1">
+    <Reads>
+      <Read Number="1" NumCycles="4" IsIndexedRead="N" />
+      <Read Number="2" NumCycles="2" IsIndexedRead="Y" />
+      <Read Number="3" NumCycles="4" IsIndexedRead="N" />
+    </Reads>
+    <FlowcellLayout LaneCount="2" SurfaceCount="1" SwathCount="1" TileCount="2" />
+  </Run>
+</RunInfo>
+"""
+
+
+def add_extraction_metrics(run_dir, records, version=2):
+    """Append (lane, tile, cycle) records to ExtractionMetricsOut.bin"""
+    path = os.path.join(run_dir, run_readiness.EXTRACTION_METRICS)
+    record_id = struct.Struct("<HHH" if version == 2 else "<HIH")
+    record_size = record_id.size + 32
+    with open(path, 'ab') as fh:
+        if fh.tell() == 0:
+            fh.write(bytes([version, record_size]) + (b"\x04" if version == 3 else b""))
+        for record in records:
+            fh.write(record_id.pack(*record) + b"\x00" * 32)
+
+
+def bcl_path(run_dir, lane, cycle, tile=1101):
+    return os.path.join(run_dir, "Data", "Intensities", "BaseCalls", "L%03d" % lane,
+                        "C%d.1" % cycle, "s_%d_%d.bcl.gz" % (lane, tile))
+
+
+@pytest.fixture
+def run_dir():
+    tmp_folder = tempfile.mkdtemp()
+    os.makedirs(os.path.join(tmp_folder, "InterOp"))
+    with open(os.path.join(tmp_folder, "RunInfo.xml"), 'w') as fh:
+        fh.write(RUN_INFO)
+    yield tmp_folder
+    shutil.rmtree(tmp_folder)
+
+
+@pytest.mark.parametrize("version", [2, 3])
+def test_cycles_complete_once_extraction_moved_on(run_dir, version):
+    readiness = run_readiness.RunReadiness(run_dir)
+    add_extraction_metrics(run_dir, [(1, tile, cycle) for cycle in (1, 2, 3) for tile in (1101, 1102)] +
+                           [(1, 1101, 4), (2, 1101, 1), (2, 1102, 1)], version)
+    readiness.refresh(now=0)
+
+    # Lane 1 was extracted up to cycle 3 (cycle 4 misses a tile)
+    assert readiness.is_ready(bcl_path(run_dir, 1, 1))
+    assert readiness.is_ready(bcl_path(run_dir, 1, 2)) is None
+    assert readiness.is_ready(bcl_path(run_dir, 2, 1)) is None
+    assert readiness.is_ready(os.path.join(run_dir, "RunInfo.xml")) is None
+
+    # New records are read incrementally, refreshes are throttled
+    add_extraction_metrics(run_dir, [(1, 1102, 4)], version)
+    readiness.refresh(now=1)
+    assert readiness.is_ready(bcl_path(run_dir, 1, 2)) is None
+    readiness.refresh(now=run_readiness.REFRESH_INTERVAL)
+    assert readiness.is_ready(bcl_path(run_dir, 1, 2))
+    assert readiness.is_ready(os.path.dirname(bcl_path(run_dir, 1, 2)))
+
+
+def test_run_info_tiles_per_lane(run_dir):
+    assert run_readiness.parse_run_info(run_dir) == ([4, 2, 4], 2, {1: 2, 2: 2})
+
+    # Camera sections each image every lane, and tile sets list the tiles
+    with open(os.path.join(run_dir, "RunInfo.xml"), 'w') as fh:
+        fh.write(RUN_INFO.replace(
+            'TileCount="2" />',
+            'TileCount="2" SectionPerLane="3" LanePerSection="2" />'))
+    assert run_readiness.parse_run_info(run_dir)[1:] == (2, {1: 6, 2: 6})
+    with open(os.path.join(run_dir, "RunInfo.xml"), 'w') as fh:
+        fh.write(RUN_INFO.replace(
+            'TileCount="2" />',
+            'TileCount="2"><TileSet><Tiles><Tile>1_1101</Tile><Tile>2_1101</Tile>'
+            '<Tile>2_1102</Tile><Tile>2_1103</Tile></Tiles></TileSet></FlowcellLayout>'))
+    assert run_readiness.parse_run_info(run_dir)[1:] == (2, {1: 1, 2: 3})
+
+
+def test_read_complete_markers_release_read_cycles(run_dir):
+    readiness = run_readiness.RunReadiness(run_dir)
+    open(os.path.join(run_dir, "RTARead2Complete.txt"), 'w').close()
+    readiness.refresh(now=0)
+
+    # Reads 1 and 2 span cycles 1 to 6, in all lanes
+    assert readiness.is_ready(bcl_path(run_dir, 2, 6))
+    assert readiness.is_ready(bcl_path(run_dir, 2, 7)) is None
+
+
+def test_select_files_to_upload_releases_complete_cycles(run_dir):
+    args = argparse.Namespace(sync_dir=run_dir, min_age=3600, rta_readiness=True)
+    for cycle in (1, 2):
+        path = bcl_path(run_dir, 1, cycle)
+        os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+    add_extraction_metrics(run_dir, [(1, tile, cycle) for cycle in (1, 2, 3) for tile in (1101, 1102)])
+
+    entries = [dsd.entry_from_stat(path, os.lstat(path))
+               for path in (bcl_path(run_dir, 1, 1), bcl_path(run_dir, 1, 2),
+                            os.path.join(run_dir, "RunInfo.xml"))]
+    to_upload, not_ready = dsd.select_files_to_upload(entries, {'files': {}}, args)
+    assert [entry.path for entry in to_upload] == [bcl_path(run_dir, 1, 1)]
+    assert not_ready == [bcl_path(run_dir, 1, 2), os.path.join(run_dir, "RunInfo.xml")]
+
+    # Without --rta-readiness, only --min-age applies
+    args.rta_readiness = False
+    assert dsd.select_files_to_upload(entries, {'files': {}}, args)[0] == []
@@ -0,0 +1,126 @@
+import sys
+import os
+import hashlib
+import http.server
+import threading
+import tempfile
+import shutil
+import pytest
+
+src_dir = os.path.join(os.path.dirname(__file__), "..")
+files_dir = os.path.join(src_dir, "files")
+sys.path.append(files_dir)
+import upload_engine
+
+
+class PartHandler(http.server.BaseHTTPRequestHandler):
+    """Stand-in for the part upload URLs: PUT /<file id>/<part index>"""
+    protocol_version = "HTTP/1.1"
+
+    def do_PUT(self):
+        server = self.server
+        data = self.rfile.read(int(self.headers["Content-Length"]))
+        file_id, index = self.path.strip("/").split("/")
+        with server.lock:
+            server.connections.add(self.client_address)
+            fail = server.fail_once.pop((file_id, int(index)), None)
+        if fail:
+            status = fail
+        elif hashlib.md5(data).hexdigest() != self.headers["Content-MD5"]:
+            status = 400
+        else:
+            server.parts.setdefault(file_id, {})[int(index)] = data
+            status = 200
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalFileAPI(upload_engine.DXFileAPI):
+    """File API calls answered locally, parts sent to the local server"""
+
+    def __init__(self, server):
+        super().__init__(pool=upload_engine.urllib3.PoolManager(maxsize=4, block=True))
+        self.server = server
+        self.closed = []
+
+    def new_file(self, project, folder, name):
+        return "file-%04d" % len(self.closed)
+
+    def get_upload_url(self, file_id, index, size, md5):
+        url = "http://127.0.0.1:%d/%s/%d" % (self.server.server_port, file_id, index)
+        return url, {"Content-MD5": md5}
+
+    def close(self, file_id):
+        self.closed.append(file_id)
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), PartHandler)
+    server.lock = threading.Lock()
+    server.parts = {}
+    server.connections = set()
+    server.fail_once = {}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def tmp_dir():
+    tmp_folder = tempfile.mkdtemp()
+    yield tmp_folder
+    shutil.rmtree(tmp_folder)
+
+
+def test_choose_part_size():
+    assert upload_engine.choose_part_size(2**20) == upload_engine.MIN_PART_SIZE
+    assert upload_engine.choose_part_size(2**20, 64 * 2**20) == 64 * 2**20
+    # Raised to fit within the part limit
+    assert upload_engine.choose_part_size(10**12, 5 * 2**20) * upload_engine.MAX_PARTS >= 10**12
+    assert upload_engine.adaptive_part_size(80 * 2**20, 4) == upload_engine.MIN_PART_SIZE
+    assert upload_engine.adaptive_part_size(8 * 2**30, 4) == upload_engine.DEFAULT_PART_SIZE
+    with pytest.raises(ValueError):
+        upload_engine.choose_part_size(upload_engine.MAX_PART_SIZE * upload_engine.MAX_PARTS)
+
+
+def test_upload_file_in_parallel_parts(server, tmp_dir, monkeypatch):
+    monkeypatch.setattr(upload_engine.time, "sleep", lambda seconds: None)
+    api = LocalFileAPI(server)
+    part_size = upload_engine.MIN_PART_SIZE
+    paths = []
+    for i in range(2):
+        paths.append(os.path.join(tmp_dir, "run_%03d.tar" % i))
+        with open(paths[-1], 'wb') as fh:
+            fh.write(os.urandom(3 * part_size + 1000))
+    # A transient server error is retried
+    server.fail_once[("file-0000", 2)] = 503
+
+    progress = []
+    file_ids = [upload_engine.upload_file(path, "project-xxxx", "/", api=api, threads=3, part_size=part_size,
+                                          progress=lambda done, total: progress.append((done, total)))
+                for path in paths]
+
+    assert file_ids == ["file-0000", "file-0001"] == api.closed
+    for path, file_id in zip(paths, file_ids):
+        parts = server.parts[file_id]
+        assert sorted(parts) == [1, 2, 3, 4]
+        with open(path, 'rb') as fh:
+            assert b"".join(parts[index] for index in sorted(parts)) == fh.read()
+    total = os.path.getsize(paths[0])
+    assert progress[3] == (total, total) and progress[-1] == (total, total)
+    # Connections are reused across parts and files
+    assert len(server.connections) <= 4
+
+
+def test_upload_part_gives_up_on_client_errors(server, tmp_dir):
+    api = LocalFileAPI(server)
+    server.fail_once[("file-0000", 1)] = 403
+    with pytest.raises(upload_engine.UploadError):
+        api.upload_part("file-0000", 1, b"foo")